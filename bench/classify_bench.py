@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Microbenchmark for eac3bot's track classifier.
+#
+# Builds large synthetic eac3to playlist listings and times the track
+# selection done for every playlist (video, lossless, lossy and
+# subtitle tracks), using the compiled classifier and a copy of the
+# old find_track_matches/filter_by implementation for comparison. Both
+# must select the same tracks; the script exits non-zero if they don't.
+#
+# Usage: classify_bench.py [--tracks N] [--listings N] [--languages L ...]
+#
+
+import sys
+import os
+import re
+import random
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import eac3bot
+
+CODECS = ['Chapters, %(n)d chapters',
+          'h264/AVC, 1080p24 /1.001 (16:9)',
+          'h264/AVC, 1080i50 (16:9)',
+          'VC-1, 1080p24 /1.001 (16:9)',
+          'MPEG2, 1080p24 /1.001 (16:9)',
+          'DTS Master Audio, %(lang)s, %(ch)s channels, 24 bits, 48kHz',
+          'TrueHD/AC3, %(lang)s, %(ch)s channels, 48kHz',
+          'RAW/PCM, %(lang)s, %(ch)s channels, 16 bits, 48kHz',
+          'AC3, %(lang)s, %(ch)s channels, 192kbps, 48kHz, dialnorm: -27dB',
+          'AC3 Surround, %(lang)s, %(ch)s channels, 448kbps, 48kHz',
+          'DTS, %(lang)s, %(ch)s channels, 768kbps, 48kHz',
+          'DTS Express, %(lang)s, %(ch)s channels, 192kbps, 48kHz',
+          'Subtitle (PGS), %(lang)s']
+LANGUAGES = ['English', 'French', 'German', 'Spanish', 'Italian',
+             'Japanese', 'Dutch', 'Polish', 'Czech', 'Korean']
+CHANNELS = ['1.0', '2.0', '5.1', '6.1', '7.1']
+
+def synthetic_listing(rng, ntracks):
+    lines = ['M2TS, 1 video track, %d audio tracks, 1:49:08, 24p /1.001' % ntracks]
+    for i in range(1, ntracks + 1):
+        desc = rng.choice(CODECS) % {'n': rng.randint(1, 40),
+                                     'lang': rng.choice(LANGUAGES),
+                                     'ch': rng.choice(CHANNELS)}
+        lines.append('%d: %s' % (i, desc))
+        if desc.startswith('DTS Master'):
+            lines.append('   (core: DTS, 5.1 channels, 1509kbps, 48kHz)')
+    return lines
+
+#
+# The selection code eac3bot used before the classifier.
+#
+def legacy_find_track_matches(regex, track_list):
+    def match(track):
+        m = re.match(regex, track)
+        if m:
+            return m.groupdict()
+        else:
+            return None
+    return filter(lambda x: x, map(match, track_list))
+
+def legacy_filter_by(regexes, tracks):
+    selected_tracks = []
+    for r in regexes:
+        selected_tracks += filter(lambda t: re.search(r, t['description']),
+                                  tracks)
+    return selected_tracks
+
+def legacy_select(lines, languages):
+    fm = legacy_find_track_matches
+    video = []
+    for r in [r'h264/AVC, 1080p24 /1.001 \(16:9\)$', r'h264/AVC, 1080i50 \(16:9\)$',
+              r'VC-1, 1080p24 /1.001 \(16:9\)$', r'MPEG2, 1080p24 /1.001 \(16:9\)$']:
+        video += fm(r'(?P<id>[0-9]+:) (?P<description>%s)' % r, lines)
+    lossless = []
+    for r in [r'DTS Master Audio, .*', r'TrueHD/AC3, .*', r'RAW/PCM, .*']:
+        lossless += fm(r'(?P<id>[0-9]+:) (?P<description>%s)' % r, lines)
+    lossy = []
+    for r in [r'AC3, .*', r'AC3 Surround, .*', r'DTS, .*']:
+        lossy += fm(r'(?P<id>[0-9]+:) (?P<description>%s)' % r, lines)
+    subtitles = fm(r'(?P<id>[0-9]+:) (?P<description>Subtitle \(PGS\), .*)', lines)
+    return [video,
+            legacy_filter_by(languages, lossless),
+            legacy_filter_by([r'[12]\.0'], legacy_filter_by(languages, lossy)),
+            legacy_filter_by(languages, subtitles)]
+
+def classifier_select(lines, languages):
+    table = eac3bot.track_classifier().classify(lines)
+    return [eac3bot.video_tracks(table),
+            eac3bot.lossless_audio_tracks(table, languages),
+            eac3bot.lossy_audio_tracks(table, languages),
+            eac3bot.subtitle_tracks(table, languages)]
+
+def dedup(tracks):
+    seen = set()
+    result = []
+    for t in tracks:
+        if t['id'] not in seen:
+            seen.add(t['id'])
+            result.append(t)
+    return result
+
+def timed(func, listings, languages, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        for lines in listings:
+            func(lines, languages)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the eac3bot track classifier.')
+    parser.add_argument('--tracks', type=int, default=200,
+                        help='Tracks per synthetic listing (default: 200).')
+    parser.add_argument('--listings', type=int, default=200,
+                        help='Number of synthetic listings (default: 200).')
+    parser.add_argument('--languages', nargs='+', default=['English', 'French', 'German'],
+                        help='Soundtrack languages to select (default: English French German).')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Take the best of this many runs (default: 3).')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    listings = [synthetic_listing(rng, args.tracks) for _ in range(args.listings)]
+
+    # Same selections, except that the old code could return a track
+    # more than once.
+    for lines in listings:
+        old = [dedup(x) for x in legacy_select(lines, args.languages)]
+        new = classifier_select(lines, args.languages)
+        if old != new:
+            print >> sys.stderr, 'Selections differ for listing:\n%s' % '\n'.join(lines)
+            return 1
+
+    ntracks = args.tracks * args.listings
+    legacy = timed(legacy_select, listings, args.languages, args.repeat)
+    compiled = timed(classifier_select, listings, args.languages, args.repeat)
+    print '%d listings x %d tracks, %d languages' % (args.listings, args.tracks, len(args.languages))
+    print '  legacy:     %8.3fs  %10.0f tracks/s' % (legacy, ntracks / legacy)
+    print '  classifier: %8.3fs  %10.0f tracks/s' % (compiled, ntracks / compiled)
+    print '  speedup:    %8.1fx' % (legacy / compiled)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Benchmark and regression check for eac3bot, using the stand-in
+# eac3to and mkvmerge in bench/fake and the recorded scans in
+# bench/scans (one directory per disc), so no drive or Windows tools
+# are needed.
+#
+# Measures:
+#
+#   parse     scan parsing and track classification, in scans per
+#             second, for every recording;
+#   demux     end-to-end demux() of the 'feature' recording, with tiny
+#             tracks, split into time spent in the tools (the traced
+#             phases) and eac3bot's own overhead;
+#   scaling   demuxing the 'series' episodes serially, as a pipeline
+#             and with --jobs, with extraction and muxing slowed to a
+#             fixed rate.
+#
+# Every recording is also demuxed once to record what eac3bot makes of
+# it: the playlists it finds, and each playlist's eac3to command line
+# and mkvmerge options. --save writes these and the measurements to a
+# baseline file; --compare fails if the results differ from a
+# baseline, or if a measurement is worse than the baseline by more
+# than --tolerance.
+#
+# Usage: demux_bench.py [--only parse demux scaling] [--save FILE]
+#                       [--compare FILE] [--tolerance FRACTION]
+#
+# bench/baseline.json is a baseline from a reference machine; its
+# results hold anywhere, its timings only on similar hardware.
+#
+
+import sys
+import os
+import time
+import json
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+import eac3bot
+
+FAKE_EAC3TO = os.path.join(BENCH_DIR, 'fake', 'eac3to')
+FAKE_MKVMERGE = os.path.join(BENCH_DIR, 'fake', 'mkvmerge')
+SCANS_DIR = os.path.join(BENCH_DIR, 'scans')
+BASELINE_VERSION = 1
+
+def recordings():
+    return sorted([name for name in os.listdir(SCANS_DIR)
+                   if os.path.isdir(os.path.join(SCANS_DIR, name))])
+
+def read_recording(name, scan):
+    f = open(os.path.join(SCANS_DIR, name, scan), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+class Quiet(object):
+    """Run demux() in a scratch directory, without its console output."""
+
+    def __init__(self, env):
+        self.env = env
+
+    def __enter__(self):
+        self.saved_env = dict(os.environ)
+        os.environ.update(self.env)
+        self.cwd = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix='eac3bot-bench-')
+        os.chdir(self.work_dir)
+        # eac3to's output is echoed to stdout while it runs.
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        return self.work_dir
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+
+def fake_env(recording, size=64 * 1024, rate=0, mux_rate=0):
+    return {'FAKE_EAC3TO_SCANS': os.path.join(SCANS_DIR, recording),
+            'FAKE_EAC3TO_SIZE': str(size),
+            'FAKE_EAC3TO_RATE': str(rate),
+            'FAKE_MKVMERGE_RATE': str(mux_rate)}
+
+def run_demux(recording, playlists=None, **options):
+    return eac3bot.demux(dict(options, eac3to=FAKE_EAC3TO, mkvmerge=FAKE_MKVMERGE,
+                              path=os.path.join(SCANS_DIR, recording), name=recording,
+                              playlist_indexes=playlists, use_cache=False, preflight=False))
+
+#
+# Benchmarks.
+#
+def bench_parse(args, metrics):
+    classifier = eac3bot.track_classifier()
+    for name in recordings():
+        scans = sorted(os.listdir(os.path.join(SCANS_DIR, name)))
+        outputs = [(scan, read_recording(name, scan)) for scan in scans]
+        best = None
+        for _ in range(args.repeat):
+            started = time.time()
+            for _ in range(args.parse_iterations):
+                for scan, output in outputs:
+                    lines = eac3bot.scan_lines(output)
+                    if scan == 'disc.txt':
+                        eac3bot.parse_playlists(lines)
+                    else:
+                        classifier.classify(lines)
+            elapsed = time.time() - started
+            if best is None or elapsed < best:
+                best = elapsed
+        rate = args.parse_iterations * len(outputs) / best
+        metrics['parse.%s.scans_per_second' % name] = rate
+        print '  parse %-10s %10.0f scans/s' % (name, rate)
+
+def busy_seconds(spans):
+    """The time covered by at least one span; phases can overlap."""
+    total = 0.0
+    end = None
+    for span in sorted(spans, key=lambda span: span['start']):
+        span_end = span['start'] + span['wall']
+        if end is None or span['start'] >= end:
+            total += span['wall']
+            end = span_end
+        elif span_end > end:
+            total += span_end - end
+            end = span_end
+    return total
+
+def bench_demux(args, metrics):
+    spans = []
+    eac3bot.add_trace_hook(spans.append)
+    try:
+        best = None
+        for _ in range(args.repeat):
+            del spans[:]
+            with Quiet(fake_env('feature')):
+                started = time.time()
+                rc = run_demux('feature')
+                wall = time.time() - started
+            if rc:
+                raise RuntimeError('demux failed with status %d' % rc)
+            tools = busy_seconds(spans)
+            if best is None or wall < best[0]:
+                best = (wall, tools)
+    finally:
+        eac3bot.trace_hooks.remove(spans.append)
+    wall, tools = best
+    metrics['demux.wall_seconds'] = wall
+    metrics['demux.overhead_seconds'] = wall - tools
+    print '  demux feature     %8.3fs  (%.3fs in tools, %.3fs overhead)' \
+        % (wall, tools, wall - tools)
+
+def bench_scaling(args, metrics):
+    episodes = [2, 3, 4, 5]
+    env = fake_env('series', size=args.track_size, rate=args.rate, mux_rate=args.rate)
+    modes = [('serial', {}), ('pipeline', {'pipeline': True})]
+    modes += [('jobs%d' % jobs, {'jobs': jobs}) for jobs in args.jobs if jobs > 1]
+    serial = None
+    for mode, kwargs in modes:
+        with Quiet(env):
+            started = time.time()
+            rc = run_demux('series', episodes, **kwargs)
+            wall = time.time() - started
+        if rc:
+            raise RuntimeError('demux (%s) failed with status %d' % (mode, rc))
+        if serial is None:
+            serial = wall
+        metrics['scaling.%s.wall_seconds' % mode] = wall
+        if mode != 'serial':
+            metrics['scaling.%s.speedup' % mode] = serial / wall
+        print '  %d episodes %-8s %8.3fs  %5.2fx' % (len(episodes), mode, wall, serial / wall)
+
+#
+# What eac3bot makes of each recording.
+#
+def collect_results():
+    results = {}
+    for name in recordings():
+        disc = eac3bot.parse_playlists(eac3bot.scan_lines(read_recording(name, 'disc.txt')))
+        playlists = {}
+        commands = {}
+        def listener(event):
+            if event['type'] == 'start' and event['label'].endswith(' extraction'):
+                # Without the paths of eac3to and the disc.
+                commands[event['label']] = event['command'][2:]
+        eac3bot.progress_listeners.append(listener)
+        try:
+            with Quiet(fake_env(name)) as work_dir:
+                rc = run_demux(name, 'all')
+                for pl, dur in disc:
+                    options = os.path.join(work_dir, '%s.playlist_%02d' % (name, pl),
+                                           'mkvmerge.options')
+                    if not os.path.isfile(options):
+                        playlists['%d' % pl] = None
+                        continue
+                    playlists['%d' % pl] = {
+                        'eac3to': commands.get('playlist %d) extraction' % pl),
+                        'mkvmerge': open(options).read().splitlines()}
+        finally:
+            eac3bot.progress_listeners.remove(listener)
+        results[name] = {'status': rc,
+                         'playlists': [[pl, dur] for pl, dur in disc],
+                         'demux': playlists}
+    return results
+
+#
+# Baselines.
+#
+def worse_by(metric, value, baseline):
+    """How much worse ``value`` is than ``baseline``, as a fraction."""
+    if metric.endswith('_seconds'):
+        return (value - baseline) / max(baseline, 1e-9)
+    return (baseline - value) / max(baseline, 1e-9)
+
+def compare(baseline, metrics, results, tolerance, min_delta):
+    failed = False
+    if baseline.get('results') != results:
+        for name in sorted(set(baseline.get('results', {})) | set(results)):
+            if baseline.get('results', {}).get(name) != results.get(name):
+                print >> sys.stderr, 'Results for %s differ from the baseline' % name
+        failed = True
+    for metric in sorted(metrics):
+        if metric not in baseline.get('metrics', {}):
+            continue
+        worse = worse_by(metric, metrics[metric], baseline['metrics'][metric])
+        if metric.endswith('_seconds') and \
+                metrics[metric] - baseline['metrics'][metric] < min_delta:
+            # Too small to tell from noise.
+            continue
+        if worse > tolerance:
+            print >> sys.stderr, '%s regressed by %.0f%% (%.4g, baseline %.4g)' \
+                % (metric, worse * 100, metrics[metric], baseline['metrics'][metric])
+            failed = True
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark eac3bot with stand-in tools and recorded scans.')
+    parser.add_argument('--only', nargs='+', choices=['parse', 'demux', 'scaling'],
+                        default=['parse', 'demux', 'scaling'],
+                        help='Run only these benchmarks.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Take the best of this many runs (default: 3).')
+    parser.add_argument('--parse-iterations', type=int, default=500,
+                        help='Passes over the recordings per parse run (default: 500).')
+    parser.add_argument('--track-size', type=int, default=2 * 1024 * 1024,
+                        help='Size of each extracted track in the scaling runs, in bytes (default: 2 MB).')
+    parser.add_argument('--rate', type=int, default=32 * 1024 * 1024,
+                        help='Extraction and mux rate in the scaling runs, in bytes per second (default: 32 MB/s).')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[2, 4],
+                        help='--jobs values to try in the scaling runs (default: 2 4).')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Write the results to this baseline file.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Fail if the results are worse than this baseline file.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='How much worse than the baseline a measurement may be, as a fraction (default: 0.25).')
+    parser.add_argument('--min-delta', type=float, default=0.02,
+                        help='Ignore times that are worse than the baseline by less than this many seconds (default: 0.02).')
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger('eac3bot')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.ERROR)
+
+    results = collect_results()
+    metrics = {}
+    for name in ['parse', 'demux', 'scaling']:
+        if name in args.only:
+            globals()['bench_' + name](args, metrics)
+
+    if args.save:
+        f = open(args.save, 'w')
+        json.dump({'version': BASELINE_VERSION,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.time(),
+                   'metrics': metrics,
+                   'results': results}, f, indent=1, sort_keys=True)
+        f.close()
+    if args.compare:
+        f = open(args.compare)
+        baseline = json.load(f)
+        f.close()
+        if compare(baseline, metrics, results, args.tolerance, args.min_delta):
+            return 1
+        print 'No regressions against %s' % args.compare
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Regression check for eac3bot's --stream, using the stand-in eac3to
+# and mkvmerge in bench/fake and the recorded scans in bench/scans.
+# Like the real tools, the stand-ins create or open all of their
+# outputs and inputs before reading or writing them side by side, so
+# a pipe neither end will ever get to shows up as a hang.
+#
+# Demuxes a playlist of the 'feature' recording with --stream and
+# --verify three times: as is, which must stream its main soundtrack;
+# with an mkvmerge that can't read DTS from a pipe; and with every
+# streamable track streamed at once, which can't work and must be
+# given up on once it stalls. The last two must extract the tracks to
+# files instead and still make a good mkv. Exits non-zero if any run
+# doesn't behave, or doesn't finish within CHECK_TIMEOUT seconds.
+#
+# Usage: stream_check.py
+#
+
+import sys
+import os
+import stat
+import logging
+import threading
+
+from demux_bench import Quiet, fake_env, run_demux
+import eac3bot
+
+TRACK_SIZE = 256 * 1024
+PLAYLIST = 1
+STALL_TIMEOUT = 2
+CHECK_TIMEOUT = 60
+
+def streaming_everything(settings, tracks):
+    return [track for track in tracks
+            if os.path.splitext(track['filename'])[1] in settings['stream_formats']]
+
+def check(case):
+    """Demux PLAYLIST with --stream and --verify as ``case`` says;
+    return a list of failures."""
+    mux_playlist = eac3bot.mux_playlist
+    streamed_tracks = eac3bot.streamed_tracks
+    stall_timeout = eac3bot.STREAM_STALL_TIMEOUT
+    env = fake_env('feature', size=TRACK_SIZE)
+    if case == 'unreadable format':
+        env['FAKE_MKVMERGE_SEEK'] = '.dts'
+    elif case == 'two pipes':
+        eac3bot.streamed_tracks = streaming_everything
+        eac3bot.STREAM_STALL_TIMEOUT = STALL_TIMEOUT
+    streamed = []
+    extracted = []
+    def checking_mux(settings, plan):
+        streamed.extend([track['filename'] for track in plan.get('streamed', [])])
+        rc = mux_playlist(settings, plan)
+        for filename in streamed:
+            path = os.path.join(plan['demux_dir'], filename)
+            if os.path.exists(path) and stat.S_ISREG(os.stat(path).st_mode):
+                extracted.append(filename)
+        return rc
+    eac3bot.mux_playlist = checking_mux
+    result = {}
+    try:
+        with Quiet(env):
+            thread = threading.Thread(target=lambda: result.update(
+                    rc=run_demux('feature', [PLAYLIST], stream=True, verify=True)))
+            thread.daemon = True
+            thread.start()
+            thread.join(CHECK_TIMEOUT)
+            if thread.is_alive():
+                return ['still running after %d seconds' % CHECK_TIMEOUT]
+    finally:
+        eac3bot.mux_playlist = mux_playlist
+        eac3bot.streamed_tracks = streamed_tracks
+        eac3bot.STREAM_STALL_TIMEOUT = stall_timeout
+
+    failures = []
+    if result.get('rc'):
+        failures.append('the demux failed (status %d)' % result['rc'])
+    if not streamed:
+        failures.append('nothing was streamed')
+    elif case == 'streamed' and extracted:
+        failures.append('%s was extracted to disk' % ' '.join(extracted))
+    elif case != 'streamed' and extracted != streamed:
+        failures.append('%s was not extracted to disk'
+                        % ' '.join([f for f in streamed if f not in extracted]))
+    return failures
+
+def main():
+    logger = logging.getLogger('eac3bot')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.CRITICAL)
+
+    status = 0
+    for case in ['streamed', 'unreadable format', 'two pipes']:
+        failures = check(case)
+        for failure in failures:
+            print '%s: %s' % (case, failure)
+            status = 1
+        if not failures:
+            print '%s: ok' % case
+        if failures and failures[0].startswith('still running'):
+            # The stand-ins are stuck on each other.
+            os._exit(status)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
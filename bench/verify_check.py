@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Regression check for eac3bot's --verify, using the stand-in eac3to
+# and mkvmerge in bench/fake and the recorded scans in bench/scans.
+#
+# Demuxes a playlist of the 'feature' recording with --verify and
+# --cleanup twice: once as is, which must verify and clean up its
+# tracks, and once with a byte of one track flipped between extraction
+# and muxing (same size, outside the parts the quick hash reads and
+# past the header hashed on its own), which must fail verification and
+# keep every track. Exits non-zero if either run doesn't behave.
+#
+# Usage: verify_check.py
+#
+
+import sys
+import os
+import logging
+
+from demux_bench import Quiet, fake_env, run_demux
+import eac3bot
+
+TRACK_SIZE = 4 * 1024 * 1024
+PLAYLIST = 1
+
+def corrupt(filename, offset):
+    """Flip the byte at ``offset`` of ``filename``, keeping its size."""
+    f = open(filename, 'r+b')
+    try:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(chr(ord(byte) ^ 0xff))
+    finally:
+        f.close()
+
+def check(corrupted):
+    """Demux PLAYLIST with --verify and --cleanup, corrupting one of its
+    tracks before the mux if ``corrupted``; return a list of failures."""
+    mux_playlist = eac3bot.mux_playlist
+    tracks = []
+    def corrupting_mux(settings, plan):
+        filenames = [os.path.join(plan['demux_dir'], track['filename'])
+                     for track in eac3bot.muxed_tracks(plan)]
+        tracks.extend(filenames)
+        if corrupted:
+            corrupt(filenames[0], TRACK_SIZE * 3 // 4)
+        return mux_playlist(settings, plan)
+    eac3bot.mux_playlist = corrupting_mux
+    try:
+        with Quiet(fake_env('feature', size=TRACK_SIZE)):
+            rc = run_demux('feature', [PLAYLIST], cleanup=True, verify=True)
+            kept = [filename for filename in tracks if os.path.exists(filename)]
+    finally:
+        eac3bot.mux_playlist = mux_playlist
+
+    failures = []
+    if not tracks:
+        failures.append('nothing was muxed')
+    elif corrupted:
+        if not rc:
+            failures.append('a corrupted track passed verification')
+        if kept != tracks:
+            failures.append('tracks were cleaned up after failing verification')
+    else:
+        if rc:
+            failures.append('an intact playlist failed verification (status %d)' % rc)
+        if kept:
+            failures.append('tracks were kept after passing verification')
+    return failures
+
+def main():
+    logger = logging.getLogger('eac3bot')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.CRITICAL)
+
+    status = 0
+    for corrupted in [False, True]:
+        name = corrupted and 'corrupted track' or 'intact tracks'
+        failures = check(corrupted)
+        for failure in failures:
+            print '%s: %s' % (name, failure)
+            status = 1
+        if not failures:
+            print '%s: ok' % name
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,7 +29,22 @@ import re
 import logging
 import os, os.path
 import contextlib
+import multiprocessing
+import threading
+import Queue
+import time
+import json
+import hashlib
+import shutil
+import tempfile
+import socket
+import uuid
 import ConfigParser
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; child CPU time isn't traced there.
+    resource = None
 
 logger = logging.getLogger('eac3bot')
 
@@ -42,90 +57,3837 @@ def find_track_matches(regex, track_list):
             return None
     return filter(lambda x: x, map(match, track_list))
 
-def filter_by(regexes, tracks):
-    selected_tracks = []
-    for r in regexes:
-        selected_tracks += filter(lambda t: re.search(r, t['description']),
-                                  tracks)
-    return selected_tracks
+#
+# Track classification.
+#
+# Each line of a playlist scan is parsed once into a Track, and
+# classified by the first rule in the rule table whose pattern matches
+# its description. Rules are (name, kind, pattern) triples; the kinds
+# are the ones the selection functions below ask for. More rules can be
+# added in the [track-rules] section of the config file, as
+#
+#   name = kind: pattern
+#
+TRACK_KINDS = ['chapters', 'video', 'lossless', 'lossy', 'subtitles']
+
+DEFAULT_TRACK_RULES = [
+    ('chapters', 'chapters', r'Chapters, .*'),
+    ('h264-1080p24', 'video', r'h264/AVC, 1080p24 /1.001 \(16:9\)$'),
+    ('h264-1080i50', 'video', r'h264/AVC, 1080i50 \(16:9\)$'),
+    ('vc1-1080p24', 'video', r'VC-1, 1080p24 /1.001 \(16:9\)$'),
+    ('mpeg2-1080p24', 'video', r'MPEG2, 1080p24 /1.001 \(16:9\)$'),
+    ('dts-ma', 'lossless', r'DTS Master Audio, .*'),
+    ('truehd', 'lossless', r'TrueHD/AC3, .*'),
+    ('pcm', 'lossless', r'RAW/PCM, .*'),
+    ('ac3', 'lossy', r'AC3, .*'),
+    ('ac3-surround', 'lossy', r'AC3 Surround, .*'),
+    ('dts', 'lossy', r'DTS, .*'),
+    ('pgs', 'subtitles', r'Subtitle \(PGS\), .*'),
+    ]
+
+_TRACK_LINE = re.compile(r'(?P<id>[0-9]+:) (?P<description>.*)')
+_LANGUAGE = re.compile(r'[A-Za-z][A-Za-z ()-]*$')
+_RESOLUTION = re.compile(r'[0-9]+[pi][0-9]*')
+_CHANNELS = re.compile(r'(?P<channels>[1-7]\.[0-2] channels)')
+
+class Track(object):
+    """A track from an eac3to playlist scan, parsed once."""
+    __slots__ = ['id', 'description', 'kind', 'codec', 'resolution',
+                 'language', 'channels', 'dialnorm', 'strange_setup']
+
+    def __init__(self, id, description, kind=None, codec=None):
+        self.id = id
+        self.description = description
+        self.kind = kind
+        self.codec = codec
+        fields = description.split(', ')
+        self.resolution = None
+        self.language = None
+        if len(fields) > 1:
+            m = _RESOLUTION.match(fields[1])
+            if m:
+                self.resolution = m.group(0)
+            elif _LANGUAGE.match(fields[1]) and \
+                    not fields[1].endswith('channels'):
+                self.language = fields[1]
+        m = _CHANNELS.search(description)
+        if m:
+            self.channels = m.group('channels')
+        else:
+            self.channels = None
+        self.dialnorm = 'dialnorm' in description
+        self.strange_setup = 'strange setup' in description
+
+    def as_dict(self):
+        """Return the track in the dict form used for extraction."""
+        return {'id': self.id, 'description': self.description}
+
+    def __repr__(self):
+        return '<Track %s %s>' % (self.id, self.description)
+
+class TrackTable(object):
+    """The classified tracks of a playlist, indexed by kind and language."""
+
+    def __init__(self, tracks, ranked=None):
+        # ``tracks`` is in scan order, ``ranked`` (if given) in the order
+        # selections should come out in.
+        self.tracks = tracks
+        self.by_kind = {}
+        self.by_kind_language = {}
+        for track in ranked or tracks:
+            if track.kind is None:
+                continue
+            self.by_kind.setdefault(track.kind, []).append(track)
+            self.by_kind_language.setdefault((track.kind, track.language),
+                                             []).append(track)
+        self.languages = set([language for (_, language) in self.by_kind_language])
+
+    def select(self, kind, languages=None, channels=None):
+        """Return the tracks of ``kind`` in rule order, then scan order.
+
+        If ``languages`` or ``channels`` are given, only tracks matching
+        at least one of those patterns are returned, ordered by the
+        first pattern they match; a track is never returned twice.
+        Patterns naming a known language exactly are looked up in the
+        index, anything else is searched for in the description.
+        """
+        selected = self.by_kind.get(kind, [])
+        if languages is not None:
+            selected = self._filter(kind, selected, languages, True)
+        if channels is not None:
+            selected = self._filter(kind, selected, channels, False)
+        return selected
+
+    def _filter(self, kind, tracks, patterns, indexed):
+        candidates = set([id(t) for t in tracks])
+        seen = set()
+        result = []
+        for pattern in patterns:
+            if indexed and pattern in self.languages:
+                matches = self.by_kind_language.get((kind, pattern), [])
+            else:
+                regex = _compiled(pattern)
+                matches = [t for t in tracks if regex.search(t.description)]
+            for track in matches:
+                if id(track) in candidates and id(track) not in seen:
+                    seen.add(id(track))
+                    result.append(track)
+        return result
+
+_regex_cache = {}
+def _compiled(pattern):
+    try:
+        return _regex_cache[pattern]
+    except KeyError:
+        regex = _regex_cache[pattern] = re.compile(pattern)
+        return regex
+
+class TrackClassifier(object):
+    """Classifies scan lines into Tracks using a precompiled rule table."""
+
+    def __init__(self, rules=DEFAULT_TRACK_RULES):
+        self.rules = []
+        for (name, kind, pattern) in rules:
+            if kind not in TRACK_KINDS:
+                raise ValueError("Track rule %s has unknown kind %s" % (name, kind))
+            self.rules.append((name, kind, re.compile(pattern)))
+        self.ranks = dict([(rule[0], i) for (i, rule) in enumerate(self.rules)])
+
+    def classify(self, lines):
+        """Parse and classify scan lines, returning a TrackTable."""
+        tracks = []
+        for line in lines:
+            m = _TRACK_LINE.match(line)
+            if not m:
+                continue
+            track = Track(m.group('id'), m.group('description'))
+            for (name, kind, regex) in self.rules:
+                if regex.match(track.description):
+                    track.kind = kind
+                    track.codec = name
+                    break
+            tracks.append(track)
+        # Selections come out in rule order first, then scan order.
+        ranks = self.ranks
+        return TrackTable(tracks,
+                          sorted(tracks, key=lambda t: ranks.get(t.codec, 0)))
+
+def track_rules(extra_rules=None):
+    """Return the default rule table with ``extra_rules`` merged in.
+
+    Extra rules replace a default rule of the same name, and are
+    otherwise appended.
+    """
+    rules = list(DEFAULT_TRACK_RULES)
+    for (name, kind, pattern) in extra_rules or []:
+        names = [rule[0] for rule in rules]
+        if name in names:
+            rules[names.index(name)] = (name, kind, pattern)
+        else:
+            rules.append((name, kind, pattern))
+    return rules
+
+_classifiers = {}
+def track_classifier(rules=DEFAULT_TRACK_RULES):
+    """Return a (cached) classifier for ``rules``."""
+    key = tuple(rules)
+    if key not in _classifiers:
+        _classifiers[key] = TrackClassifier(rules)
+    return _classifiers[key]
+
+def track_table(track_list):
+    if isinstance(track_list, TrackTable):
+        return track_list
+    return track_classifier().classify(track_list)
+
+def chapter_tracks(track_list):
+    return [t.as_dict() for t in track_table(track_list).select('chapters')]
+
+def video_tracks(track_list):
+    return [t.as_dict() for t in track_table(track_list).select('video')]
+
+def lossless_audio_tracks(track_list, languages=[r'English']):
+    return [t.as_dict() for t in
+            track_table(track_list).select('lossless', languages)]
+
+def lossy_audio_tracks(track_list, languages=[r'English'], channels=[r'[12]\.0']):
+    return [t.as_dict() for t in
+            track_table(track_list).select('lossy', languages, channels)]
+
+def subtitle_tracks(track_list, languages=['English']):
+    return [t.as_dict() for t in
+            track_table(track_list).select('subtitles', languages)]
+
+@contextlib.contextmanager
+def chdir(dirname=None):
+    curdir = os.getcwd()
+    try:
+        if dirname is not None:
+            os.chdir(dirname)
+        yield
+    finally:
+        os.chdir(curdir)
+
+#
+# Tool probes.
+#
+# Each run checks that eac3to, mkvmerge (and flac, with --flac-jobs)
+# can be executed, and notes their version and which of the options
+# eac3bot uses they support. With --stream, mkvmerge is also tried on
+# a tiny input fed through a named pipe, since some builds (Windows
+# ones under Wine, say) can't open one at all; whether it can read
+# each streamed format from a pipe is only found out when it tries
+# (see the Streaming mode comment below). Starting eac3to under Wine
+# takes seconds, so the results are kept in the cache directory, keyed
+# by each executable's resolved path, size and mtime. Tools that
+# aren't in the cache are probed while the disc is being scanned.
+#
+TOOL_CACHE_VERSION = 3
+
+# The arguments each tool is probed with, and the options to look for
+# in what it prints.
+TOOL_PROBES = {'eac3to': ([], ['-sonic', '-keepDialnorm']),
+               'mkvmerge': (['-V'], []),
+               'flac': (['--version'], [])}
+
+# A subtitle file for mkvmerge to read through a named pipe.
+FIFO_PROBE_INPUT = '1\r\n00:00:00,000 --> 00:00:01,000\r\nprobe\r\n\r\n'
+# How long the named pipe probe may take, in seconds.
+FIFO_PROBE_TIMEOUT = 30
+
+_TOOL_VERSION = re.compile(r'\bv?(?P<version>[0-9]+(?:\.[0-9]+)+)')
+_tool_cache_lock = threading.Lock()
+_tool_probes = {}
+
+def find_executable(binexec):
+    """Return the absolute path of ``binexec``, looking it up in PATH if
+    it has no directory part, or None if it can't be found."""
+    if os.path.dirname(binexec):
+        candidates = [binexec]
+    else:
+        candidates = [os.path.join(d, binexec)
+                      for d in os.environ.get('PATH', '').split(os.pathsep) if d]
+    extensions = ['']
+    if sys.platform == 'win32':
+        extensions += os.environ.get('PATHEXT', '.EXE').lower().split(os.pathsep)
+    for candidate in candidates:
+        for ext in extensions:
+            if os.path.isfile(candidate + ext):
+                return os.path.abspath(candidate + ext)
+    return None
+
+def probe_tool(tool, binexec, fifo=False):
+    """Run ``binexec`` the way TOOL_PROBES says for ``tool``.
+
+    Returns a dict holding its resolved 'path', 'version' (None if it
+    doesn't print one) and the supported 'flags', or None if it can't
+    be executed. With ``fifo``, mkvmerge's probe also says whether it
+    can read from a named pipe, as 'fifo'.
+    """
+    args, flags = TOOL_PROBES[tool]
+    try:
+        output = subprocess.check_output([binexec] + args,
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    m = _TOOL_VERSION.search(output)
+    probe = {'path': find_executable(binexec) or binexec,
+             'version': m and m.group('version'),
+             'flags': [flag for flag in flags
+                       if re.search(r'(^|\s)%s\b' % re.escape(flag), output)]}
+    if tool == 'mkvmerge' and fifo:
+        probe['fifo'] = probe_fifo_input(binexec)
+    return probe
+
+def probe_fifo_input(mkvmerge):
+    """Whether ``mkvmerge`` can mux an input it reads from a named pipe."""
+    if not hasattr(os, 'mkfifo'):
+        return False
+    probe_dir = tempfile.mkdtemp(prefix='eac3bot-probe-')
+    fifo = os.path.join(probe_dir, 'probe.srt')
+    outfile = os.path.join(probe_dir, 'probe.mkv')
+    def feed():
+        try:
+            f = open(fifo, 'wb')
+            try:
+                f.write(FIFO_PROBE_INPUT)
+            finally:
+                f.close()
+        except IOError:
+            # mkvmerge gave up reading.
+            pass
+    try:
+        os.mkfifo(fifo)
+        thread = threading.Thread(target=feed, name='probe mkvmerge fifo')
+        thread.daemon = True
+        thread.start()
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = subprocess.Popen([mkvmerge, '-o', outfile, fifo],
+                                    stdout=devnull, stderr=subprocess.STDOUT)
+        finally:
+            devnull.close()
+        started = time.time()
+        while proc.poll() is None and time.time() - started < FIFO_PROBE_TIMEOUT:
+            time.sleep(0.01)
+        if proc.poll() is None:
+            proc.kill()
+        rc = proc.wait()
+        _release_fifos([fifo])
+        thread.join(1)
+        # Status 1 means mkvmerge only had warnings.
+        return rc in [0, 1] and os.path.isfile(outfile) and os.path.getsize(outfile) > 0
+    except OSError:
+        return False
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+def _tool_key(tool, binexec):
+    path = find_executable(binexec)
+    if path is None:
+        return None
+    st = os.stat(path)
+    return '%s %s %d %d' % (tool, path, st.st_size, int(st.st_mtime))
+
+def _load_tool_cache(filename):
+    try:
+        f = open(filename)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+    if data.get('version') != TOOL_CACHE_VERSION:
+        return {}
+    return data['tools']
+
+def _store_tool_cache(filename, probes):
+    # Several jobs in a batch may be updating the file.
+    _tool_cache_lock.acquire()
+    try:
+        tools = _load_tool_cache(filename)
+        tools.update(probes)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            write_atomic(filename, json.dumps({'version': TOOL_CACHE_VERSION, 'tools': tools},
+                                              indent=1, sort_keys=True))
+        except (IOError, OSError), e:
+            logger.warning("Can't save tool probes to cache: %s" % e)
+    finally:
+        _tool_cache_lock.release()
+
+def start_tool_probes(settings, tools, cache_dir=None):
+    """Probe ``tools``, a list of (tool, executable) pairs, in the
+    background (see the Tool probes comment above).
+
+    Probes are looked up in ``cache_dir`` first, if it's given. With
+    settings['stream'], mkvmerge's named pipe input is probed too.
+    Returns a function that waits for the probes to finish and returns
+    a dict mapping each tool to its probe (None if it can't be
+    executed).
+    """
+    fifo = settings.get('stream')
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'tools.json')
+        cached = _load_tool_cache(cache_file)
+    else:
+        cache_file = None
+        cached = {}
+    probes = {}
+    found = {}
+    threads = []
+    def run(tool, binexec, key):
+        with traced(settings, 'probe %s' % tool) as span:
+            probes[tool] = probe_tool(tool, binexec, fifo)
+            span['status'] = int(probes[tool] is None)
+        if key is not None and probes[tool] is not None:
+            found[key] = probes[tool]
+    for tool, binexec in tools:
+        try:
+            key = _tool_key(tool, binexec)
+        except OSError:
+            key = None
+        if cache_file and key is not None:
+            probe = _tool_probes.get(key) or cached.get(key)
+            if probe is not None and fifo and tool == 'mkvmerge' and 'fifo' not in probe:
+                # Probed by a run without --stream.
+                probe = None
+            if probe is not None:
+                logger.debug("Using cached probe of %s" % probe['path'])
+                probes[tool] = probe
+                _tool_probes[key] = probe
+                continue
+        thread = threading.Thread(target=run, args=(tool, binexec, key),
+                                  name='probe %s' % tool)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    def wait():
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        if cache_file and found:
+            _tool_probes.update(found)
+            _store_tool_cache(cache_file, found)
+        return probes
+    return wait
+
+def check_tools(probes):
+    """Log any tool that can't be executed; return True if all can."""
+    ok = True
+    for tool in sorted(probes):
+        if probes[tool] is None:
+            logger.error("Can't execute %s; use --%s to specify the path." % (tool, tool))
+            ok = False
+        else:
+            logger.debug("%s: %s, version %s" % (tool, probes[tool]['path'],
+                                                 probes[tool]['version']))
+    return ok
+
+def tool_supports(settings, tool, flag):
+    """Whether the probed ``tool`` supports ``flag`` (True if it
+    hasn't been probed)."""
+    probe = settings.get('tools', {}).get(tool)
+    return probe is None or flag in probe['flags']
+
+#
+# Running eac3to and mkvmerge.
+#
+# Tool output is read from a pipe as it's produced, rather than
+# buffered until the tool exits. Progress updates are turned into
+# events, which are passed to every callable in progress_listeners
+# (and written as JSON lines with --progress-json). If the output
+# shows that the run has failed, the tool is killed straight away.
+#
+
+# Output that means a run has failed, by tool.
+FATAL_PATTERNS = {
+    'eac3to': [r'^ERROR:',
+               r'^Aborted at file position',
+               r'format of the source file could not be detected',
+               r'not enough space on the disk'],
+    'mkvmerge': [r'^Error:'],
+    }
+
+# eac3to prints 'analyze: 12%', 'process: 45%' and so on, mkvmerge
+# prints 'Progress: 45%'.
+_PROGRESS = re.compile(r'(?P<phase>[A-Za-z][A-Za-z ]*): *(?P<percent>[0-9]{1,3})%$')
+_SEPARATORS = re.compile(r'[\r\n\x08]+')
+
+progress_listeners = []
+
+def add_progress_listener(listener):
+    """Call ``listener(event)`` for every tool progress event.
+
+    Events are dicts with a 'type' of 'start', 'progress', 'abort' or
+    'exit', plus 'tool', 'label', 'time' and type-specific fields:
+    'progress' events carry 'phase', 'percent', 'elapsed', 'eta' (in
+    seconds, or None) and, when the run's output files are known,
+    'bytes' and 'rate' (bytes per second).
+    """
+    progress_listeners.append(listener)
+
+class JsonLinesProgress(object):
+    """A progress listener that appends events to a JSON lines file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event) + '\n'
+        self.lock.acquire()
+        try:
+            f = open(self.filename, 'a')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+
+def _output_bytes(outputs):
+    total = 0
+    for filename in outputs:
+        try:
+            total += os.path.getsize(filename)
+        except OSError:
+            pass
+    return total
+
+def format_size(nbytes):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if abs(nbytes) < 1024.0 or unit == 'GB':
+            break
+        nbytes /= 1024.0
+    if unit == 'bytes':
+        return '%d bytes' % nbytes
+    return '%.1f %s' % (nbytes, unit)
+
+def write_atomic(filename, contents):
+    """Replace ``filename`` with ``contents``, so that readers (in other
+    threads, processes or hosts) see either the old file or the new one,
+    never a half-written one or none at all. Raises IOError or OSError.
+    """
+    tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+    try:
+        f = open(tmpname, 'wb')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(filename):
+            # Windows won't rename over an existing file.
+            os.remove(filename)
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def run_tool(command, cwd=None, tool=None, label=None, echo=True,
+             outputs=None, on_event=None, processes=None):
+    """Run ``command``, following its output while it runs.
+
+    ``tool`` selects the fatal output patterns (default: the basename
+    of the executable); ``label`` says what the run is for, in events
+    and log messages. Output is copied to stdout if ``echo`` is set.
+    ``outputs`` are the files the run writes, used to measure its
+    throughput. Events go to ``on_event`` and the progress listeners.
+    The child's Popen object is appended to ``processes``, if given, so
+    another thread can kill it.
+
+    Returns (returncode, output). If the tool was killed because of
+    fatal output, the return code is 1 (unless it had already exited
+    with an error status of its own).
+    """
+    if tool is None:
+        tool = os.path.splitext(os.path.basename(command[0]))[0].lower()
+    if label is None:
+        label = tool
+    fatal = [re.compile(p) for p in FATAL_PATTERNS.get(tool, [])]
+    listeners = list(progress_listeners)
+    if on_event is not None:
+        listeners.append(on_event)
+
+    def emit(event_type, **fields):
+        fields.update({'type': event_type, 'tool': tool, 'label': label,
+                       'time': time.time()})
+        for listener in listeners:
+            try:
+                listener(fields)
+            except Exception:
+                logger.exception("Progress listener failed")
+
+    started = time.time()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    if processes is not None:
+        processes.append(proc)
+    emit('start', command=command)
+    chunks = []
+    pending = ''
+    last_percent = None
+    last_phase = None
+    last_bytes_check = 0
+    nbytes = None
+    aborted = None
+    fd = proc.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if echo:
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        # Only complete segments are parsed, so a half-written
+        # 'process: 4' isn't mistaken for 4%.
+        segments = _SEPARATORS.split(pending + chunk)
+        pending = segments.pop()
+        for segment in segments:
+            segment = segment.strip()
+            if not segment:
+                continue
+            for regex in fatal:
+                if regex.search(segment):
+                    aborted = segment
+                    break
+            if aborted:
+                break
+            m = _PROGRESS.search(segment)
+            if not m:
+                continue
+            phase = m.group('phase').strip()
+            percent = int(m.group('percent'))
+            if (phase, percent) == (last_phase, last_percent):
+                continue
+            if phase != last_phase:
+                # A new pass over the input (e.g. eac3to's 'analyze'
+                # followed by 'process'); time it separately.
+                phase_started = time.time()
+            last_phase, last_percent = phase, percent
+            now = time.time()
+            elapsed = now - phase_started
+            if percent > 0:
+                eta = elapsed * (100 - percent) / percent
+            else:
+                eta = None
+            fields = {'phase': phase, 'percent': percent,
+                      'elapsed': now - started, 'eta': eta}
+            if outputs:
+                # Don't stat the output files more than once a second.
+                if now - last_bytes_check >= 1 or percent == 100:
+                    nbytes = _output_bytes(outputs)
+                    last_bytes_check = now
+                fields['bytes'] = nbytes
+                fields['rate'] = nbytes / max(now - started, 0.001)
+            emit('progress', **fields)
+        if aborted:
+            break
+    if aborted:
+        logger.error("\n%s: fatal output '%s', stopping it." % (label, aborted))
+        emit('abort', reason=aborted)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+    proc.stdout.close()
+    rc = proc.wait()
+    if aborted and rc <= 0:
+        # Killed by us rather than failing on its own.
+        rc = 1
+    elapsed = time.time() - started
+    fields = {'returncode': rc, 'elapsed': elapsed}
+    if outputs:
+        nbytes = _output_bytes(outputs)
+        fields['bytes'] = nbytes
+        fields['rate'] = nbytes / max(elapsed, 0.001)
+        if not rc:
+            logger.info("%s: wrote %s in %s (%s/s)" \
+                            % (label, format_size(nbytes), format_duration(elapsed),
+                               format_size(fields['rate'])))
+    emit('exit', **fields)
+    return rc, ''.join(chunks)
+
+def progress_callback(settings, playlist):
+    """Return an event callback for runs belonging to ``playlist``."""
+    if settings.get('progress_json'):
+        writer = JsonLinesProgress(settings['progress_json'])
+    else:
+        writer = None
+    def callback(event):
+        event['playlist'] = playlist
+        if writer is not None:
+            writer(event)
+    return callback
+
+#
+# Tracing.
+#
+# With --trace, each phase of a run (the tool probes, the disc scan,
+# and each playlist's scan, extraction, mux and cleanup) is recorded
+# as a span: its wall time, the CPU time used by the child processes
+# that finished during it, and the size of every file it wrote. Spans
+# are passed to every callable in trace_hooks, and written to the
+# trace file, either as JSON lines or, if the filename ends in '.json',
+# as Chrome trace events (for chrome://tracing or Perfetto).
+#
+
+trace_hooks = []
+
+def add_trace_hook(hook):
+    """Call ``hook(span)`` whenever a traced phase of a run finishes.
+
+    Spans are dicts holding the 'phase', 'playlist' (None for the
+    probes and the disc scan), the disc 'name' and 'drive', 'start'
+    (a timestamp), 'wall' and 'child_cpu' (seconds; 'child_cpu' is None
+    where it can't be measured), the 'files' written (filename to size
+    in bytes), their total 'bytes' and 'rate' (bytes per second), the
+    'status' of the phase, and 'pid' and 'thread'. Phases run in worker
+    processes (--jobs) are passed to the hooks in the main process.
+    """
+    trace_hooks.append(hook)
+
+_trace_lock = threading.Lock()
+_trace_threads = set()
+
+def write_trace(filename, span):
+    """Append a span to a trace file (see the Tracing comment above)."""
+    if filename.endswith('.json'):
+        # The JSON array format; the closing bracket is optional, so
+        # events can be appended as they happen.
+        events = []
+        if (span['pid'], span['tid']) not in _trace_threads:
+            _trace_threads.add((span['pid'], span['tid']))
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': span['pid'], 'tid': span['tid'],
+                           'args': {'name': span['thread']}})
+        if span['playlist'] is None:
+            label = span['phase']
+        else:
+            label = 'playlist %d) %s' % (span['playlist'], span['phase'])
+        events.append({'name': label, 'cat': span['phase'], 'ph': 'X',
+                       'ts': int(span['start'] * 1000000),
+                       'dur': int(span['wall'] * 1000000),
+                       'pid': span['pid'], 'tid': span['tid'],
+                       'args': span})
+        text = ''.join([json.dumps(event) + ',\n' for event in events])
+    else:
+        text = json.dumps(span) + '\n'
+    _trace_lock.acquire()
+    try:
+        f = open(filename, 'a')
+        try:
+            if f.tell() == 0 and filename.endswith('.json'):
+                f.write('[\n')
+            f.write(text)
+        finally:
+            f.close()
+    finally:
+        _trace_lock.release()
+
+def emit_span(settings, span):
+    """Hand a finished span to the trace hooks and the trace file."""
+    if settings.get('trace_spans') is not None:
+        # In a worker process: the main process emits it.
+        settings['trace_spans'].append(span)
+        return
+    for hook in trace_hooks:
+        try:
+            hook(span)
+        except Exception:
+            logger.exception("Trace hook failed")
+    if settings.get('trace'):
+        write_trace(settings['trace'], span)
+    if settings.get('history') and span['phase'] in COST_PHASES and span['status'] == 0:
+        record_history(settings['history'], span)
+
+def _child_cpu_time():
+    # This covers every child of the process that has been waited for,
+    # so phases running at the same time in other threads are counted
+    # too.
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+@contextlib.contextmanager
+def traced(settings, phase, playlist=None, outputs=None):
+    """Trace the enclosed block as a run phase.
+
+    ``outputs`` are the files the phase writes. The span is yielded,
+    so the block can set its 'status' and add fields of its own.
+    """
+    if not trace_hooks and not settings.get('trace') and not settings.get('history') \
+            and settings.get('trace_spans') is None:
+        yield {}
+        return
+    thread = threading.current_thread()
+    span = {'phase': phase, 'playlist': playlist,
+            'name': settings.get('name'), 'drive': settings.get('drive'),
+            'pid': os.getpid(), 'tid': thread.ident, 'thread': thread.name,
+            'status': 0}
+    cpu = _child_cpu_time()
+    started = time.time()
+    try:
+        yield span
+    except:
+        span['status'] = 'error'
+        raise
+    finally:
+        span['start'] = started
+        span['wall'] = time.time() - started
+        if cpu is not None:
+            span['child_cpu'] = _child_cpu_time() - cpu
+        else:
+            span['child_cpu'] = None
+        span['files'] = {}
+        for filename in outputs or []:
+            if os.path.isfile(filename):
+                span['files'][os.path.basename(filename)] = os.path.getsize(filename)
+        span['bytes'] = sum(span['files'].values())
+        span['rate'] = span['bytes'] / max(span['wall'], 0.001)
+        emit_span(settings, span)
+
+def duration_seconds(duration):
+    """Convert an eac3to 'H:MM:SS' duration to seconds."""
+    hours, minutes, seconds = [int(x) for x in duration.split(':')]
+    return hours * 3600 + minutes * 60 + seconds
+
+def source_path(path):
+    """Return ``path`` in a form that works from any working directory.
+
+    eac3to runs inside the demux directory, so a relative path to a
+    Blu-ray folder has to be made absolute. Bare drive letters ('D:')
+    are left alone.
+    """
+    if os.path.splitdrive(path)[1] and os.path.isdir(path):
+        return os.path.abspath(path)
+    return path
+
+#
+# Scan cache.
+#
+# Scanning a physical disc takes eac3to tens of seconds per scan, so
+# the output of the disc scan and of each playlist scan is kept on
+# disk, keyed by a fingerprint of the disc's BDMV structure. Each disc
+# gets its own entry directory holding one JSON file per scan.
+#
+SCAN_CACHE_VERSION = 1
+
+def scan_lines(output):
+    """Split eac3to output into lines, without progress backspaces."""
+    return [line.strip('\x08').rstrip(' ') for line in \
+                output.split('\r\n')]
+
+def parse_playlists(lines):
+    """Parse an eac3to disc scan into a list of (id, duration) pairs."""
+    playlists = []
+    for line in lines:
+        m = re.match(r'(?P<id>[0-9]+)\) .*, (?P<duration>[0-9]:[0-9][0-9]:[0-9][0-9])$', line)
+        if m:
+            playlists.append((int(m.group('id')), m.group('duration')))
+    return playlists
+
+def bdmv_dir(path):
+    """Return the BDMV directory of a Blu-ray structure, or None."""
+    if path.endswith(':'):
+        # A bare drive letter; 'D:BDMV' would be relative to D:'s cwd.
+        path += os.sep
+    for candidate in [os.path.join(path, 'BDMV'), path]:
+        if os.path.isdir(os.path.join(candidate, 'PLAYLIST')):
+            return candidate
+    return None
+
+def disc_fingerprint(path, eac3to):
+    """Fingerprint a Blu-ray structure for the scan cache.
+
+    The playlists are small, so they're hashed in full; clip info
+    files are identified by name, size and mtime. The eac3to
+    executable is part of the key too, since a different version may
+    print a different scan. Returns None if ``path`` isn't a Blu-ray
+    structure we can look into (in which case nothing is cached).
+    """
+    bdmv = bdmv_dir(path)
+    if bdmv is None:
+        return None
+    digest = hashlib.sha1()
+    digest.update('eac3bot scan cache %d\0' % SCAN_CACHE_VERSION)
+    try:
+        st = os.stat(eac3to)
+        digest.update('%s %d %d\0' % (os.path.basename(eac3to), st.st_size, int(st.st_mtime)))
+    except OSError:
+        digest.update('%s\0' % eac3to)
+    try:
+        playlist_dir = os.path.join(bdmv, 'PLAYLIST')
+        for fn in sorted(os.listdir(playlist_dir)):
+            if fn.lower().endswith('.mpls'):
+                digest.update('%s\0' % fn)
+                f = open(os.path.join(playlist_dir, fn), 'rb')
+                try:
+                    digest.update(f.read())
+                finally:
+                    f.close()
+        clipinf_dir = os.path.join(bdmv, 'CLIPINF')
+        if os.path.isdir(clipinf_dir):
+            for fn in sorted(os.listdir(clipinf_dir)):
+                st = os.stat(os.path.join(clipinf_dir, fn))
+                digest.update('%s %d %d\0' % (fn, st.st_size, int(st.st_mtime)))
+    except (IOError, OSError), e:
+        logger.debug("Can't fingerprint %s: %s" % (path, e))
+        return None
+    return digest.hexdigest()
+
+def _cache_entry_size(entry):
+    return sum([os.path.getsize(os.path.join(entry, fn))
+                for fn in os.listdir(entry)])
+
+def prune_scan_cache(cache_dir, max_size, max_age):
+    """Evict cache entries older than ``max_age`` seconds, then the least
+    recently used ones until the cache is no bigger than ``max_size``
+    bytes."""
+    now = time.time()
+    entries = []
+    for fn in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, fn)
+        if os.path.isdir(entry):
+            entries.append((os.path.getmtime(entry), _cache_entry_size(entry), entry))
+    entries.sort()
+    total = sum([size for (_, size, _) in entries])
+    for (mtime, size, entry) in entries:
+        if now - mtime > max_age or total > max_size:
+            logger.debug("Evicting scan cache entry %s" % entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def open_scan_cache(cache_dir, path, eac3to, refresh=False,
+                    max_size=64 * 1024 * 1024, max_age=90 * 24 * 3600):
+    """Return the scan cache for the disc at ``path``, or None.
+
+    The cache is a dict holding the disc's entry directory and whether
+    existing entries should be ignored (and overwritten).
+    """
+    if not cache_dir:
+        return None
+    fingerprint = disc_fingerprint(path, eac3to)
+    if fingerprint is None:
+        logger.info("Not caching scans: can't find a BDMV structure in %s" % path)
+        return None
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        prune_scan_cache(cache_dir, max_size, max_age)
+        entry = os.path.join(cache_dir, fingerprint)
+        if not os.path.isdir(entry):
+            os.mkdir(entry)
+        # The entry's mtime records when it was last used.
+        os.utime(entry, None)
+    except OSError, e:
+        logger.warning("Can't use scan cache %s: %s" % (cache_dir, e))
+        return None
+    return {'dir': entry, 'refresh': refresh}
+
+def _scan_cache_file(cache, playlist):
+    if playlist is None:
+        return os.path.join(cache['dir'], 'disc.json')
+    return os.path.join(cache['dir'], 'playlist_%02d.json' % playlist)
+
+def load_cached_scan(cache, playlist=None):
+    if cache is None or cache['refresh']:
+        return None
+    try:
+        f = open(_scan_cache_file(cache, playlist))
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if data.get('version') != SCAN_CACHE_VERSION:
+        return None
+    return _latin1(data)
+
+def _latin1(obj):
+    # eac3to's output is stored as latin-1 (any byte string survives the
+    # round trip), so turn what json gives back into byte strings again.
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    elif isinstance(obj, list):
+        return [_latin1(x) for x in obj]
+    elif isinstance(obj, dict):
+        return dict([(_latin1(k), _latin1(v)) for (k, v) in obj.items()])
+    return obj
+
+def store_cached_scan(cache, playlist, data):
+    if cache is None:
+        return
+    data = dict(data, version=SCAN_CACHE_VERSION)
+    filename = _scan_cache_file(cache, playlist)
+    # Concurrent jobs never read a half-written entry.
+    try:
+        write_atomic(filename, json.dumps(data, encoding='latin-1'))
+    except (IOError, OSError), e:
+        logger.warning("Can't save scan to cache: %s" % e)
+
+def eac3to_scan(eac3to, path, playlist=None, cache=None, on_event=None):
+    """Scan the disc (or one of its playlists) with eac3to.
+
+    Returns a dict holding the raw 'output', its 'lines' and the
+    parsed table: 'playlists' for a disc scan, 'tracks' for a playlist
+    scan. Scans come from ``cache`` when possible. Raises
+    CalledProcessError (or OSError) if eac3to fails.
+    """
+    data = load_cached_scan(cache, playlist)
+    if data is not None:
+        if playlist is None:
+            logger.info('Using cached scan of %s' % path)
+        else:
+            logger.info('Using cached scan of playlist %d)' % playlist)
+        return data
+    command = [eac3to, path]
+    if playlist is not None:
+        command.append('%d)' % playlist)
+    if playlist is None:
+        label = 'disc scan'
+    else:
+        label = 'playlist %d) scan' % playlist
+    rc, output = run_tool(command, tool='eac3to', label=label, echo=False,
+                          on_event=on_event)
+    if rc:
+        raise subprocess.CalledProcessError(rc, command, output)
+    lines = scan_lines(output)
+    data = {'output': output, 'lines': lines}
+    if playlist is None:
+        data['playlists'] = parse_playlists(lines)
+    else:
+        data['tracks'] = find_track_matches(r'(?P<id>[0-9]+:) (?P<description>.*)', lines)
+    store_cached_scan(cache, playlist, data)
+    return data
+
+#
+# Rip profiles.
+#
+# A profile says what becomes of each lossless soundtrack: a FLAC
+# encode ('flac'), the DTS-MA or TrueHD stream as it is on the disc
+# ('original'), or both. RAW/PCM tracks have no original stream worth
+# keeping, so they always become FLAC. 'archive' keeps both, 'fast'
+# skips FLAC encoding (the CPU-heavy part of an extraction) and writes
+# each soundtrack once, and 'compact' keeps only the FLAC. A profile is
+# chosen with --profile, or 'profile' in the config or a batch job.
+# Profiles can be changed or added in [profile NAME] sections of the
+# config file:
+#
+#   [profile music]
+#   audio = flac original
+#
+PROFILES = {'archive': {'audio': ['flac', 'original']},
+            'fast': {'audio': ['original']},
+            'compact': {'audio': ['flac']}}
+DEFAULT_PROFILE = 'archive'
+PROFILE_OUTPUTS = ['flac', 'original']
+# eac3to decodes a lossless track and encodes it as FLAC about this
+# many times faster than it plays, on one core.
+FLAC_REALTIME = 40
+
+def soundtrack_outputs(profile, description):
+    """Return what ``profile`` makes of a lossless soundtrack: 'flac',
+    'original' or both, in that order."""
+    if re.match(r'RAW/PCM', description):
+        return ['flac']
+    return [output for output in PROFILE_OUTPUTS if output in profile['audio']]
+
+def read_profiles(config):
+    """Return the built-in profiles, updated from the [profile NAME]
+    sections of ``config``. Raises ValueError for a bad profile."""
+    profiles = dict(PROFILES)
+    for section in config.sections():
+        if not section.startswith('profile '):
+            continue
+        name = section[len('profile '):].strip()
+        if not config.has_option(section, 'audio'):
+            raise ValueError("Profile %s has no audio setting" % name)
+        audio = config.get(section, 'audio', raw=True).split()
+        if not audio or [output for output in audio if output not in PROFILE_OUTPUTS]:
+            raise ValueError("Profile %s: audio must be %s, or both" \
+                                 % (name, ' or '.join(PROFILE_OUTPUTS)))
+        profiles[name] = {'audio': audio}
+    return profiles
+
+def profile_costs(settings, plans):
+    """Estimate what each profile would cost for ``plans``: a list of
+    (name, bytes of tracks, CPU seconds of FLAC encoding)."""
+    costs = []
+    for name in sorted(settings['profiles']):
+        profile = settings['profiles'][name]
+        nbytes = cpu = 0
+        for plan in plans:
+            seconds = duration_seconds(plan['duration'])
+            for group in TRACK_GROUPS:
+                if group == 'soundtracks':
+                    continue
+                for track in plan[group]:
+                    nbytes += estimate_track_bytes(GROUP_KINDS[group], track['description'],
+                                                   seconds)
+            for track in plan['lossless']:
+                for output in soundtrack_outputs(profile, track['description']):
+                    nbytes += estimate_track_bytes('lossless', track['description'], seconds)
+                    if output == 'flac':
+                        cpu += seconds / float(FLAC_REALTIME)
+        costs.append((name, nbytes, cpu))
+    return costs
+
+def log_profile_costs(settings, plans):
+    logger.info("Profiles (tracks, FLAC encoding CPU time):")
+    for name, nbytes, cpu in profile_costs(settings, plans):
+        if name == settings['profile']['name']:
+            mark = '*'
+        else:
+            mark = ' '
+        logger.info(" %s %-12s %10s %10s  %s" % (mark, name, format_size(nbytes),
+                                                 format_duration(cpu),
+                                                 ' + '.join(settings['profiles'][name]['audio'])))
+
+# The groups of tracks in a playlist plan, in the order in which they
+# are handed to eac3to and mkvmerge.
+TRACK_GROUPS = ['chapters', 'videos', 'soundtracks', 'commentaries', 'subtitles']
+
+def idnum(track):
+    return int(track['id'].rstrip(':'))
+
+def add_option(track, option):
+    if 'eac3to args' in track:
+        track['eac3to args'] += [option]
+    else:
+        track['eac3to args'] = [option]
+
+def log_tracks(track_type, tracks):
+    logger.info("  %s:" % track_type)
+    if not tracks:
+        logger.info("    none")
+    else:
+        for track in tracks:
+            logger.info("    %s %s" % (track['id'], track['description']))
+    return
+
+def playlist_dir(settings, playlist):
+    """Return the demux directory of a playlist, on the scratch volume."""
+    dirname = "%s.playlist_%02d" % (settings['name'], playlist)
+    if settings.get('sample'):
+        dirname += '.sample'
+    return os.path.join(settings['work_dir'], dirname)
+
+def scan_playlist(settings, current_playlist):
+    """Scan a playlist with eac3to; return the scan, or None if it fails."""
+    logger.info("Scanning playlist %d)" % current_playlist)
+    try:
+        with traced(settings, 'scan', current_playlist):
+            with holding(settings, 'drive'):
+                return eac3to_scan(settings['eac3to'], settings['path'], current_playlist,
+                                   settings['scan_cache'],
+                                   progress_callback(settings, current_playlist))
+    except:
+        return None
+
+def plan_playlist(settings, current_playlist, pl_scan, problems=None):
+    """Work out what to extract from a scanned playlist.
+
+    Returns a plan dict holding the selected tracks, the demux
+    directory and the eac3to command line, or None if the playlist
+    can't be demuxed. The reasons why not are appended to ``problems``;
+    the checks carry on past the first one, so they all come out at
+    once.
+    """
+    eac3to = settings['eac3to']
+    soundtrack_languages = settings['soundtrack_languages']
+    current_default_audio_track = settings['default_audio_track']
+    if problems is None:
+        problems = []
+    errors = []
+
+    demux_dir = playlist_dir(settings, current_playlist)
+
+    #
+    # Select tracks to extract.
+    #
+    tracks = track_classifier(settings['track_rules']).classify(pl_scan['lines'])
+    chapters = chapter_tracks(tracks)
+    videos = video_tracks(tracks)
+    lossless = lossless_audio_tracks(tracks, soundtrack_languages)
+    commentaries = lossy_audio_tracks(tracks)
+    subtitles = subtitle_tracks(tracks)
+
+    # Sanity checks for required tracks.
+    if not chapters:
+        errors.append("No chapter tracks found.")
+    if len(chapters) > 1:
+        errors.append("There's more than one chapter track.")
+    if not videos:
+        errors.append("No feature video tracks found.")
+    if len(videos) > 1:
+        errors.append("There's more than one feature video track.")
+    if not lossless:
+        errors.append("No lossless soundtracks selected.")
+
+    # Lossless tracks are converted to FLAC, kept as they are, or both,
+    # as the profile says.
+    soundtracks = []
+    FLACTAG = '(FLAC)'
+    for track in lossless:
+        outputs = soundtrack_outputs(settings['profile'], track['description'])
+        if 'flac' in outputs:
+            soundtracks.append({'id' : track['id'],
+                                'description' : ' '.join([FLACTAG, track['description']])})
+        if 'original' in outputs:
+            soundtracks.append(track)
+
+    logger.info("Demuxing the following tracks:")
+    log_tracks("Chapters", chapters)
+    log_tracks("Video", videos)
+    log_tracks("Soundtracks", soundtracks)
+    log_tracks("Commentaries", commentaries)
+    log_tracks("Subtitles", subtitles)
+    logger.info('')
+
+    #
+    # Map tracks to filenames for extraction.
+    #
+    for track in chapters:
+        track['filename'] = '%02dchapters.txt' % idnum(track)
+    for track in videos:
+        track['filename'] = '%02dvideo.mkv' % idnum(track)
+    for track in soundtracks:
+        # XXX handle these more gracefully.
+        if re.search(r'strange setup', track['description']):
+            errors.append("Track %s is a 'strange setup'." % track['id'])
+            continue
+
+        if re.match(r'\(FLAC\)', track['description']):
+            track['filename'] = '%02daudio.flac' % idnum(track)
+            track['format'] = 'FLAC'
+            if re.search(r'DTS Master Audio', track['description']) and re.search(r'6.1 channels', track['description']):
+                if tool_supports(settings, 'eac3to', '-sonic'):
+                    logger.warning("Track %s is a DTS-MA 6.1 track, using Sonic decoder for it." % track['id'])
+                    add_option(track, '-sonic')
+                else:
+                    logger.warning("Track %s is a DTS-MA 6.1 track, but this eac3to has no Sonic decoder." % track['id'])
+        elif re.match(r'DTS Master Audio', track['description']):
+            track['filename'] = '%02daudio.dts' % idnum(track)
+            track['format'] = 'DTS-MA'
+        elif re.match(r'TrueHD', track['description']):
+            track['filename'] = '%02daudio.thd' % idnum(track)
+            track['format'] = 'TrueHD'
+        else:
+            # XXX handle these more gracefully
+            errors.append("Audio track %s has an unknown type: %s" % (track['id'], track['description']))
+            continue
+        track['channels'] = re.search(r'(?P<channels>[1-7]\.[0-2] channels)', track['description']).group('channels')
+    for track in commentaries:
+        if re.match(r'AC3', track['description']):
+            track['filename'] = '%02dcommentary.ac3' % idnum(track)
+            track['format'] = 'AC3'
+        elif re.match(r'DTS', track['description']):
+            track['filename'] = '%02dcommentary.dts' % idnum(track)
+            track['format'] = 'DTS'
+        else:
+            # XXX hack.
+            errors.append("Commentary track %s has unknown type: %s" % (track['id'], track['description']))
+            continue
+        track['channels'] = re.search(r'(?P<channels>[1-7]\.[0-2] channels)', track['description']).group('channels')
+        # Keep dialog normalization for commentaries.
+        if re.search(r'dialnorm', track['description']) and \
+                tool_supports(settings, 'eac3to', '-keepDialnorm'):
+            add_option(track, '-keepDialnorm')
+    for track in subtitles:
+        track['filename'] = '%02dsubtitles.sup' % idnum(track)
+
+    if current_default_audio_track is None:
+        # assume default audio track is the first soundtrack
+        if soundtracks:
+            current_default_audio_track = soundtracks[0]['id'].rstrip(':')
+    else:
+        if current_default_audio_track not in [track['id'].rstrip(':') for track in soundtracks] and \
+                current_default_audio_track not in [track['id'].rstrip(':') for track in commentaries]:
+            errors.append("You selected track ID %s as the default audio track, but it's not an audio track." % current_default_audio_track)
+    if errors:
+        problems.extend(errors)
+        return None
+
+    eac3to_command = build_eac3to_command(eac3to, playlist_source(settings, current_playlist),
+                                          chapters + videos + soundtracks + commentaries + subtitles)
+
+    return {'playlist': current_playlist,
+            'demux_dir': demux_dir,
+            'chapters': chapters,
+            'videos': videos,
+            'soundtracks': soundtracks,
+            'commentaries': commentaries,
+            'subtitles': subtitles,
+            'lossless': lossless,
+            'default_audio_track': current_default_audio_track,
+            'eac3to_command': eac3to_command,
+            'duration': settings.get('durations', {}).get(current_playlist),
+            'scan_digest': hashlib.sha1(pl_scan['output']).hexdigest()}
+
+def playlist_source(settings, playlist):
+    """Return the eac3to arguments naming a playlist to extract from:
+    the disc and the playlist's number, or the playlist's file in the
+    prefetched mirror of the disc."""
+    if playlist in settings.get('mirror_playlists', {}):
+        return [settings['mirror_playlists'][playlist]]
+    return [settings['path'], '%d)' % playlist]
+
+def build_eac3to_command(eac3to, source, tracks):
+    """Return the eac3to command line extracting ``tracks`` from
+    ``source``, as returned by playlist_source()."""
+    eac3to_command = [eac3to] + source
+    for track in tracks:
+        eac3to_command.append(track['id'])
+        eac3to_command.append(track['filename'])
+        if 'eac3to args' in track:
+            # eac3to args are a list.
+            eac3to_command += track['eac3to args']
+    return eac3to_command
+
+def mkvmerge_options(plan):
+    """Build the contents of mkvmerge.options for a playlist plan."""
+    chapters = plan['chapters']
+    videos = plan['videos']
+    current_default_audio_track = plan['default_audio_track']
+
+    mkvmerge_options = ['# Set default language']
+    mkvmerge_options += ['--default-language', 'eng']
+    # eac3to always saves the log file as 'foo - Log.txt' where 'foo'
+    # is the filename of the first extracted track, minus the '.txt'
+    # extension. In our case, that's the chapter file.
+    mkvmerge_options += ['', '# Attach eac3to extraction log']
+    mkvmerge_options += ['--attachment-description', 'eac3to extraction log',
+                         '--attachment-mime-type', 'text/plain',
+                         '--attach-file', '%s - Log.txt' % chapters[0]['filename'].rstrip('.txt')]
+    mkvmerge_options += ['', '# Chapter file']
+    for track in chapters:
+        mkvmerge_options += ['--chapters', track['filename']]
+    # XXX hack - assume first video track is the default
+    mkvmerge_options += ['', '# Default video track']
+    mkvmerge_options += ['--default-track', '-1:1',
+                         '--track-name', '-1:Theatrical release',
+                         videos[0]['filename']]
+    mkvmerge_options += ['', '# Additional video tracks (may be empty)']
+    for track in videos[1:]:
+        mkvmerge_options += ['--default-track', '-1:0', track['filename']]
+
+    mkvmerge_options += ['', '# Soundtracks']
+    for track in plan['soundtracks']:
+        if track['id'].rstrip(':') == current_default_audio_track:
+            dta = '-1:1'
+            # XXX hack: now reset default track so that if there's
+            # more than one track with the same id (e.g. a DTS-MA
+            # version of a FLAC track), we won't end up with two
+            # tracks marked as default.
+            current_default_audio_track = 0
+        else:
+            dta = '-1:0'
+        mkvmerge_options += ['--default-track', dta,
+                             '--track-name', '-1:%s theatrical soundtrack (%s)' % (track['format'], track['channels']),
+                             track['filename']]
+    mkvmerge_options += ['', '# Commentary tracks (may be empty)']
+    for track in plan['commentaries']:
+        if track['id'].rstrip(':') == current_default_audio_track:
+            dta = '-1:1'
+            # XXX hack: now reset default track so that if there's
+            # more than one track with the same id (e.g. a DTS-MA
+            # version of a FLAC track), we won't end up with two
+            # tracks marked as default.
+            current_default_audio_track = 0
+        else:
+            dta = '-1:0'
+        mkvmerge_options += ['--default-track', dta,
+                             '--track-name', '-1:%s commentary (%s)' % (track['format'], track['channels']),
+                             track['filename']]
+    mkvmerge_options += ['', '# Subtitles (may be empty)']
+    for track in plan['subtitles']:
+        mkvmerge_options += ['--default-track', '-1:0',
+                             '--track-name', '-1:Subtitles',
+                             track['filename']]
+    return mkvmerge_options
+
+#
+# Checkpoints.
+#
+# Each demux directory keeps a checkpoint of the tracks planned for it
+# (by id and eac3to args) and of those that have been extracted, with
+# their size and a quick hash. When a playlist is demuxed again, only
+# tracks that are missing, damaged or planned differently are
+# extracted; if none are, eac3to isn't run at all. Likewise the mkv
+# isn't made again if it's intact and the mkvmerge options haven't
+# changed, and then nothing is extracted either. A checkpoint is only
+# used for the same playlist scan; --cleanup removes it with the
+# tracks.
+#
+CHECKPOINT_FILE = 'checkpoint.json'
+CHECKPOINT_VERSION = 2
+
+def quick_hash(filename, sample=64 * 1024):
+    """Hash a file's size and its first, middle and last ``sample`` bytes."""
+    size = os.path.getsize(filename)
+    digest = hashlib.sha1('%d\0' % size)
+    f = open(filename, 'rb')
+    try:
+        for offset in sorted(set([0, max(0, (size - sample) // 2),
+                                  max(0, size - sample)])):
+            f.seek(offset)
+            digest.update(f.read(sample))
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def _intact(filename, entry):
+    try:
+        return os.path.getsize(filename) == entry['size'] \
+            and quick_hash(filename) == entry['hash']
+    except (IOError, OSError):
+        return False
+
+class Checkpoint(object):
+    """The checkpoint of a playlist's demux directory."""
+
+    def __init__(self, plan):
+        self.demux_dir = plan['demux_dir']
+        self.filename = os.path.join(self.demux_dir, CHECKPOINT_FILE)
+        self.lock = threading.Lock()
+        self.data = {'version': CHECKPOINT_VERSION,
+                     'playlist': plan['playlist'],
+                     'scan': plan['scan_digest'],
+                     'tracks': {},
+                     'mux': None}
+        try:
+            f = open(self.filename)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return
+        if [data.get(key) for key in ['version', 'playlist', 'scan']] != \
+                [self.data[key] for key in ['version', 'playlist', 'scan']]:
+            logger.info("Ignoring %s, it's from a different scan." % self.filename)
+            return
+        self.data = data
+
+    def plan(self, tracks):
+        """Record the tracks to extract, forgetting earlier extractions
+        of anything planned differently."""
+        self.lock.acquire()
+        try:
+            entries = {}
+            for track in tracks:
+                planned = {'id': track['id'], 'args': track.get('eac3to args', [])}
+                entry = self.data['tracks'].get(track['filename'])
+                if entry is None or [entry['id'], entry['args']] != \
+                        [planned['id'], planned['args']]:
+                    entry = planned
+                entries[track['filename']] = entry
+            self.data['tracks'] = entries
+            self._save()
+        finally:
+            self.lock.release()
+
+    def extracted(self, track):
+        """Whether ``track`` was extracted earlier and is still intact."""
+        entry = self.data['tracks'].get(track['filename'])
+        if not entry or 'hash' not in entry:
+            return False
+        return _intact(os.path.join(self.demux_dir, track['filename']), entry)
+
+    def complete(self, tracks, hashes=None):
+        """Record that ``tracks`` have been extracted. ``hashes`` maps the
+        tracks' paths to hashes of the whole of each track, taken while
+        it was written (see start_output_hashing()), to record for
+        --verify to check the track against once it has been muxed."""
+        done = {}
+        for track in tracks:
+            filename = os.path.join(self.demux_dir, track['filename'])
+            entry = {'size': os.path.getsize(filename), 'hash': quick_hash(filename)}
+            if hashes and hashes.get(filename):
+                entry['size'], entry['sha1'] = hashes[filename]
+            done[track['filename']] = entry
+        self.lock.acquire()
+        try:
+            for filename, entry in done.items():
+                # A full hash from an earlier extraction is out of date.
+                self.data['tracks'][filename].pop('sha1', None)
+                self.data['tracks'][filename].update(entry)
+            # Any mkv made before was made from other tracks.
+            self.data['mux'] = None
+            self._save()
+        finally:
+            self.lock.release()
+
+    def muxed(self, outfile, options):
+        """Whether ``outfile`` was made from ``options`` and is intact."""
+        entry = self.data['mux']
+        if not entry or [entry['output'], entry['options']] != [outfile, options]:
+            return False
+        return _intact(outfile, entry)
+
+    def complete_mux(self, outfile, options):
+        """Record that ``outfile`` has been made from ``options``."""
+        entry = {'output': outfile, 'options': options,
+                 'size': os.path.getsize(outfile), 'hash': quick_hash(outfile)}
+        self.lock.acquire()
+        try:
+            self.data['mux'] = entry
+            self._save()
+        finally:
+            self.lock.release()
+
+    def verified(self):
+        """Record that the mkv has been verified."""
+        self.lock.acquire()
+        try:
+            if self.data['mux']:
+                self.data['mux']['verified'] = True
+            self._save()
+        finally:
+            self.lock.release()
+
+    def _save(self):
+        try:
+            write_atomic(self.filename, json.dumps(self.data, indent=1, sort_keys=True))
+        except (IOError, OSError), e:
+            logger.warning("Can't save checkpoint: %s" % e)
+
+def encode_flac(settings, plan, track):
+    """Encode the WAV extracted for a FLAC track with flac.
+
+    flac writes the compressed track to the track's usual filename, and
+    the WAV is removed once it's done. Returns 0 on success.
+    """
+    demux_dir = plan['demux_dir']
+    wav = wav_track(track)['filename']
+    encode_command = [settings['flac'], '-%d' % settings['flac_compression'],
+                      '--silent', '--force', '-o', track['filename'], wav]
+    logger.info("FLAC command line: %s" % ' '.join(encode_command))
+    hashing = None
+    with holding(settings, 'cpu'):
+        if settings.get('verify'):
+            hashing = start_output_hashing([os.path.join(demux_dir, track['filename'])])
+        rc = subprocess.call(encode_command, cwd=demux_dir)
+    hashes = hashing and hashing() or {}
+    if rc:
+        logger.error("Encoding track %s to %s failed (flac status %d)" \
+                         % (track['id'], track['filename'], rc))
+        return rc
+    os.remove(os.path.join(demux_dir, wav))
+    logger.info("Encoded track %s to %s" % (track['id'], track['filename']))
+    if 'checkpoint' in plan:
+        plan['checkpoint'].complete([track], hashes)
+    return 0
+
+def start_flac_encoders(settings, plan, tracks):
+    """Encode the WAVs extracted for ``tracks`` to FLAC in up to
+    settings['flac_jobs'] threads.
+
+    Returns a function that waits for the encoders to finish and
+    returns the first non-zero status (or 0).
+    """
+    pending = Queue.Queue()
+    for track in tracks:
+        pending.put(track)
+    statuses = []
+    def encoder():
+        while True:
+            try:
+                track = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                statuses.append(encode_flac(settings, plan, track))
+            except Exception:
+                logger.exception("Encoding track %s failed" % track['id'])
+                statuses.append(1)
+    threads = []
+    for i in range(min(settings['flac_jobs'], len(tracks))):
+        thread = threading.Thread(target=encoder,
+                                  name='playlist %d) flac %d' % (plan['playlist'], i + 1))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    def wait():
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return ([rc for rc in statuses if rc] + [0])[0]
+    return wait
+
+def extract_playlist(settings, plan):
+    """Run eac3to for a planned playlist and save its mkvmerge options.
+
+    Only tracks the demux directory's checkpoint doesn't show as
+    already extracted are extracted. With settings['flac_jobs'] or
+    settings['job_dir'] set, FLAC tracks are extracted as WAV, so that
+    the disc is only read once, and encoded by separate flac processes
+    (local ones or remote workers) once eac3to is done; mux_playlist()
+    waits for them.
+    """
+    demux_dir = plan['demux_dir']
+    tracks = [track for group in TRACK_GROUPS for track in plan[group]]
+    if not os.path.isdir(demux_dir):
+        os.makedirs(demux_dir)
+
+    if settings.get('stream') and settings['mkvmerge']:
+        # These are written into named pipes during the mux instead.
+        plan['streamed'] = streamed_tracks(settings, tracks)
+        tracks = [track for track in tracks if track not in plan['streamed']]
+
+    checkpoint = plan['checkpoint'] = Checkpoint(plan)
+    options = '\n'.join(mkvmerge_options(plan))
+    if settings['mkvmerge'] and \
+            checkpoint.muxed(mkv_filename(settings, plan), hashlib.sha1(options).hexdigest()):
+        logger.info("Playlist %d) has already been muxed." % plan['playlist'])
+        return 0
+    checkpoint.plan(tracks)
+    # The chapters' log is the one attached to the mkv.
+    chapters_log = '%02dchapters - Log.txt' % idnum(plan['chapters'][0])
+    done = [track for track in tracks if checkpoint.extracted(track) and \
+                (track not in plan['chapters'] or
+                 os.path.exists(os.path.join(demux_dir, chapters_log)))]
+    tracks = [track for track in tracks if track not in done]
+    if done and not tracks:
+        logger.info("Playlist %d) has already been extracted." % plan['playlist'])
+    elif done:
+        logger.info("Already extracted: %s" % ' '.join([track['filename'] for track in done]))
+
+    written = [os.path.join(demux_dir, track['filename']) for track in tracks]
+    flac_tracks = []
+    if settings.get('job_dir') or settings.get('flac_jobs'):
+        flac_tracks = [track for track in tracks if track.get('format') == 'FLAC']
+        tracks = [track for track in tracks if track.get('format') != 'FLAC'] + \
+                 [wav_track(track) for track in flac_tracks]
+
+    eac3to_command = build_eac3to_command(settings['eac3to'],
+                                          playlist_source(settings, plan['playlist']), tracks)
+    if tracks and plan['chapters'][0] not in tracks:
+        # Keep the chapters' log from the run that extracted them.
+        eac3to_command.append('-log=%02dresume - Log.txt' % idnum(tracks[0]))
+
+    outputs = [os.path.join(demux_dir, track['filename']) for track in tracks]
+    with traced(settings, 'extract', plan['playlist'], written) as span:
+        if tracks:
+            logger.info('')
+            logger.info("Demuxing command line: %s", ' '.join(eac3to_command))
+            completed = [track for track in tracks if track.get('format') != 'WAV']
+            hashing = None
+            with holding(settings, 'drive', 'cpu'):
+                if settings.get('verify'):
+                    hashing = start_output_hashing([os.path.join(demux_dir, track['filename'])
+                                                    for track in completed])
+                rc, _ = run_tool(eac3to_command, cwd=demux_dir, tool='eac3to',
+                                 label='playlist %d) extraction' % plan['playlist'],
+                                 outputs=outputs,
+                                 on_event=progress_callback(settings, plan['playlist']))
+            hashes = hashing and hashing() or {}
+            if not rc:
+                checkpoint.complete(completed, hashes)
+        else:
+            rc = 0
+        span['status'] = rc
+    if rc:
+        return rc
+    if flac_tracks and settings.get('job_dir'):
+        plan['remote_flac'] = submit_flac_jobs(settings, plan, flac_tracks)
+    elif flac_tracks:
+        plan['wait_for_flac'] = start_flac_encoders(settings, plan, flac_tracks)
+
+    logger.info('Saving mkvmerge options to mkvmerge.options')
+    mkvopts_file = open(os.path.join(demux_dir, 'mkvmerge.options'), 'w')
+    mkvopts_file.write(options)
+    mkvopts_file.close()
+    return 0
+
+def mkv_filename(settings, plan):
+    """Return the filename of the mkv made for a playlist.
+
+    When several playlists are demuxed into the output directory, each
+    mkv is named after its playlist. Samples are named NAME.sample.
+    """
+    name = settings['name']
+    ext = '.mkv'
+    if settings.get('sample'):
+        ext = '.sample.mkv'
+    if not settings['output_dir']:
+        return os.path.join(plan['demux_dir'], name + ext)
+    if settings.get('several_playlists'):
+        return os.path.join(settings['output_dir'], name,
+                            '%s.playlist_%02d%s' % (name, plan['playlist'], ext))
+    return os.path.join(settings['output_dir'], name, name + ext)
+
+def mux_playlist(settings, plan):
+    """Make the mkv from the extracted tracks (if mkvmerge is enabled)."""
+    mkvmerge = settings['mkvmerge']
+    demux_dir = plan['demux_dir']
+    if plan.get('remote_flac'):
+        rc = wait_for_flac_jobs(settings, plan)
+        if rc:
+            return rc
+    if plan.get('wait_for_flac'):
+        with traced(settings, 'encode', plan['playlist'],
+                    [os.path.join(demux_dir, track['filename']) for track in plan['soundtracks']
+                     if track.get('format') == 'FLAC']) as span:
+            rc = span['status'] = plan.pop('wait_for_flac')()
+        if rc:
+            return rc
+    if not mkvmerge:
+        return 0
+
+    logger.info('')
+    logger.info("Running mkvmerge")
+    outfile = mkv_filename(settings, plan)
+    if not os.path.isdir(os.path.dirname(outfile)):
+        os.makedirs(os.path.dirname(outfile))
+    mkvmerge_command = [mkvmerge, "-o", outfile, "@mkvmerge.options"]
+    f = open(os.path.join(demux_dir, 'mkvmerge.options'))
+    try:
+        options = hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+    checkpoint = plan.get('checkpoint')
+    if checkpoint is not None and checkpoint.muxed(outfile, options):
+        logger.info("%s has already been made." % outfile)
+        return 0
+    logger.info("mkvmerge command line: %s", ' '.join(mkvmerge_command))
+    hashing = []
+    if settings.get('verify'):
+        hashing.append(start_track_hashing(plan, [track for track in muxed_tracks(plan)
+                                                  if track not in plan.get('streamed', [])]))
+    with traced(settings, 'mux', plan['playlist'], [outfile]) as span:
+        rc = None
+        if plan.get('streamed'):
+            span['streamed'] = len(plan['streamed'])
+            streamed = plan['streamed']
+            rc = mux_streaming(settings, plan, mkvmerge_command, outfile)
+            if rc is None and settings.get('verify'):
+                # Extracted to files instead.
+                hashing.append(start_track_hashing(plan, streamed))
+        if rc is None and settings.get('job_dir'):
+            queue = JobQueue(settings['job_dir'])
+            rc = queue.wait(queue.submit('mkvmerge', mkvmerge_command[1:],
+                                         os.path.abspath(demux_dir),
+                                         'playlist %d) mux' % plan['playlist'], outfile))
+        elif rc is None:
+            with holding(settings, 'mux'):
+                rc, _ = run_tool(mkvmerge_command, cwd=demux_dir, tool='mkvmerge',
+                                 label='playlist %d) mux' % plan['playlist'],
+                                 outputs=[outfile],
+                                 on_event=progress_callback(settings, plan['playlist']))
+        if hashing:
+            plan['track_hashes'] = {}
+            for wait in hashing:
+                plan['track_hashes'].update(wait())
+        span['status'] = rc
+    if not rc and checkpoint is not None:
+        checkpoint.complete_mux(outfile, options)
+    return rc
+
+#
+# Streaming mode.
+#
+# With --stream, the first of a playlist's tracks that eac3to can
+# write sequentially (see 'stream-formats' in the config), usually its
+# main soundtrack, is never stored on disk: eac3to writes it into a
+# named pipe, created under the track's usual filename, while mkvmerge
+# reads it. Everything else (the chapters, which mkvmerge reads up
+# front; outputs whose headers are rewritten when the track ends, like
+# FLAC and Matroska; FLAC tracks from --flac-jobs) is extracted to
+# files first, as usual. mkvmerge.options is the same either way.
+#
+# Only one track is streamed per playlist. eac3to creates all of its
+# outputs before it writes any of them, while mkvmerge opens its
+# inputs one at a time and reads from each before opening the next,
+# so with two pipes each tool would wait for the other forever.
+#
+# The streamed track is read from the disc in a second eac3to run,
+# alongside the main extraction (in batch mode, the mux waits for the
+# drive). mkvmerge identifies some formats by seeking in them, which a
+# named pipe doesn't allow. If mkvmerge fails while eac3to is still
+# going, or the mkv stops growing for STREAM_STALL_TIMEOUT seconds,
+# both tools are stopped, the track is extracted to a file after all
+# and muxed from that, and tracks of its format aren't streamed for
+# the rest of the run.
+#
+DEFAULT_STREAM_FORMATS = ['.dts', '.thd', '.ac3']
+# How long a streamed mux may go without writing to the mkv, in
+# seconds, before it is given up on.
+STREAM_STALL_TIMEOUT = 300
+
+def streamed_tracks(settings, tracks):
+    """Return the tracks (at most one) to stream into mkvmerge rather
+    than extract."""
+    for track in tracks:
+        if settings.get('flac_jobs') and track.get('format') == 'FLAC':
+            continue
+        if os.path.splitext(track['filename'])[1] in settings['stream_formats']:
+            return [track]
+    return []
+
+def _release_fifos(fifos):
+    # Open and close each pipe at both ends without blocking, so that a
+    # tool stuck opening a pipe the other tool will never open gets
+    # EOF (or a broken pipe) instead of waiting forever. Opening the
+    # write end fails (ENXIO) if nobody has the pipe open for reading.
+    for fifo in fifos:
+        for flags in [os.O_WRONLY, os.O_RDONLY]:
+            try:
+                fd = os.open(fifo, flags | os.O_NONBLOCK)
+            except OSError:
+                continue
+            os.close(fd)
+
+def mux_streaming(settings, plan, mkvmerge_command, outfile):
+    """Run mkvmerge with the streamed tracks fed through named pipes.
+
+    Returns the status of the run, or None if mkvmerge couldn't read
+    the streamed tracks that way, in which case they have been
+    extracted to files instead (see extract_streamed()).
+    """
+    demux_dir = plan['demux_dir']
+    streamed = plan['streamed']
+    fifos = [os.path.join(demux_dir, track['filename']) for track in streamed]
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+    log = '%02dstream - Log.txt' % idnum(streamed[0])
+    eac3to_command = build_eac3to_command(settings['eac3to'],
+                                          playlist_source(settings, plan['playlist']),
+                                          streamed) + ['-log=%s' % log]
+    logger.info("Streaming command line: %s", ' '.join(eac3to_command))
+
+    on_event = progress_callback(settings, plan['playlist'])
+    processes = []
+    results = {}
+    failed = []
+    def run(key, command, **kwargs):
+        try:
+            results[key] = run_tool(command, cwd=demux_dir, processes=processes,
+                                    on_event=on_event, **kwargs)[0]
+        except Exception:
+            logger.exception("Can't run %s" % command[0])
+            results[key] = 1
+        if results[key]:
+            failed.append(key)
+    runs = [('mkvmerge', mkvmerge_command,
+             {'tool': 'mkvmerge', 'outputs': [outfile],
+              'label': 'playlist %d) mux' % plan['playlist']}),
+            ('eac3to', eac3to_command,
+             {'tool': 'eac3to', 'echo': False,
+              'label': 'playlist %d) streaming' % plan['playlist']})]
+
+    stalled = False
+    try:
+        with holding(settings, 'drive', 'cpu', 'mux'):
+            threads = []
+            for (key, command, kwargs) in runs:
+                thread = threading.Thread(target=run, args=(key, command), kwargs=kwargs,
+                                          name='playlist %d) %s' % (plan['playlist'], key))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            written, last_write = 0, time.time()
+            while [thread for thread in threads if thread.is_alive()]:
+                if failed or stalled:
+                    # Neither tool can finish without the other.
+                    for proc in processes:
+                        if proc.poll() is None:
+                            proc.kill()
+                    _release_fifos(fifos)
+                elif 'eac3to' in results:
+                    _release_fifos(fifos)
+                elif _output_bytes([outfile]) != written:
+                    written, last_write = _output_bytes([outfile]), time.time()
+                elif time.time() - last_write > STREAM_STALL_TIMEOUT:
+                    logger.warning("Playlist %d) mux has written nothing for %d seconds." \
+                                       % (plan['playlist'], STREAM_STALL_TIMEOUT))
+                    stalled = True
+                for thread in threads:
+                    thread.join(0.5)
+    finally:
+        for fifo in fifos:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+    if stalled or failed[:1] == ['mkvmerge'] and results.get('eac3to') != 0:
+        formats = sorted(set([os.path.splitext(track['filename'])[1] for track in streamed]))
+        logger.warning("%s can't mux %s through a named pipe; extracting %s tracks to disk." \
+                           % (settings['mkvmerge'], ' '.join([track['filename'] for track in streamed]),
+                              ' '.join(formats)))
+        settings['stream_formats'] = [ext for ext in settings['stream_formats']
+                                      if ext not in formats]
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        rc = extract_streamed(settings, plan)
+        if rc:
+            return rc
+        return None
+    # A tool we killed reports a negative status (the signal); report
+    # the status of the one that failed by itself.
+    for key in failed:
+        if results[key] > 0:
+            return results[key]
+    if failed:
+        return 1
+    return 0
+
+def extract_streamed(settings, plan):
+    """Extract a playlist's streamed tracks to files after all, and
+    record them in its checkpoint; return eac3to's status."""
+    demux_dir = plan['demux_dir']
+    streamed = plan['streamed']
+    eac3to_command = build_eac3to_command(settings['eac3to'],
+                                          playlist_source(settings, plan['playlist']),
+                                          streamed) + \
+        ['-log=%02dstream - Log.txt' % idnum(streamed[0])]
+    logger.info("Demuxing command line: %s", ' '.join(eac3to_command))
+    outputs = [os.path.join(demux_dir, track['filename']) for track in streamed]
+    hashing = None
+    with holding(settings, 'drive', 'cpu'):
+        if settings.get('verify'):
+            hashing = start_output_hashing(outputs)
+        rc, _ = run_tool(eac3to_command, cwd=demux_dir, tool='eac3to',
+                         label='playlist %d) extraction' % plan['playlist'],
+                         outputs=outputs,
+                         on_event=progress_callback(settings, plan['playlist']))
+    hashes = hashing and hashing() or {}
+    if rc:
+        return rc
+    plan['streamed'] = []
+    checkpoint = plan.get('checkpoint')
+    if checkpoint is not None:
+        checkpoint.plan([track for group in TRACK_GROUPS for track in plan[group]])
+        checkpoint.complete(streamed, hashes)
+    return 0
+
+#
+# Remote jobs.
+#
+# With --job-dir, the host with the drive only scans and extracts. FLAC
+# encoding and muxing are handed to worker processes ('eac3bot.py
+# --worker DIR') on this or other hosts, through a job directory on a
+# filesystem they all share. The demux and output directories have to
+# be on the shared filesystem too, at the same path on every host. FLAC
+# tracks are extracted as WAV for the workers to encode, and the WAV is
+# removed once the FLAC is made.
+#
+# A job is a JSON file naming a tool (each worker runs its own mkvmerge
+# or flac), its arguments and its working directory. The coordinator
+# writes it to pending/. A worker claims it by renaming it into
+# running/, touches it every few seconds while the job runs, and writes
+# the result to done/. If a running job hasn't been touched for a
+# while, its worker is assumed to be gone and the job goes back to
+# pending/. So does a job that failed, until it has been tried
+# REMOTE_ATTEMPTS times.
+#
+# A worker that was only slow to be heard from (NFS clients cache file
+# times for up to a minute by default) may still be running when its
+# job is handed to another one. Its heartbeat notices that the job is
+# no longer in running/ under its name and kills the tool. Each attempt
+# also writes its output under a name of its own, which is renamed to
+# the real one only by the worker that still holds the job, so two
+# attempts never write the same file. With --verify, the worker hashes
+# a FLAC encode's output as flac writes it, and the hash comes back
+# with the result (see the Verification comment below).
+#
+REMOTE_TOOLS = ['mkvmerge', 'flac']
+# In seconds. The timeout allows for the heartbeat, the attribute
+# caching of the hosts on both ends and a busy file server.
+REMOTE_HEARTBEAT = 5
+REMOTE_TIMEOUT = 300
+REMOTE_POLL = 1
+REMOTE_ATTEMPTS = 2
+# How much of a job's output comes back with its result.
+REMOTE_OUTPUT = 4096
+
+class JobQueue(object):
+    """A job directory; see the Remote jobs comment above."""
+
+    def __init__(self, job_dir, timeout=REMOTE_TIMEOUT):
+        self.job_dir = job_dir
+        self.timeout = timeout
+        # The hashes workers took of hashed jobs' outputs, by job id.
+        self.hashes = {}
+        for state in ['pending', 'running', 'done']:
+            try:
+                os.makedirs(os.path.join(job_dir, state))
+            except OSError:
+                # Already there, or made by someone else just now.
+                if not os.path.isdir(os.path.join(job_dir, state)):
+                    raise
+
+    def _path(self, state, job_id, ext='.json'):
+        return os.path.join(self.job_dir, state, job_id + ext)
+
+    def _read(self, filename):
+        f = open(filename)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def _write(self, state, job_id, data):
+        # Workers only look at '.json' files, so they never see one
+        # half-written.
+        write_atomic(self._path(state, job_id), json.dumps(data, indent=1, sort_keys=True))
+
+    def submit(self, tool, args, cwd, label, output, attempt=1, job_id=None, hashed=False):
+        """Queue a job running ``tool`` with ``args`` in ``cwd``, writing
+        ``output`` (one of ``args``); return its id. If ``hashed``, the
+        worker hashes the output while it's written (see
+        start_output_hashing()), and wait() puts the hash in
+        self.hashes."""
+        if job_id is None:
+            # Ids sort in the order jobs were submitted.
+            job_id = '%015d-%s-%s' % (int(time.time() * 1000), socket.gethostname(),
+                                      uuid.uuid4().hex[:8])
+        self._write('pending', job_id, {'id': job_id, 'tool': tool, 'args': args,
+                                        'cwd': cwd, 'label': label, 'output': output,
+                                        'attempt': attempt, 'hashed': hashed})
+        return job_id
+
+    def _retry(self, job, reason):
+        if job['attempt'] >= REMOTE_ATTEMPTS:
+            logger.error("%s: %s; giving up after %d attempts." \
+                             % (job['label'], reason, job['attempt']))
+            return False
+        logger.warning("%s: %s; trying again." % (job['label'], reason))
+        self.submit(job['tool'], job['args'], job['cwd'], job['label'], job['output'],
+                    job['attempt'] + 1, job['id'], job.get('hashed', False))
+        return True
+
+    def wait(self, job_id):
+        """Wait for a job to finish, retrying it as needed; return its
+        exit status."""
+        started = time.time()
+        warned = False
+        last_beat = None
+        last_change = time.time()
+        while True:
+            done = self._path('done', job_id)
+            if os.path.exists(done):
+                result = self._read(done)
+                os.remove(done)
+                if result['returncode'] == 0:
+                    # A worker we'd given up on may have finished after
+                    # all, with the job already queued again.
+                    try:
+                        os.remove(self._path('pending', job_id))
+                    except OSError:
+                        pass
+                    logger.info("%s: done by %s in %s" % (result['job']['label'], result['worker'],
+                                                          format_duration(result['elapsed'])))
+                    self.hashes[job_id] = result.get('hash')
+                    return 0
+                logger.error(result['output'])
+                if not self._retry(result['job'], 'failed on %s with status %d' \
+                                       % (result['worker'], result['returncode'])):
+                    return result['returncode']
+                started, last_beat = time.time(), None
+                continue
+            running = self._path('running', job_id)
+            try:
+                beat = os.path.getmtime(running)
+            except OSError:
+                beat = None
+            # Heartbeats are timed by this host's clock, which needn't
+            # agree with the file server's.
+            now = time.time()
+            if beat != last_beat:
+                last_beat, last_change = beat, now
+            elif beat is not None and now - last_change > self.timeout:
+                lost = self._path('running', job_id, '.lost')
+                try:
+                    # Once it's gone from running/, a late result from
+                    # the worker is ignored.
+                    os.rename(running, lost)
+                except OSError:
+                    continue
+                job = self._read(lost)
+                os.remove(lost)
+                if not self._retry(job, 'no word from %s for %ds' \
+                                       % (job.get('worker'), self.timeout)):
+                    return 1
+                started, last_beat = time.time(), None
+                continue
+            elif beat is None and not warned and now - started > self.timeout:
+                logger.warning("No worker has taken %s yet; is 'eac3bot.py --worker %s' running?" \
+                                   % (job_id, self.job_dir))
+                warned = True
+            time.sleep(REMOTE_POLL)
+
+    def claim(self, worker):
+        """Take the oldest pending job for ``worker``, or return None."""
+        for fn in sorted(os.listdir(os.path.join(self.job_dir, 'pending'))):
+            if not fn.endswith('.json'):
+                continue
+            job_id = fn[:-len('.json')]
+            try:
+                os.rename(self._path('pending', job_id), self._path('running', job_id))
+            except OSError:
+                # Another worker got there first.
+                continue
+            job = self._read(self._path('running', job_id))
+            job['worker'] = worker
+            self._write('running', job_id, job)
+            return job
+        return None
+
+    def _holds(self, job, worker):
+        """Whether ``worker`` still holds this attempt at ``job``."""
+        try:
+            current = self._read(self._path('running', job['id']))
+        except (IOError, ValueError):
+            return False
+        return (current.get('worker'), current['attempt']) == (worker, job['attempt'])
+
+    def heartbeat(self, job, worker):
+        """Touch a running job; return False if it's been taken away
+        from ``worker``."""
+        if not self._holds(job, worker):
+            return False
+        try:
+            os.utime(self._path('running', job['id']), None)
+        except OSError:
+            pass
+        return True
+
+    def finish(self, job, worker, returncode, output, elapsed, output_hash=None):
+        """Report a job's result (with the hash of its output, for a
+        hashed job) and move its output into place, unless it's been
+        taken away from us."""
+        partial = os.path.join(job['cwd'], attempt_output(job))
+        if not self._holds(job, worker):
+            logger.warning("%s was given to another worker; dropping its result." % job['label'])
+            returncode = None
+        elif returncode == 0:
+            try:
+                if os.name == 'nt' and os.path.exists(os.path.join(job['cwd'], job['output'])):
+                    os.remove(os.path.join(job['cwd'], job['output']))
+                os.rename(partial, os.path.join(job['cwd'], job['output']))
+            except OSError, e:
+                returncode, output = 1, output + "\nCan't rename %s: %s" % (partial, e)
+        if returncode != 0 and os.path.exists(partial):
+            os.remove(partial)
+        if returncode is None:
+            return
+        self._write('done', job['id'], {'job': job, 'worker': worker, 'returncode': returncode,
+                                        'output': output[-REMOTE_OUTPUT:], 'elapsed': elapsed,
+                                        'hash': output_hash})
+        try:
+            os.remove(self._path('running', job['id']))
+        except OSError:
+            pass
+
+def attempt_output(job):
+    """Return the name one attempt at ``job`` writes its output to."""
+    root, ext = os.path.splitext(job['output'])
+    return '%s.attempt%d%s' % (root, job['attempt'], ext)
+
+def wav_track(track):
+    """Return the WAV extraction of a FLAC track, for flac to encode."""
+    return dict(track, filename='%s.wav' % os.path.splitext(track['filename'])[0],
+                format='WAV')
+
+def submit_flac_jobs(settings, plan, tracks):
+    """Queue FLAC encodes of the WAVs extracted for ``tracks``; return
+    a list of (track, job id)."""
+    queue = JobQueue(settings['job_dir'])
+    jobs = []
+    for track in tracks:
+        args = ['-%d' % settings['flac_compression'], '--silent', '--force',
+                '-o', track['filename'], wav_track(track)['filename']]
+        jobs.append((track, queue.submit('flac', args, os.path.abspath(plan['demux_dir']),
+                                         'playlist %d) flac %s' % (plan['playlist'],
+                                                                   track['filename']),
+                                         track['filename'], hashed=bool(settings.get('verify')))))
+    return jobs
+
+def wait_for_flac_jobs(settings, plan):
+    """Wait for a playlist's remote FLAC encodes; return the first
+    non-zero status (or 0)."""
+    queue = JobQueue(settings['job_dir'])
+    status = 0
+    with traced(settings, 'encode', plan['playlist'],
+                [os.path.join(plan['demux_dir'], track['filename'])
+                 for (track, _) in plan['remote_flac']]) as span:
+        for track, job_id in plan['remote_flac']:
+            rc = queue.wait(job_id)
+            if rc:
+                status = status or rc
+                continue
+            os.remove(os.path.join(plan['demux_dir'], wav_track(track)['filename']))
+            filename = os.path.join(plan['demux_dir'], track['filename'])
+            plan['checkpoint'].complete([track], {filename: queue.hashes.get(job_id)})
+        span['status'] = status
+    del plan['remote_flac']
+    return status
+
+def _run_remote_job(queue, job, tools, worker):
+    stop = threading.Event()
+    processes = []
+    def heartbeat():
+        while not stop.wait(REMOTE_HEARTBEAT):
+            if queue.heartbeat(job, worker) or stop.is_set():
+                continue
+            logger.warning("%s was given to another worker; stopping it." % job['label'])
+            for proc in processes:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            if processes:
+                return
+    thread = threading.Thread(target=heartbeat, name='%s heartbeat' % job['id'])
+    thread.daemon = True
+    thread.start()
+    logger.info("Running %s (attempt %d)" % (job['label'], job['attempt']))
+    started = time.time()
+    partial = os.path.join(job['cwd'], attempt_output(job))
+    hashing = None
+    try:
+        if job['tool'] not in tools:
+            rc, output = 1, "This worker doesn't run %s." % job['tool']
+        else:
+            if job.get('hashed'):
+                hashing = start_output_hashing([partial])
+            args = [arg == job['output'] and attempt_output(job) or arg for arg in job['args']]
+            rc, output = run_tool([tools[job['tool']]] + args, cwd=job['cwd'],
+                                  tool=job['tool'], label=job['label'], echo=False,
+                                  processes=processes)
+    except OSError, e:
+        rc, output = 1, "Can't run %s: %s" % (job['tool'], e)
+    finally:
+        stop.set()
+    hashes = hashing and hashing() or {}
+    logger.info("%s finished with status %d" % (job['label'], rc))
+    queue.finish(job, worker, rc, output, time.time() - started, hashes.get(partial))
+
+def run_worker(job_dir, tools, slots=1):
+    """Run jobs from ``job_dir`` until interrupted, ``slots`` at a time.
+
+    ``tools`` maps the tool names in REMOTE_TOOLS to this host's
+    executables.
+    """
+    queue = JobQueue(job_dir)
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+    logger.info("Worker %s taking jobs from %s" % (name, job_dir))
+    def worker(n):
+        while True:
+            try:
+                job = queue.claim('%s/%d' % (name, n))
+            except (IOError, OSError, ValueError), e:
+                logger.warning("Can't take a job: %s" % e)
+                job = None
+            if job is None:
+                time.sleep(REMOTE_POLL)
+                continue
+            _run_remote_job(queue, job, tools, '%s/%d' % (name, n))
+    threads = []
+    for n in range(slots):
+        thread = threading.Thread(target=worker, args=(n + 1,), name='worker %d' % (n + 1))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    return 0
+
+#
+# Verification.
+#
+# With --verify, every track is hashed in full twice without being
+# read from the disk again: while eac3to (or flac) writes it, by a
+# thread following the file as it grows, and while mkvmerge reads it.
+# Tools rewrite a file's header (sizes, durations, seek tables) once
+# they're done, so the first HASH_HEAD bytes are hashed separately,
+# after the tool exits. Once the mkv is made, it's checked against the
+# plan: the tracks must still be the ones that were written (same size
+# and full hash, so a track corrupted in place before the mux is
+# caught too), the mkv must hold as many tracks as were muxed, its
+# duration must match the playlist's, and it can't be smaller than the
+# tracks that went into it. --cleanup only removes the tracks of a
+# playlist that passes.
+#
+# Verifying and cleaning up a playlist happens in the background while
+# the next playlist is extracted.
+#
+
+# How far the mkv's duration may be from the playlist's, in seconds and
+# as a fraction of the duration (whichever is larger).
+VERIFY_DURATION_SLACK = (2, 0.01)
+# The smallest the mkv may be, as a fraction of its tracks' size.
+VERIFY_MIN_SIZE = 0.95
+# The part of a file hashed on its own (see above), in bytes.
+HASH_HEAD = 1024 * 1024
+# How often a file being written is checked for more data, in seconds.
+HASH_POLL = 0.5
+
+def muxed_tracks(plan):
+    """Return the tracks of a plan that end up as tracks of the mkv."""
+    return [track for group in TRACK_GROUPS if group != 'chapters'
+            for track in plan[group]]
+
+def _full_hash(head, rest):
+    return hashlib.sha1(hashlib.sha1(head).digest() + rest.digest()).hexdigest()
+
+def hash_file(filename, chunk=1024 * 1024):
+    """Return (size, sha1) of a file, reading all of it; the sha1 is
+    that of the sha1s of its first HASH_HEAD bytes and of the rest."""
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        head = f.read(HASH_HEAD)
+        size = len(head)
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            digest.update(data)
+            size += len(data)
+    finally:
+        f.close()
+    return size, _full_hash(head, digest)
+
+def start_output_hashing(filenames, chunk=1024 * 1024):
+    """Hash ``filenames`` as hash_file() does while a tool writes them,
+    a thread each following its file as it grows.
+
+    Files that are already there are removed first, as left over from
+    an earlier run. Returns a function to call once the tool has
+    exited, which reads what is left of the files and returns a dict
+    mapping each filename to (size, sha1), or to None for files that
+    couldn't be read.
+    """
+    done = threading.Event()
+    hashes = {}
+    def follow(filename):
+        digest = hashlib.sha1()
+        offset = HASH_HEAD
+        f = None
+        try:
+            while True:
+                finished = done.is_set()
+                if f is None and os.path.exists(filename):
+                    f = open(filename, 'rb')
+                if f is not None:
+                    f.seek(offset)
+                    while True:
+                        data = f.read(chunk)
+                        if not data:
+                            break
+                        digest.update(data)
+                        offset += len(data)
+                if finished:
+                    break
+                done.wait(HASH_POLL)
+            if f is None:
+                # The tool failed before writing it.
+                hashes[filename] = None
+                return
+            f.seek(0)
+            head = f.read(HASH_HEAD)
+            size = len(head) < HASH_HEAD and len(head) or offset
+            if [size, os.fstat(f.fileno()).st_ino] != \
+                    [os.fstat(f.fileno()).st_size, os.stat(filename).st_ino]:
+                # Written some other way than by appending to it.
+                hashes[filename] = hash_file(filename)
+            else:
+                hashes[filename] = size, _full_hash(head, digest)
+        except (IOError, OSError), e:
+            logger.error("Can't read %s: %s" % (filename, e))
+            hashes[filename] = None
+        finally:
+            if f is not None:
+                f.close()
+    threads = []
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+        thread = threading.Thread(target=follow, args=(filename,),
+                                  name='hash %s' % os.path.basename(filename))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    def wait():
+        done.set()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return hashes
+    return wait
+
+def start_track_hashing(plan, tracks):
+    """Hash the files of ``tracks`` in background threads, one per track.
+
+    Returns a function that waits for the threads and returns a dict
+    mapping track filenames to (size, sha1), or to None for files that
+    couldn't be read.
+    """
+    hashes = {}
+    def run(track):
+        try:
+            hashes[track['filename']] = hash_file(os.path.join(plan['demux_dir'],
+                                                               track['filename']))
+        except (IOError, OSError), e:
+            logger.error("Can't read %s: %s" % (track['filename'], e))
+            hashes[track['filename']] = None
+    threads = []
+    for track in tracks:
+        thread = threading.Thread(target=run, args=(track,),
+                                  name='playlist %d) hash %s' % (plan['playlist'], track['filename']))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    def wait():
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        return hashes
+    return wait
+
+def identify_mkv(mkvmerge, filename):
+    """Return mkvmerge's JSON identification of ``filename``, or None if
+    this mkvmerge can't give one."""
+    try:
+        output = subprocess.check_output([mkvmerge, '-J', filename],
+                                         stderr=subprocess.STDOUT)
+        info = json.loads(output)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+    if not info.get('container', {}).get('recognized'):
+        return None
+    return info
+
+def check_mkv(settings, plan):
+    """Check a playlist's mkv and tracks; return a list of problems."""
+    demux_dir = plan['demux_dir']
+    checkpoint = plan.get('checkpoint')
+    outfile = mkv_filename(settings, plan)
+    hashes = plan.get('track_hashes', {})
+    problems = []
+    tracks = muxed_tracks(plan)
+    files = [track for track in tracks if track not in plan.get('streamed', [])]
+    input_bytes = 0
+    for track in files:
+        filename = track['filename']
+        entry = checkpoint and checkpoint.data['tracks'].get(filename) or {}
+        if filename in hashes:
+            if hashes[filename] is None:
+                problems.append("%s couldn't be read" % filename)
+                continue
+            size, sha1 = hashes[filename]
+        elif os.path.exists(os.path.join(demux_dir, filename)):
+            # Muxed by an earlier run; a quick check will do.
+            size, sha1 = os.path.getsize(os.path.join(demux_dir, filename)), None
+        else:
+            # Already cleaned up after an earlier run.
+            continue
+        input_bytes += size
+        if 'hash' not in entry:
+            problems.append("%s has no record of its extraction" % filename)
+        elif sha1 is not None and sha1 != entry.get('sha1', sha1) \
+                or not _intact(os.path.join(demux_dir, filename), entry):
+            problems.append("%s has changed since it was extracted" % filename)
+
+    try:
+        mkv_bytes = os.path.getsize(outfile)
+    except OSError:
+        return problems + ["%s is missing" % outfile]
+    if mkv_bytes < input_bytes * VERIFY_MIN_SIZE:
+        problems.append("%s is %s, but its tracks are %s" \
+                            % (outfile, format_size(mkv_bytes), format_size(input_bytes)))
+
+    info = identify_mkv(settings['mkvmerge'], outfile)
+    if info is None:
+        logger.warning("mkvmerge can't identify %s; only checking sizes." % outfile)
+        return problems
+    if len(info.get('tracks', [])) != len(tracks):
+        problems.append("%s has %d tracks, expected %d" \
+                            % (outfile, len(info.get('tracks', [])), len(tracks)))
+    duration = info['container'].get('properties', {}).get('duration')
+    if duration is not None and plan.get('duration'):
+        expected = duration_seconds(plan['duration'])
+        seconds = duration / 1e9
+        if abs(seconds - expected) > max(VERIFY_DURATION_SLACK[0],
+                                         expected * VERIFY_DURATION_SLACK[1]):
+            problems.append("%s lasts %s, but the playlist lasts %s" \
+                                % (outfile, format_duration(seconds), plan['duration']))
+    return problems
+
+def verify_playlist(settings, plan):
+    """Verify a playlist's mkv (if --verify); see the comment above."""
+    if not settings.get('verify') or not settings['mkvmerge']:
+        return 0
+    with traced(settings, 'verify', plan['playlist']) as span:
+        problems = check_mkv(settings, plan)
+        span['problems'] = problems
+        span['status'] = int(bool(problems))
+    if problems:
+        for problem in problems:
+            logger.error("Playlist %d) verification: %s" % (plan['playlist'], problem))
+        logger.error("Playlist %d) failed verification; keeping its demuxed tracks." \
+                         % plan['playlist'])
+        return 1
+    logger.info("Playlist %d) verified." % plan['playlist'])
+    if plan.get('checkpoint') is not None:
+        plan['checkpoint'].verified()
+    return 0
+
+def cleanup_playlist(settings, plan):
+    """Remove demuxed tracks once they've been muxed (if --cleanup)."""
+    with traced(settings, 'cleanup', plan['playlist']) as span:
+        rc = _cleanup_playlist(settings, plan)
+        span['status'] = rc
+    return rc
+
+def _cleanup_playlist(settings, plan):
+    cleanup = settings['cleanup']
+    demux_dir = plan['demux_dir']
+
+    if settings['mkvmerge'] and cleanup:
+        logger.info("Cleaning up demuxed tracks.")
+        for group in TRACK_GROUPS:
+            for track in plan[group]:
+                # Tracks may be gone if the mkv was made by an earlier run.
+                filename = os.path.join(demux_dir, track['filename'])
+                if track not in plan.get('streamed', []) and os.path.exists(filename):
+                    os.remove(filename)
+        # Including the logs of FLAC encodes, streaming and resumed
+        # runs, from earlier runs too.
+        for fn in os.listdir(demux_dir):
+            if fn.endswith(' - Log.txt'):
+                os.remove(os.path.join(demux_dir, fn))
+        os.remove(os.path.join(demux_dir, 'mkvmerge.options'))
+        if os.path.exists(os.path.join(demux_dir, CHECKPOINT_FILE)):
+            os.remove(os.path.join(demux_dir, CHECKPOINT_FILE))
+
+    if cleanup and not os.listdir(demux_dir):
+        logger.info("Removing empty demux directory %s" % demux_dir)
+        os.rmdir(demux_dir)
+    return 0
+
+def demux_playlist(settings, plan):
+    """Extract and mux a single planned playlist.
+
+    Everything happens in the playlist's own demux directory, which is
+    passed to the child processes as their working directory; the
+    process-global cwd is never changed, so several playlists can be
+    demuxed concurrently.
+
+    Returns 0 on success, otherwise a non-zero exit status.
+    """
+    for stage in [extract_playlist, mux_playlist, verify_playlist, cleanup_playlist]:
+        rc = stage(settings, plan)
+        if rc:
+            return rc
+    return 0
+
+def demux_serial(settings, plans):
+    """Demux planned playlists one after the other, stopping at the first
+    failure.
+
+    With --verify, each playlist is verified and cleaned up in a
+    background thread while the next one is being extracted.
+    """
+    if not settings.get('verify'):
+        for plan in plans:
+            rc = demux_playlist(settings, plan)
+            if rc:
+                return rc
+        return 0
+
+    pending = Queue.Queue(1)
+    statuses = []
+    def verifier():
+        while True:
+            plan = pending.get()
+            if plan is None:
+                return
+            try:
+                rc = verify_playlist(settings, plan) or cleanup_playlist(settings, plan)
+            except Exception:
+                logger.exception("Playlist %d) failed" % plan['playlist'])
+                rc = 1
+            statuses.append(rc)
+    thread = threading.Thread(target=verifier, name='%s verify' % settings['name'])
+    thread.daemon = True
+    thread.start()
+    rc = 0
+    try:
+        for plan in plans:
+            if [status for status in statuses if status]:
+                break
+            rc = extract_playlist(settings, plan) or mux_playlist(settings, plan)
+            if rc:
+                break
+            pending.put(plan)
+    finally:
+        pending.put(None)
+        while thread.is_alive():
+            thread.join(1)
+    return rc or ([status for status in statuses if status] + [0])[0]
+
+def _init_demux_worker(level):
+    # Worker processes log through their own handler, tagged with the
+    # worker name so interleaved output from several playlists can be
+    # told apart.
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('[%(processName)s] %(message)s'))
+    logger.addHandler(console)
+    logger.setLevel(level)
+
+def _demux_playlist_job(job):
+    settings, plan = job
+    playlist = plan['playlist']
+    # Spans are sent back to the main process with the result.
+    settings = dict(settings, trace_spans=[])
+    try:
+        return playlist, demux_playlist(settings, plan), settings['trace_spans']
+    except Exception:
+        logger.exception("Playlist %d) failed" % playlist)
+        return playlist, 1, settings['trace_spans']
+
+def demux_parallel(settings, plans, jobs):
+    """Demux several planned playlists in a pool of ``jobs`` worker
+    processes.
+
+    ``plans`` should already be in scheduling order. Unlike the
+    serial loop, a failed playlist doesn't stop the others; the first
+    non-zero exit status is returned once all of them have finished.
+    """
+    logger.info("Demuxing %d playlists with %d parallel jobs" \
+                    % (len(plans), jobs))
+    pool = multiprocessing.Pool(processes=min(jobs, len(plans)),
+                                initializer=_init_demux_worker,
+                                initargs=(logger.getEffectiveLevel(),))
+    status = 0
+    failed = []
+    try:
+        for playlist, rc, spans in pool.imap_unordered(_demux_playlist_job,
+                                                       [(settings, plan) for plan in plans]):
+            for span in spans:
+                emit_span(settings, span)
+            if rc:
+                failed.append(playlist)
+                if not status:
+                    status = rc
+            else:
+                logger.info("Playlist %d) finished" % playlist)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if failed:
+        logger.error("The following playlists failed: %s" \
+                         % ', '.join(['%d)' % pl for pl in sorted(failed)]))
+    return status
+
+
+# Stages of the demux pipeline, in order. Each stage runs in its own
+# thread and hands its playlists on to the next one through a bounded
+# queue, so e.g. one playlist can be muxing while the next is being
+# extracted. (Playlists have all been scanned before it starts.)
+PIPELINE_STAGES = ['extract', 'mux', 'verify', 'cleanup']
+
+def _run_pipeline_stage(settings, stage, item):
+    """Run one pipeline stage; return (status, item for the next stage)."""
+    func = {'extract': extract_playlist,
+            'mux': mux_playlist,
+            'verify': verify_playlist,
+            'cleanup': cleanup_playlist}[stage]
+    return func(settings, item), item
+
+def _pipeline_worker(settings, stage, inq, outq, stats, failures):
+    while True:
+        started = time.time()
+        item = inq.get()
+        stats['wait'] += time.time() - started
+        if item is None:
+            break
+        playlist = item['playlist']
+        started = time.time()
+        try:
+            rc, result = _run_pipeline_stage(settings, stage, item)
+        except Exception:
+            logger.exception("Playlist %d) failed in the %s stage" % (playlist, stage))
+            rc, result = 1, None
+        stats['work'] += time.time() - started
+        stats['playlists'] += 1
+        if rc:
+            failures.append((playlist, stage, rc))
+        elif outq is not None:
+            started = time.time()
+            outq.put(result)
+            stats['wait'] += time.time() - started
+    if outq is not None:
+        outq.put(None)
+
+def demux_pipeline(settings, plans, queue_size=1):
+    """Demux planned playlists through an extract -> mux -> verify ->
+    cleanup pipeline.
+
+    At most ``queue_size`` playlists wait between any two stages. A
+    playlist that fails in one stage is dropped from the rest of the
+    pipeline; the others carry on. Once everything has drained, the
+    time each stage spent working and waiting is logged, and the first
+    non-zero exit status is returned.
+    """
+    logger.info("Demuxing %d playlists in a pipeline" % len(plans))
+    queues = [Queue.Queue()]
+    for stage in PIPELINE_STAGES[1:]:
+        queues.append(Queue.Queue(queue_size))
+    for plan in plans:
+        queues[0].put(plan)
+    queues[0].put(None)
+
+    stats = {}
+    failures = []
+    threads = []
+    for i, stage in enumerate(PIPELINE_STAGES):
+        stats[stage] = {'work': 0.0, 'wait': 0.0, 'playlists': 0}
+        if i + 1 < len(queues):
+            outq = queues[i + 1]
+        else:
+            outq = None
+        thread = threading.Thread(target=_pipeline_worker,
+                                  name='%s %s' % (settings['name'], stage),
+                                  args=(settings, stage, queues[i], outq,
+                                        stats[stage], failures))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join() with a timeout keeps the main thread responsive to ^C.
+        while thread.is_alive():
+            thread.join(1)
+
+    logger.info('')
+    logger.info('Pipeline stage times (working / waiting):')
+    for stage in PIPELINE_STAGES:
+        logger.info('  %-8s %8.1fs / %8.1fs  (%d playlists)' \
+                        % (stage, stats[stage]['work'], stats[stage]['wait'],
+                           stats[stage]['playlists']))
+    bottleneck = max(PIPELINE_STAGES, key=lambda s: stats[s]['work'])
+    logger.info('Bottleneck stage: %s' % bottleneck)
+
+    status = 0
+    for playlist, stage, rc in sorted(failures):
+        logger.error("Playlist %d) failed in the %s stage." % (playlist, stage))
+        if not status:
+            status = rc
+    return status
+
+#
+# Samples.
+#
+# With --sample, the selected playlists are scanned and planned as
+# usual, but only a few chapters or minutes of each are muxed, into
+# NAME.sample.mkv, to try out the track selection, FLAC and Sonic
+# handling, default-track flags and naming without a full rip. Samples
+# are demuxed into directories of their own, so they never mix with a
+# full rip's tracks or checkpoint.
+#
+# eac3to can't start partway into a playlist, so the tracks are
+# extracted from the beginning, and eac3to is stopped once it's past
+# the end of the sample; mkvmerge then cuts the sample out with
+# '--split parts:'. The closer a sample is to the start of the
+# playlist, the quicker it is to make.
+#
+# How far past the end of the sample eac3to is stopped, in percent of
+# the playlist, so that mkvmerge has every frame it needs.
+SAMPLE_MARGIN = 1
+
+_CHAPTER_TIME = re.compile(r'CHAPTER([0-9]+)=([0-9]+):([0-9]+):([0-9.]+)')
+
+def parse_sample(value):
+    """Parse a --sample value: a chapter or chapter range ('3', '3-5'),
+    or a time range ('0:10:00-0:12:00').
+
+    Returns ('chapters', first, last) or ('time', start, end), with
+    times in seconds. Raises ValueError.
+    """
+    first, _, last = value.partition('-')
+    if ':' in value:
+        start, end = duration_seconds(first), duration_seconds(last)
+        if start >= end:
+            raise ValueError("the sample ends before it starts")
+        return ('time', start, end)
+    first = int(first)
+    last = last and int(last) or first
+    if not 1 <= first <= last:
+        raise ValueError("chapters are numbered from 1, first to last")
+    return ('chapters', first, last)
+
+def read_chapters(filename):
+    """Return the start times (in seconds) of the chapters in an OGM
+    chapter file, as eac3to writes them."""
+    starts = []
+    f = open(filename)
+    try:
+        for line in f:
+            m = _CHAPTER_TIME.search(line)
+            if m:
+                hours, minutes, seconds = m.group(2, 3, 4)
+                starts.append(int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+    finally:
+        f.close()
+    return starts
+
+def sample_window(sample, chapters, seconds):
+    """Return the (start, end) of a sample in a playlist lasting
+    ``seconds`` with ``chapters`` (as from read_chapters()). Raises
+    ValueError if the playlist has no such part."""
+    if sample[0] == 'time':
+        start, end = sample[1], min(sample[2], seconds)
+        if start >= end:
+            raise ValueError("the playlist is only %s long" % format_duration(seconds))
+        return start, end
+    first, last = sample[1], sample[2]
+    if last > len(chapters):
+        raise ValueError("the playlist only has %d chapters" % len(chapters))
+    if last < len(chapters):
+        return chapters[first - 1], chapters[last]
+    return chapters[first - 1], seconds
+
+def _timestamp(seconds):
+    return '%02d:%02d:%06.3f' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def extract_sample(settings, plan):
+    """Extract a planned playlist up to the end of its sample, and save
+    its mkvmerge options.
+
+    The chapters are extracted first, to find where the sample is; the
+    window is saved in plan['sample_window'].
+    """
+    demux_dir = plan['demux_dir']
+    label = 'playlist %d) sample' % plan['playlist']
+    if not os.path.isdir(demux_dir):
+        os.makedirs(demux_dir)
+    source = playlist_source(settings, plan['playlist'])
+    callback = progress_callback(settings, plan['playlist'])
+    chapters = plan['chapters'][0]
+    with holding(settings, 'drive'):
+        rc, _ = run_tool(build_eac3to_command(settings['eac3to'], source, [chapters]),
+                         cwd=demux_dir, tool='eac3to', label='%s chapters' % label,
+                         echo=False, on_event=callback)
+    if rc:
+        return rc
+    seconds = duration_seconds(plan['duration'])
+    try:
+        start, end = sample_window(settings['sample'],
+                                   read_chapters(os.path.join(demux_dir, chapters['filename'])),
+                                   seconds)
+    except (IOError, ValueError), e:
+        logger.error("Playlist %d) has no such sample: %s" % (plan['playlist'], e))
+        return 1
+    logger.info("Playlist %d) sample: %s to %s" % (plan['playlist'], format_duration(start),
+                                                   format_duration(end)))
+
+    tracks = [track for group in TRACK_GROUPS for track in plan[group] if group != 'chapters']
+    stop_at = int(end * 100 // max(seconds, 1)) + 1 + SAMPLE_MARGIN
+    processes = []
+    stopped = []
+    def on_event(event):
+        callback(event)
+        if event['type'] == 'progress' and event['phase'] == 'process' and \
+                event['percent'] >= stop_at and not stopped:
+            stopped.append(event['percent'])
+            for proc in processes:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+    eac3to_command = build_eac3to_command(settings['eac3to'], source, tracks)
+    outputs = [os.path.join(demux_dir, track['filename']) for track in tracks]
+    with traced(settings, 'sample', plan['playlist'], outputs) as span:
+        logger.info('')
+        logger.info("Demuxing command line: %s", ' '.join(eac3to_command))
+        with holding(settings, 'drive', 'cpu'):
+            rc, _ = run_tool(eac3to_command, cwd=demux_dir, tool='eac3to', label=label,
+                             outputs=outputs, on_event=on_event, processes=processes)
+        if stopped:
+            logger.info("\nStopped eac3to at %d%%, past the end of the sample." % stopped[0])
+            rc = 0
+        span['status'] = rc
+    if rc:
+        return rc
+    plan['sample_window'] = (start, end)
+
+    # eac3to may not have got round to some tracks before it was stopped.
+    missing = [track for track in tracks
+               if not os.path.exists(os.path.join(demux_dir, track['filename']))]
+    if [track for track in missing if track in plan['videos']]:
+        logger.error("Playlist %d): eac3to was stopped before it wrote the video." % plan['playlist'])
+        return 1
+    if missing:
+        logger.warning("Leaving tracks eac3to hadn't written yet out of the sample: %s" \
+                           % ' '.join([track['filename'] for track in missing]))
+    sample_plan = dict(plan)
+    for group in TRACK_GROUPS:
+        sample_plan[group] = [track for track in plan[group] if track not in missing]
+
+    logger.info('Saving mkvmerge options to mkvmerge.options')
+    mkvopts_file = open(os.path.join(demux_dir, 'mkvmerge.options'), 'w')
+    mkvopts_file.write('\n'.join(mkvmerge_options(sample_plan)))
+    mkvopts_file.close()
+    return 0
+
+def mux_sample(settings, plan):
+    """Cut a playlist's sample out of its extracted tracks with mkvmerge."""
+    demux_dir = plan['demux_dir']
+    outfile = mkv_filename(settings, plan)
+    if not os.path.isdir(os.path.dirname(outfile)):
+        os.makedirs(os.path.dirname(outfile))
+    start, end = plan['sample_window']
+    mkvmerge_command = [settings['mkvmerge'], '-o', outfile,
+                        '--split', 'parts:%s-%s' % (_timestamp(start), _timestamp(end)),
+                        '@mkvmerge.options']
+    logger.info('')
+    logger.info("mkvmerge command line: %s", ' '.join(mkvmerge_command))
+    with traced(settings, 'mux', plan['playlist'], [outfile]) as span:
+        with holding(settings, 'mux'):
+            rc, output = run_tool(mkvmerge_command, cwd=demux_dir, tool='mkvmerge',
+                                  label='playlist %d) sample mux' % plan['playlist'],
+                                  outputs=[outfile],
+                                  on_event=progress_callback(settings, plan['playlist']))
+        # Status 1 is for warnings, which tracks eac3to was stopped in
+        # the middle of are bound to give.
+        if rc == 1 and not re.search(r'^Error:', output, re.M):
+            rc = 0
+        span['status'] = rc
+    if rc:
+        return rc
+    # Depending on its version, mkvmerge numbers even a single split
+    # file.
+    numbered = '%s-001%s' % os.path.splitext(outfile)
+    if not os.path.exists(outfile) and os.path.exists(numbered):
+        os.rename(numbered, outfile)
+    logger.info("Sample of playlist %d): %s" % (plan['playlist'], outfile))
+    return 0
+
+def demux_sample(settings, plans):
+    """Make the samples of planned playlists, one after the other."""
+    for plan in plans:
+        rc = extract_sample(settings, plan)
+        if not rc and settings['mkvmerge']:
+            rc = mux_sample(settings, plan) or cleanup_playlist(settings, plan)
+        if rc:
+            return rc
+    return 0
+
+#
+# Prescan.
+#
+# Every selected playlist is scanned and planned before anything is
+# extracted, so a playlist that can't be demuxed turns up before hours
+# have gone into the ones ahead of it. Up to --scan-jobs playlists are
+# scanned at once, but only cached scans really run side by side: they
+# don't touch the disc at all. Scans that do read it take turns, so a
+# drive never has more than one reader seeking it (in batch mode, the
+# drive resource sees to that; otherwise, a lock of the job's own).
+# Then every problem found is reported together, and the job either
+# stops or, with --skip-invalid, carries on with the playlists that
+# passed.
+#
+PRESCAN_JOBS = 4
+
+def prescan_playlists(settings, playlists, scan_jobs=PRESCAN_JOBS):
+    """Scan and plan ``playlists``.
+
+    Returns (plans, problems): the plans of the playlists that can be
+    demuxed, in the order given, and a (playlist, message) list saying
+    why the others can't.
+    """
+    scans = {}
+    pending = Queue.Queue()
+    for playlist in playlists:
+        pending.put(playlist)
+    reader = threading.Lock()
+    def scanner():
+        while True:
+            try:
+                playlist = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if settings.get('resources') is None and \
+                    load_cached_scan(settings['scan_cache'], playlist) is None:
+                with reader:
+                    scans[playlist] = scan_playlist(settings, playlist)
+            else:
+                scans[playlist] = scan_playlist(settings, playlist)
+    threads = []
+    for n in range(1, min(scan_jobs, len(playlists))):
+        thread = threading.Thread(target=scanner, name='%s scan %d' % (settings['name'], n + 1))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # This thread scans too, so a single scan isn't waited for by
+    # polling a thread.
+    scanner()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    plans = []
+    problems = []
+    for playlist in playlists:
+        found = []
+        pl_scan = scans.get(playlist)
+        if pl_scan is None:
+            found.append("Can't parse the playlist.")
+        else:
+            # Logged in order, whichever scan finished first.
+            logger.info("\nPlaylist %d):" % playlist)
+            logger.info(pl_scan['output'])
+            plan = plan_playlist(settings, playlist, pl_scan, found)
+            if plan is not None:
+                plans.append(plan)
+        problems.extend([(playlist, message) for message in found])
+    return plans, problems
+
+def report_problems(problems, playlists, skip_invalid):
+    """Log the problems prescan_playlists() found; return True if the
+    job should carry on."""
+    invalid = sorted(set([playlist for (playlist, _) in problems]))
+    logger.error("\n%d of the %d selected playlists can't be demuxed:" \
+                     % (len(invalid), len(playlists)))
+    for playlist, message in problems:
+        logger.error("  %d) %s" % (playlist, message))
+    if len(invalid) == len(playlists):
+        logger.error("Nothing left to demux, aborting.")
+        return False
+    if not skip_invalid:
+        logger.error("Aborting before anything is extracted (use --skip-invalid to demux the others).")
+        return False
+    logger.warning("Skipping playlists %s." % ', '.join(['%d)' % pl for pl in invalid]))
+    return True
+
+#
+# Disk space.
+#
+# Before anything is extracted, the space a job needs is estimated from
+# the track summaries in the disc scan (or, failing that, from playlist
+# durations alone): the tracks eac3bot would select, at the bitrate
+# eac3to gives for them or a typical one. That's compared with the free
+# space on the scratch and output volumes. A job that won't fit is
+# refused; in a batch, it waits while other jobs' reservations on the
+# same volume account for the shortfall.
+#
+
+# Typical bitrates in kbit/s, for tracks whose description doesn't give
+# one. Lossless audio is per channel, for each output the profile makes
+# of it (see soundtrack_outputs()), and so are the WAVs extracted for
+# flac to encode with --flac-jobs or --job-dir (24 bits at 48kHz).
+ESTIMATED_KBPS = {'video': 30000,
+                  'lossless': 650,
+                  'wav': 1152,
+                  'lossy': 640,
+                  'subtitles': 40,
+                  'chapters': 0}
+# For playlists the disc scan doesn't describe.
+ESTIMATED_PLAYLIST_KBPS = 40000
+# Headroom on top of the estimates.
+SPACE_MARGIN = 1.05
+
+def disc_scan_tracks(lines):
+    """Parse the track summaries of an eac3to disc scan, by playlist.
+
+    Returns a dict mapping playlist ids to 'N: description' lines, as in
+    a playlist scan (the ids are made up).
+    """
+    tracks = {}
+    current = None
+    for line in lines:
+        m = re.match(r'(?P<id>[0-9]+)\) ', line)
+        if m:
+            current = int(m.group('id'))
+            tracks[current] = []
+            continue
+        m = re.match(r' +- (?P<description>.*)$', line)
+        if m and current is not None:
+            tracks[current].append('%d: %s' % (len(tracks[current]) + 1,
+                                                m.group('description')))
+    return tracks
+
+def estimate_track_bytes(kind, description, seconds):
+    m = re.search(r'(?P<kbps>[0-9]+)kbps', description)
+    if m and kind != 'wav':
+        kbps = int(m.group('kbps'))
+    else:
+        kbps = ESTIMATED_KBPS[kind]
+        if kind in ['lossless', 'wav']:
+            m = re.search(r'(?P<main>[1-7])\.(?P<lfe>[0-2]) channels', description)
+            if m:
+                kbps *= int(m.group('main')) + int(m.group('lfe'))
+            else:
+                kbps *= 6
+    return kbps * 1000 / 8 * seconds
+
+def estimate_playlist(settings, track_lines, seconds):
+    """Estimate the bytes a playlist's tracks take on scratch, and the
+    bytes its mkv takes, as (scratch, mkv)."""
+    if not track_lines:
+        nbytes = ESTIMATED_PLAYLIST_KBPS * 1000 / 8 * seconds
+        return nbytes, nbytes
+    languages = settings['soundtrack_languages']
+    tracks = track_classifier(settings['track_rules']).classify(track_lines)
+    outputs = []
+    for track in video_tracks(tracks):
+        outputs.append(('video', track['description'], '.mkv'))
+    for track in lossless_audio_tracks(tracks, languages):
+        for output in soundtrack_outputs(settings['profile'], track['description']):
+            if output == 'flac':
+                outputs.append(('lossless', track['description'], '.flac'))
+                if settings.get('flac_jobs') or settings.get('job_dir'):
+                    outputs.append(('wav', track['description'], '.wav'))
+            elif re.match(r'DTS', track['description']):
+                outputs.append(('lossless', track['description'], '.dts'))
+            elif re.match(r'TrueHD', track['description']):
+                outputs.append(('lossless', track['description'], '.thd'))
+    for track in lossy_audio_tracks(tracks):
+        outputs.append(('lossy', track['description'],
+                        re.match(r'AC3', track['description']) and '.ac3' or '.dts'))
+    for track in subtitle_tracks(tracks):
+        outputs.append(('subtitles', track['description'], '.sup'))
+    scratch = mkv = 0
+    streaming = settings['stream'] and settings['mkvmerge']
+    for (kind, description, ext) in outputs:
+        nbytes = estimate_track_bytes(kind, description, seconds)
+        if kind != 'wav':
+            mkv += nbytes
+        if streaming and ext in settings['stream_formats']:
+            # Only the first of these is streamed.
+            streaming = False
+        else:
+            scratch += nbytes
+    return scratch, mkv
+
+def _existing_dir(path):
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def volume(path):
+    """Identify the volume holding ``path``."""
+    path = _existing_dir(os.path.abspath(path))
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return drive.upper()
+    return 'dev%d' % os.stat(path).st_dev
+
+def free_space(path):
+    """Return the bytes free on the volume holding ``path``, or None."""
+    path = _existing_dir(os.path.abspath(path))
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(path)
+        return st.f_bavail * st.f_frsize
+    try:
+        import ctypes
+        free = ctypes.c_ulonglong(0)
+        if ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path),
+                                                      ctypes.byref(free), None, None):
+            return free.value
+    except (ImportError, AttributeError):
+        pass
+    return None
 
-def chapter_tracks(track_list):
-    return find_track_matches(r'(?P<id>[0-9]+:) (?P<description>Chapters, .*)',
-                              track_list)
+def _dir_size(path):
+    total = 0
+    if os.path.isdir(path):
+        for fn in os.listdir(path):
+            if os.path.isfile(os.path.join(path, fn)):
+                total += os.path.getsize(os.path.join(path, fn))
+    return total
 
-def video_tracks(track_list):
-    all_tracks = find_track_matches(r'(?P<id>[0-9]+:) (?P<description>h264/AVC, 1080p24 /1.001 \(16:9\)$)', track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>h264/AVC, 1080i50 \(16:9\)$)', track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>VC-1, 1080p24 /1.001 \(16:9\)$)', track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>MPEG2, 1080p24 /1.001 \(16:9\)$)', track_list)
-    return all_tracks
+def space_needed(settings, disc_scan, playlists, concurrency, prefetched=None):
+    """Estimate the space a job needs, as a dict mapping volumes to
+    (a directory on the volume, bytes). ``prefetched`` are the files to
+    be copied to the disc's mirror, if any."""
+    summaries = disc_scan_tracks(disc_scan['lines'])
+    durations = dict(disc_scan['playlists'])
+    scratch = []
+    mkvs = 0
+    for pl in playlists:
+        tracks, mkv = estimate_playlist(settings, summaries.get(pl),
+                                        duration_seconds(durations[pl]))
+        # Whatever an earlier run left in the demux directory is
+        # already on disk.
+        done = _dir_size(playlist_dir(settings, pl))
+        scratch.append(max(tracks - done, 0))
+        mkvs += mkv
+    if settings['cleanup'] and settings['mkvmerge']:
+        # Tracks are removed once they've been muxed, so only the
+        # playlists in progress at the same time need room for theirs.
+        scratch = sorted(scratch, reverse=True)[:concurrency]
+    needs = {}
+    def need(path, nbytes):
+        key = volume(path)
+        needs[key] = (path, needs.get(key, (path, 0))[1] + nbytes)
+    need(settings['work_dir'], sum(scratch))
+    for (_, dest, size) in prefetched or []:
+        if not (os.path.isfile(dest) and os.path.getsize(dest) == size):
+            need(settings['work_dir'], size)
+    if settings['mkvmerge']:
+        need(settings['output_dir'] or settings['work_dir'], mkvs)
+    return dict([(key, (path, int(nbytes * SPACE_MARGIN)))
+                 for (key, (path, nbytes)) in needs.items() if nbytes])
 
-def lossless_audio_tracks(track_list, languages=[r'English']):
-    all_tracks = find_track_matches(r'(?P<id>[0-9]+:) (?P<description>DTS Master Audio, .*)',
-                                    track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>TrueHD/AC3, .*)',
-                                    track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>RAW/PCM, .*)',
-                                     track_list)
-    return filter_by(languages, all_tracks)
+def reserve_space(settings, needs):
+    """Check (or, in a batch, reserve) the space a job needs.
 
-def lossy_audio_tracks(track_list, languages=[r'English'], channels=[r'[12]\.0']):
-    all_tracks = find_track_matches(r'(?P<id>[0-9]+:) (?P<description>AC3, .*)', track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>AC3 Surround, .*)', track_list)
-    all_tracks += find_track_matches(r'(?P<id>[0-9]+:) (?P<description>DTS, .*)', track_list)
-    return filter_by(channels, filter_by(languages, all_tracks))
-                      
-def subtitle_tracks(track_list, languages=['English']):
-    all_tracks = find_track_matches(r'(?P<id>[0-9]+:) (?P<description>Subtitle \(PGS\), .*)',
-                                    track_list)
-    return filter_by(languages, all_tracks)
+    Returns False, having logged why, if the job won't fit.
+    """
+    for key, (path, nbytes) in sorted(needs.items()):
+        free = free_space(path)
+        logger.info("Estimated space needed on %s: %s (%s free)" \
+                        % (path, format_size(nbytes),
+                           free is None and 'unknown' or format_size(free)))
+    resources = settings.get('resources')
+    if resources is not None:
+        return resources.reserve_space(needs, settings['name'])
+    for key, (path, nbytes) in needs.items():
+        free = free_space(path)
+        if free is not None and free < nbytes:
+            logger.error("Not enough space on %s: %s needed, %s free; aborting." \
+                             % (path, format_size(nbytes), format_size(free)))
+            return False
+    return True
 
-@contextlib.contextmanager
-def chdir(dirname=None):
-    curdir = os.getcwd()
+def release_space(settings):
+    if settings.get('resources') is not None:
+        settings['resources'].release_space(settings['name'])
+
+#
+# Duplicate playlists.
+#
+# Blu-rays often have several playlists made of the same clips: the
+# same title listed twice, or a 'play all' playlist next to the
+# episodes it strings together. The disc scan says which clips each
+# playlist plays, in order, so with --skip-duplicates a selected
+# playlist is left out if it plays exactly the clips of another one,
+# or exactly the clips of several others one after the other. Any
+# other playlist is kept, even if other playlists play all of its
+# clips between them: the theatrical cut of a film may be made of
+# clips of the extended cut, and an extended cut may only add a clip
+# found elsewhere on the disc, but both are titles of their own.
+#
+
+def disc_scan_clips(lines):
+    """Parse the clips of each playlist in an eac3to disc scan.
+
+    Returns a dict mapping playlist ids to lists of clip numbers, in
+    playing order. eac3to lists a single clip on the playlist's line
+    ('2) 00801.mpls, 00040.m2ts, 0:02:31'), and several on the line
+    after it ('[33+34+35+36].m2ts').
+    """
+    clips = {}
+    current = None
+    for line in lines:
+        m = re.match(r'(?P<id>[0-9]+)\) [^,]*\.mpls, (?:(?P<clip>[0-9]+)\.m2ts, )?', line)
+        if m:
+            current = int(m.group('id'))
+            if m.group('clip'):
+                clips[current] = [int(m.group('clip'))]
+            continue
+        m = re.match(r' +\[?(?P<clips>[0-9]+(?:\+[0-9]+)*)\]?\.m2ts$', line)
+        if m and current is not None and current not in clips:
+            clips[current] = [int(clip) for clip in m.group('clips').split('+')]
+    return clips
+
+def _concatenation(sequence, parts):
+    """Split ``sequence`` into two or more of ``parts`` (a dict of clip
+    lists) played one after the other; return their keys, or None."""
+    # splits[i] is a way to make up sequence[:i], as a list of keys.
+    splits = {0: []}
+    for i in range(len(sequence)):
+        if i not in splits:
+            continue
+        for key, part in parts.items():
+            if part and sequence[i:i + len(part)] == part and i + len(part) not in splits:
+                splits[i + len(part)] = splits[i] + [key]
+    found = splits.get(len(sequence))
+    if found is None or len(found) < 2:
+        return None
+    return found
+
+def redundant_playlists(clips, playlists):
+    """Find the playlists in ``playlists`` that play the same clips, in
+    the same order, as another one, or as several others played one
+    after the other.
+
+    Of identical playlists, the first one is kept. Playlists with the
+    most clips are looked at first, so a 'play all' playlist goes rather
+    than its episodes. Returns a dict mapping each redundant playlist to
+    the kept playlists that play its clips. Playlists whose clips
+    aren't known are always kept.
+    """
+    kept = [pl for pl in playlists if pl in clips]
+    redundant = {}
+    for pl in list(kept):
+        for other in kept[:kept.index(pl)]:
+            if clips[other] == clips[pl]:
+                kept.remove(pl)
+                redundant[pl] = [other]
+                break
+    for pl in sorted(kept, key=lambda pl: (-len(clips[pl]), kept.index(pl))):
+        parts = _concatenation(clips[pl], dict([(other, clips[other]) for other in kept
+                                                if other != pl]))
+        if parts is not None:
+            kept.remove(pl)
+            redundant[pl] = sorted(set(parts), key=parts.index)
+    return redundant
+
+def skip_duplicate_playlists(settings, disc_scan, playlists, skip):
+    """Report the redundant playlists among ``playlists``, and return the
+    playlists to demux: without the redundant ones if ``skip`` is set."""
+    clips = disc_scan_clips(disc_scan['lines'])
+    redundant = redundant_playlists(clips, playlists)
+    if not redundant:
+        return playlists
+    summaries = disc_scan_tracks(disc_scan['lines'])
+    durations = dict(disc_scan['playlists'])
+    avoided = 0
+    for pl in sorted(redundant):
+        if clips[pl] == clips[redundant[pl][0]]:
+            logger.info("Playlist %d) plays the same clips as playlist %d)" \
+                            % (pl, redundant[pl][0]))
+        else:
+            logger.info("Playlist %d) plays the clips of playlists %s one after the other" \
+                            % (pl, ', '.join(['%d)' % other for other in redundant[pl]])))
+        avoided += estimate_playlist(settings, summaries.get(pl),
+                                     duration_seconds(durations[pl]))[1]
+    if not skip:
+        logger.info("Use --skip-duplicates to leave them out (about %s less to extract)." \
+                        % format_size(avoided))
+        return playlists
+    logger.info("Skipping %s; about %s less to extract." \
+                    % (', '.join(['%d)' % pl for pl in sorted(redundant)]),
+                       format_size(avoided)))
+    return [pl for pl in playlists if pl not in redundant]
+
+#
+# Prefetching.
+#
+# Optical drives are slow to seek, and eac3to reads each playlist's
+# clips separately, so demuxing several playlists straight from a disc
+# keeps the drive seeking. With --prefetch, the files the selected
+# playlists need (their .mpls, and the .clpi and .m2ts of every clip
+# they play) are first copied to a mirror of the BDMV structure on the
+# scratch volume, in one pass, in clip order and with large sequential
+# reads. eac3to then extracts from the playlist files in the mirror.
+# Scans still come from the disc (or the scan cache), so the playlist
+# numbers don't change. The mirror is removed once the playlists have
+# been demuxed.
+#
+PREFETCH_CHUNK = 8 * 1024 * 1024
+
+def disc_scan_mpls(lines):
+    """Parse the playlist file of each playlist in an eac3to disc scan."""
+    mpls = {}
+    for line in lines:
+        m = re.match(r'(?P<id>[0-9]+)\) (?P<mpls>[^,]*\.mpls), ', line)
+        if m:
+            mpls[int(m.group('id'))] = m.group('mpls')
+    return mpls
+
+def mirror_dir(settings):
+    return os.path.join(settings['work_dir'], '%s.mirror' % settings['name'])
+
+def _find_file(directory, name):
+    # Disc filesystems don't agree on case.
     try:
-        if dirname is not None:
-            os.chdir(dirname)
-        yield
+        for fn in os.listdir(directory):
+            if fn.lower() == name.lower():
+                return os.path.join(directory, fn)
+    except OSError:
+        pass
+    return None
+
+def prefetch_files(settings, disc_scan, playlists):
+    """List the files to prefetch for ``playlists``.
+
+    Returns a list of (file on the disc, file in the mirror, size), in
+    the order to copy them, or None (having logged why at debug level)
+    if they can't all be found.
+    """
+    bdmv = bdmv_dir(settings['path'])
+    if bdmv is None:
+        logger.debug("No BDMV structure in %s" % settings['path'])
+        return None
+    mpls = disc_scan_mpls(disc_scan['lines'])
+    clips = disc_scan_clips(disc_scan['lines'])
+    wanted = []
+    for pl in playlists:
+        if pl not in mpls or pl not in clips:
+            logger.debug("The disc scan doesn't say which clips playlist %d) plays" % pl)
+            return None
+        wanted.append(('PLAYLIST', mpls[pl]))
+    played = sorted(set([clip for pl in playlists for clip in clips[pl]]))
+    wanted += [('CLIPINF', '%05d.clpi' % clip) for clip in played]
+    wanted += [('STREAM', '%05d.m2ts' % clip) for clip in played]
+    files = []
+    for (subdir, name) in wanted:
+        source = _find_file(os.path.join(bdmv, subdir), name)
+        if source is None:
+            logger.debug("Can't find %s in %s" % (name, os.path.join(bdmv, subdir)))
+            return None
+        files.append((source, os.path.join(mirror_dir(settings), 'BDMV', subdir,
+                                           os.path.basename(source)),
+                      os.path.getsize(source)))
+    return files
+
+def copy_sequential(source, dest, chunk=PREFETCH_CHUNK):
+    """Copy ``source`` to ``dest`` in reads of ``chunk`` bytes."""
+    fin = open(source, 'rb', 0)
+    try:
+        fout = open(dest, 'wb', 0)
+        try:
+            while True:
+                data = fin.read(chunk)
+                if not data:
+                    break
+                fout.write(data)
+        finally:
+            fout.close()
     finally:
-        os.chdir(curdir)
+        fin.close()
+
+def prefetch_clips(settings, files):
+    """Copy ``files`` (as returned by prefetch_files()) into the mirror.
+
+    Files an earlier run already copied are kept. Returns True if
+    everything was copied.
+    """
+    total = sum([size for (_, _, size) in files])
+    logger.info("Prefetching %d files (%s) to %s" \
+                    % (len(files), format_size(total), mirror_dir(settings)))
+    copied = 0
+    with traced(settings, 'prefetch', None, [dest for (_, dest, _) in files]) as span:
+        started = time.time()
+        try:
+            with holding(settings, 'drive'):
+                for (source, dest, size) in files:
+                    if os.path.isfile(dest) and os.path.getsize(dest) == size:
+                        continue
+                    if not os.path.isdir(os.path.dirname(dest)):
+                        os.makedirs(os.path.dirname(dest))
+                    copy_sequential(source, dest)
+                    copied += size
+        except (IOError, OSError), e:
+            logger.error("Prefetching failed: %s" % e)
+            span['status'] = 1
+            return False
+        elapsed = time.time() - started
+        span['read_bytes'] = copied
+    if copied < total:
+        logger.info("%s had already been prefetched." % format_size(total - copied))
+    logger.info("Read %s from the disc in %s (%s/s)" \
+                    % (format_size(copied), format_duration(elapsed),
+                       format_size(copied / max(elapsed, 0.001))))
+    return True
+
+def evict_mirror(settings):
+    if os.path.isdir(mirror_dir(settings)):
+        logger.info("Removing prefetched files in %s" % mirror_dir(settings))
+        shutil.rmtree(mirror_dir(settings), ignore_errors=True)
+
+#
+# Planning.
+#
+# Every successful prefetch, extract, mux and verify phase of a run is
+# appended to a history file in the cache directory (as a trace span).
+# With --plan, nothing is extracted or muxed: the playlists are scanned
+# and planned as usual, and each track's size is estimated the way the
+# disk-space preflight does it. The time each phase will take is that
+# size over the phase's throughput in the most recent runs, or over a
+# typical throughput when there's no history yet. For a batch, the plan
+# also estimates how long the whole batch takes with --jobs discs at a
+# time (each drive reading one disc at a time), and whether the output
+# fits.
+#
+HISTORY_FILE = 'history.jsonl'
+# How many spans of each phase the cost model looks at, and how many
+# the history file keeps.
+HISTORY_SPANS = 50
+HISTORY_MAX_LINES = 2000
+
+# Typical throughput of each phase, in bytes (written) per second.
+COST_PHASES = {'prefetch': 20 * 1024 * 1024,
+               'extract': 25 * 1024 * 1024,
+               'mux': 100 * 1024 * 1024,
+               'verify': 500 * 1024 * 1024}
+
+# The track kinds of the groups in a plan.
+GROUP_KINDS = {'chapters': 'chapters',
+               'videos': 'video',
+               'soundtracks': 'lossless',
+               'commentaries': 'lossy',
+               'subtitles': 'subtitles'}
+
+_history_lock = threading.Lock()
 
-def test_run(binexec, args=[]):
+def record_history(filename, span):
+    _history_lock.acquire()
     try:
-        _ = subprocess.check_output([binexec] + args,
-                                    stderr=subprocess.STDOUT)
-        return True
-    except:
-        return False
+        try:
+            f = open(filename, 'a')
+            try:
+                f.write(json.dumps(span) + '\n')
+            finally:
+                f.close()
+        except IOError, e:
+            logger.warning("Can't record run history: %s" % e)
+    finally:
+        _history_lock.release()
+
+def trim_history(filename, max_lines=HISTORY_MAX_LINES):
+    """Drop all but the last ``max_lines`` spans of a history file."""
+    try:
+        f = open(filename)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+        if len(lines) <= max_lines:
+            return
+        f = open(filename, 'w')
+        try:
+            f.writelines(lines[-max_lines:])
+        finally:
+            f.close()
+    except IOError:
+        pass
+
+class CostModel(object):
+    """Phase throughputs, from the spans of earlier runs."""
+
+    def __init__(self, spans=()):
+        by_phase = {}
+        for span in spans:
+            if span.get('phase') in COST_PHASES and span.get('bytes') and span.get('wall'):
+                by_phase.setdefault(span['phase'], []).append(span)
+        self.rates = {}
+        self.runs = {}
+        for phase, default in COST_PHASES.items():
+            recent = by_phase.get(phase, [])[-HISTORY_SPANS:]
+            self.runs[phase] = len(recent)
+            if recent:
+                self.rates[phase] = sum([span['bytes'] for span in recent]) \
+                    / sum([span['wall'] for span in recent])
+            else:
+                self.rates[phase] = float(default)
+
+    def seconds(self, phase, nbytes):
+        return nbytes / self.rates[phase]
+
+    def describe(self):
+        return ', '.join(['%s %s/s (%s)' % (phase, format_size(self.rates[phase]),
+                                             self.runs[phase] and '%d earlier' % self.runs[phase]
+                                             or 'typical')
+                          for phase in sorted(COST_PHASES)])
+
+def load_cost_model(filename):
+    """Return the cost model for a history file (which may not exist)."""
+    spans = []
+    try:
+        f = open(filename)
+        try:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    pass
+        finally:
+            f.close()
+    except (IOError, TypeError):
+        pass
+    return CostModel(spans)
+
+def schedule(tasks, slots):
+    """Estimate when a list of tasks finishes on ``slots`` workers.
+
+    Tasks are (name, drive, drive seconds, other seconds); the longest
+    go first, each on the worker that's free soonest. A task holds its
+    drive (if it has one) for its drive seconds, so tasks on the same
+    drive read one after the other. Returns the makespan in seconds.
+    """
+    free = [0.0] * max(slots, 1)
+    drives = {}
+    for (name, drive, drive_seconds, other_seconds) in \
+            sorted(tasks, key=lambda t: t[2] + t[3], reverse=True):
+        slot = free.index(min(free))
+        start = free[slot]
+        if drive is not None:
+            start = max(start, drives.get(drive, 0.0))
+            drives[drive] = start + drive_seconds
+        free[slot] = start + drive_seconds + other_seconds
+    return max(free)
+
+def estimate_plan(settings, plan, model):
+    """Estimate the output and costs of a planned playlist."""
+    seconds = duration_seconds(plan['duration'])
+    tracks = []
+    for group in TRACK_GROUPS:
+        for track in plan[group]:
+            nbytes = estimate_track_bytes(GROUP_KINDS[group], track['description'], seconds)
+            tracks.append({'id': track['id'], 'filename': track['filename'],
+                           'kind': GROUP_KINDS[group], 'bytes': int(nbytes),
+                           'seconds': model.seconds('extract', nbytes)})
+    nbytes = sum([track['bytes'] for track in tracks])
+    estimate = {'playlist': plan['playlist'],
+                'duration': plan['duration'],
+                'tracks': tracks,
+                'eac3to': plan['eac3to_command'],
+                'mkvmerge': mkvmerge_options(plan),
+                'bytes': nbytes,
+                'extract_seconds': model.seconds('extract', nbytes),
+                'mux_seconds': 0,
+                'verify_seconds': 0}
+    if settings['mkvmerge']:
+        estimate['mux_seconds'] = model.seconds('mux', nbytes)
+    if settings.get('verify'):
+        estimate['verify_seconds'] = model.seconds('verify', nbytes)
+    return estimate
+
+def plan_job(settings, plans, jobs, pipeline, prefetched, model):
+    """Estimate a job's planned playlists without demuxing them.
+
+    Returns the job's estimate.
+    """
+    logger.info("Cost model: %s" % model.describe())
+    estimates = [estimate_plan(settings, plan, model) for plan in plans]
+
+    logger.info('')
+    prefetch_seconds = 0
+    if prefetched:
+        nbytes = sum([size for (_, _, size) in prefetched])
+        prefetch_seconds = model.seconds('prefetch', nbytes)
+        logger.info("Prefetch: %s, %s" % (format_size(nbytes), format_duration(prefetch_seconds)))
+    for estimate in estimates:
+        logger.info("Playlist %d) (%s):" % (estimate['playlist'], estimate['duration']))
+        for track in estimate['tracks']:
+            logger.info("  %-20s %-10s %10s %10s" % (track['filename'], track['kind'],
+                                                     format_size(track['bytes']),
+                                                     format_duration(track['seconds'])))
+        logger.info("  eac3to: %s" % ' '.join(estimate['eac3to']))
+        logger.info("  %s; extract %s, mux %s" \
+                        % (format_size(estimate['bytes']),
+                           format_duration(estimate['extract_seconds']),
+                           format_duration(estimate['mux_seconds'] + estimate['verify_seconds'])))
+
+    extract = [e['extract_seconds'] for e in estimates]
+    rest = [e['mux_seconds'] + e['verify_seconds'] for e in estimates]
+    if jobs > 1 and len(estimates) > 1:
+        seconds = schedule([(e['playlist'], None, e['extract_seconds'],
+                             e['mux_seconds'] + e['verify_seconds']) for e in estimates], jobs)
+    elif pipeline or settings.get('verify'):
+        # Muxing (and verifying) overlaps the next extraction.
+        seconds = max(sum(extract) + rest[-1], extract[0] + sum(rest))
+    else:
+        seconds = sum(extract) + sum(rest)
+    seconds += prefetch_seconds
+    logger.info('')
+    log_profile_costs(settings, plans)
+    logger.info("Estimated time for %s: %s" % (settings['name'], format_duration(seconds)))
+    return {'name': settings['name'],
+            'drive': settings.get('drive'),
+            'prefetch_seconds': prefetch_seconds,
+            'drive_seconds': prefetch_seconds + sum(extract),
+            'seconds': seconds,
+            'profile': settings['profile']['name'],
+            'profiles': dict([(name, {'bytes': int(nbytes), 'cpu_seconds': cpu})
+                              for (name, nbytes, cpu) in profile_costs(settings, plans)]),
+            'playlists': estimates}
+
+def write_plan(filename, plan):
+    f = open(filename, 'w')
+    try:
+        json.dump(plan, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+#
+# Options.
+#
+# demux() takes its options as one dict. main() builds it once from the
+# command line and the config file, and passes it as it is to a single
+# run, or as the defaults of every job in a batch (which the manifest
+# can override; see JOB_OPTIONS). Options that aren't given take the
+# values below. A new option goes here, into main() and, if a batch job
+# can set it, into JOB_OPTIONS.
+#
+DEMUX_OPTIONS = {'eac3to': 'eac3to',
+                 'mkvmerge': 'mkvmerge',
+                 # The disc, and the name of its mkvs; required.
+                 'path': None,
+                 'name': None,
+                 'output_dir': None,
+                 'scratch_dir': None,
+                 'cleanup': False,
+                 'verify': False,
+                 'playlist_indexes': None,
+                 'soundtrack_languages': ['English'],
+                 'default_audio_track': None,
+                 'jobs': 1,
+                 'pipeline': False,
+                 'use_cache': True,
+                 'cache_dir': None,
+                 'refresh_cache': False,
+                 'cache_max_size': 64 * 1024 * 1024,
+                 'cache_max_age': 90 * 24 * 3600,
+                 'extra_track_rules': None,
+                 'progress_json': None,
+                 'trace': None,
+                 'flac': None,
+                 'flac_jobs': 0,
+                 'flac_compression': 8,
+                 'stream': False,
+                 'stream_formats': DEFAULT_STREAM_FORMATS,
+                 'preflight': True,
+                 'skip_duplicates': False,
+                 'skip_invalid': False,
+                 'scan_jobs': PRESCAN_JOBS,
+                 'prefetch': False,
+                 'job_dir': None,
+                 'sample': None,
+                 'profile': DEFAULT_PROFILE,
+                 'profiles': PROFILES,
+                 # Set for batch jobs (see the Batch mode comment below).
+                 'resources': None,
+                 'drive': None,
+                 # A list to append the job's plan to, with --plan.
+                 'estimates': None}
+
+def demux(options):
+    """Demux playlists of the disc at options['path'] into mkvs named
+    options['name']. ``options`` is a dict of DEMUX_OPTIONS (see the
+    Options comment above).
+
+    If options['estimates'] is a list, nothing is extracted or muxed:
+    the job's plan and estimated costs are appended to it (see the
+    Planning comment above). Returns 0 on success, otherwise a non-zero
+    exit status.
+    """
+    unknown = sorted(set(options) - set(DEMUX_OPTIONS))
+    if unknown:
+        raise TypeError("Unknown demux() options: %s" % ', '.join(unknown))
+    options = dict(DEMUX_OPTIONS, **options)
+    if options['path'] is None or options['name'] is None:
+        raise TypeError("demux() needs a path and a name")
+    jobs, pipeline = options['jobs'], options['pipeline']
+    preflight, prefetch = options['preflight'], options['prefetch']
+    estimates = options['estimates']
+
+    settings = {'eac3to': options['eac3to'],
+                'mkvmerge': options['mkvmerge'],
+                'output_dir': options['output_dir'] and os.path.abspath(options['output_dir']),
+                'cleanup': options['cleanup'],
+                'path': source_path(options['path']),
+                'name': options['name'],
+                'soundtrack_languages': options['soundtrack_languages'],
+                'default_audio_track': options['default_audio_track'],
+                'work_dir': os.path.abspath(options['scratch_dir'] or os.getcwd()),
+                'scan_cache': None,
+                'track_rules': track_rules(options['extra_track_rules']),
+                'progress_json': options['progress_json'],
+                'resources': options['resources'],
+                'drive': options['drive'],
+                'flac': options['flac'],
+                'flac_jobs': options['flac_jobs'],
+                'flac_compression': options['flac_compression'],
+                'stream': options['stream'],
+                'stream_formats': options['stream_formats'],
+                'trace': options['trace'],
+                'verify': options['verify'] and bool(options['mkvmerge']),
+                'job_dir': options['job_dir'] and os.path.abspath(options['job_dir']),
+                'sample': options['sample'],
+                'profile': dict(options['profiles'][options['profile']], name=options['profile']),
+                'profiles': options['profiles']}
+
+    if options['stream'] and not hasattr(os, 'mkfifo'):
+        logger.warning("Named pipes aren't available here; extracting every track to disk.")
+        settings['stream'] = False
+    if options['stream'] and options['job_dir']:
+        logger.warning("Remote workers can't read named pipes; extracting every track to disk.")
+        settings['stream'] = False
+    if options['sample']:
+        # Samples are small and made one at a time, by eac3to alone
+        # (see the Samples comment above).
+        preflight = prefetch = False
+
+    # The tools are probed while the disc is being scanned. With
+    # --job-dir, mkvmerge and flac are run by the workers (though
+    # --verify still runs mkvmerge here).
+    tools = [('eac3to', options['eac3to'])]
+    if options['mkvmerge'] and (options['verify'] or not options['job_dir']):
+        tools.append(('mkvmerge', options['mkvmerge']))
+    if options['flac_jobs'] and not options['job_dir']:
+        tools.append(('flac', options['flac']))
+    wait_for_probes = start_tool_probes(settings, tools,
+                                        options['use_cache'] and options['cache_dir'])
 
-def demux(eac3to, mkvmerge, output_dir, cleanup, path, name, playlist_indexes=None, soundtrack_languages=['English'], default_audio_track=None):
-    if not test_run(eac3to):
-        logger.error("Can't execute eac3to; use --eac3to to specify the path.")
-        return 1
-    if mkvmerge and not test_run(mkvmerge, ["-V"]):
-        logger.error("Can't execute mkvmerge; use --mkvmerge to specify the path.")
-        return 1
-    
     #
     # Scan for playlists.
     #
-    logger.info('Scanning playlists in %s' % path)
+    if options['use_cache']:
+        cache = open_scan_cache(options['cache_dir'], options['path'], options['eac3to'],
+                                options['refresh_cache'], options['cache_max_size'],
+                                options['cache_max_age'])
+    else:
+        cache = None
+    settings['scan_cache'] = cache
+    history = None
+    if options['use_cache'] and options['cache_dir']:
+        history = os.path.join(options['cache_dir'], HISTORY_FILE)
+        if estimates is None:
+            try:
+                if not os.path.isdir(options['cache_dir']):
+                    os.makedirs(options['cache_dir'])
+                trim_history(history)
+                settings['history'] = history
+            except OSError, e:
+                logger.warning("Can't record run history in %s: %s" % (options['cache_dir'], e))
+
+    logger.info('Scanning playlists in %s' % options['path'])
     try:
-        scan_output = subprocess.check_output([eac3to, path],
-                                              stderr=subprocess.STDOUT)
+        with traced(settings, 'disc scan'):
+            with holding(settings, 'drive'):
+                disc_scan = eac3to_scan(options['eac3to'], options['path'], cache=cache,
+                                        on_event=progress_callback(settings, None))
     except:
-        logger.error("%s doesn't appear to be a valid Blu-ray structure." \
-                         % path)
+        if check_tools(wait_for_probes()):
+            logger.error("%s doesn't appear to be a valid Blu-ray structure." \
+                             % options['path'])
         return 1
-    lines = [line.strip('\x08').rstrip(' ') for line in \
-                 scan_output.split('\r\n')]
-    playlist_ids = []
-    durations = []
-    for line in lines:
-        m = re.match(r'(?P<id>[0-9]+)\) .*, (?P<duration>[0-9]:[0-9][0-9]:[0-9][0-9])$', line)
-        if m:
-            playlist_ids.append(int(m.group('id')))
-            durations.append(m.group('duration'))
+    settings['tools'] = wait_for_probes()
+    if not check_tools(settings['tools']):
+        return 1
+    if settings['stream'] and settings['mkvmerge'] and \
+            not (settings['tools'].get('mkvmerge') or {}).get('fifo'):
+        logger.warning("%s can't read tracks from named pipes; extracting every track to disk." \
+                           % options['mkvmerge'])
+        settings['stream'] = False
+    playlist_ids = [pl for (pl, dur) in disc_scan['playlists']]
+    settings['durations'] = dict(disc_scan['playlists'])
+    durations = [dur for (pl, dur) in disc_scan['playlists']]
     if not playlist_ids:
         logger.error("Can't parse eac3to output, aborting.")
         return 1
@@ -139,15 +3901,15 @@ def demux(eac3to, mkvmerge, output_dir, cleanup, path, name, playlist_indexes=No
     # Select playlist(s) for demuxing.
     #
     demux_playlists = []
-    if playlist_indexes:
-        if playlist_indexes == "all":
+    if options['playlist_indexes']:
+        if options['playlist_indexes'] == "all":
             demux_playlists = playlist_ids
         else:
-            for idx in playlist_indexes:
+            for idx in options['playlist_indexes']:
                 if idx not in playlist_ids:
                     logger.error("There is no playlist %d, aborting." % idx)
                     return 1
-            demux_playlists = playlist_indexes
+            demux_playlists = options['playlist_indexes']
     else:
         #
         # Sort playlists by duration, choose the longest one.
@@ -161,251 +3923,471 @@ def demux(eac3to, mkvmerge, output_dir, cleanup, path, name, playlist_indexes=No
             logger.info("Automatically demuxing the longest playlist (%d)" \
                              % zipped[0][0])
 
-    for current_playlist in demux_playlists:
-        current_default_audio_track = default_audio_track
-        demux_dir = "%s.playlist_%02d" % (name, current_playlist)
-        if not os.path.isdir(demux_dir):
-            os.mkdir(demux_dir)
-        os.chdir(demux_dir)
-        logger.info("\nScanning playlist %d)" % current_playlist)
-        try:
-            pl_output = subprocess.check_output([eac3to,
-                                                 path,
-                                                 "%d)" % current_playlist],
-                                                stderr=subprocess.STDOUT)
-        except:
-            logger.error("Can't parse playlist %d)" % current_playlist)
-            return 1
-        logger.info(pl_output)
+    if len(demux_playlists) > 1:
+        demux_playlists = skip_duplicate_playlists(settings, disc_scan, demux_playlists,
+                                                   options['skip_duplicates'])
+    settings['several_playlists'] = len(demux_playlists) > 1
+    if jobs > 1 and options['resources'] is not None:
+        # Worker processes can't share the batch's resource slots.
+        logger.info("Ignoring --jobs in batch mode.")
+        jobs = 1
 
-        #
-        # Select tracks to extract.
-        #
-        tracks = [line.strip('\x08').rstrip(' ') for line in \
-                      pl_output.split('\r\n')]
-        chapters = chapter_tracks(tracks)
-        videos = video_tracks(tracks)
-        lossless = lossless_audio_tracks(tracks, soundtrack_languages)
-        commentaries = lossy_audio_tracks(tracks)
-        subtitles = subtitle_tracks(tracks)
-
-        # Sanity checks for required tracks.
-        if not chapters:
-            logger.error("No chapter tracks found, aborting.")
-            return 1
-        if len(chapters) > 1:
-            logger.error("There's more than one chapter track, aborting.")
-            return 1
-        if not videos:
-            logger.error("No feature video tracks found, aborting.")
-            return 1
-        if len(videos) > 1:
-            logger.error("There's more than one feature video track, aborting.")
+    #
+    # Scan and check every selected playlist before extracting any.
+    #
+    plans, problems = prescan_playlists(settings, demux_playlists, options['scan_jobs'])
+    if problems:
+        if not report_problems(problems, demux_playlists, options['skip_invalid']):
             return 1
-        if not lossless:
-            logger.error("No lossless soundtracks selected, aborting.")
+        demux_playlists = [plan['playlist'] for plan in plans]
+    if estimates is None:
+        for profile_name, nbytes, cpu in profile_costs(settings, plans):
+            if profile_name == options['profile']:
+                logger.info("Using the %s profile (%s): about %s of tracks, %s of FLAC encoding" \
+                                % (profile_name,
+                                   ' + '.join(options['profiles'][profile_name]['audio']),
+                                   format_size(nbytes), format_duration(cpu)))
+
+    if jobs > 1 and len(demux_playlists) > 1:
+        concurrency = min(jobs, len(demux_playlists))
+    elif pipeline:
+        concurrency = 2
+    else:
+        concurrency = 1
+    if options['verify'] and not (jobs > 1 and len(demux_playlists) > 1):
+        # The last playlist is still being verified.
+        concurrency += 1
+    prefetched = None
+    if prefetch:
+        prefetched = prefetch_files(settings, disc_scan, demux_playlists)
+        if prefetched is None:
+            logger.warning("Can't tell which files to prefetch; reading from %s" % options['path'])
+    if estimates is not None:
+        job = plan_job(settings, plans, jobs, pipeline, prefetched,
+                       load_cost_model(history))
+        job['space'] = space_needed(settings, disc_scan, demux_playlists, concurrency,
+                                    prefetched)
+        estimates.append(job)
+        return 0
+    if preflight:
+        needs = space_needed(settings, disc_scan, demux_playlists, concurrency, prefetched)
+        if not reserve_space(settings, needs):
             return 1
+    try:
+        if prefetched is not None:
+            if not prefetch_clips(settings, prefetched):
+                return 1
+            mpls = disc_scan_mpls(disc_scan['lines'])
+            settings['mirror_playlists'] = \
+                dict([(pl, os.path.join(mirror_dir(settings), 'BDMV', 'PLAYLIST', mpls[pl]))
+                      for pl in demux_playlists])
+        if options['sample']:
+            rc = demux_sample(settings, plans)
+        elif jobs > 1 and len(demux_playlists) > 1:
+            # Longest playlists first, so a long feature doesn't end up
+            # running on its own after all the short ones have finished.
+            plans = sorted(plans, key=lambda plan: duration_seconds(plan['duration']),
+                           reverse=True)
+            rc = demux_parallel(settings, plans, jobs)
+        elif pipeline:
+            rc = demux_pipeline(settings, plans)
+        else:
+            rc = demux_serial(settings, plans)
+    finally:
+        if prefetched is not None:
+            evict_mirror(settings)
+        if preflight:
+            release_space(settings)
+    if rc:
+        return rc
 
-        # I always convert lossless tracks to FLAC.
-        soundtracks = []
-        FLACTAG = '(FLAC)'
-        for track in lossless:
-            soundtracks.append({'id' : track['id'],
-                                'description' : ' '.join([FLACTAG, track['description']])})
-            # I don't want RAW/PCM tracks, just the FLAC will do.
-            if re.match(r'RAW/PCM', track['description']):
-                pass
-            else:
-                soundtracks.append(track)
+    if problems:
+        logger.warning("Done, but skipped playlists %s." \
+                           % ', '.join(['%d)' % pl for pl in sorted(set([pl for (pl, _) in problems]))]))
+        return 0
+    logger.info('Done')
+    return 0
 
-        def log_tracks(track_type, tracks):
-            logger.info("  %s:" % track_type)
-            if not tracks:
-                logger.info("    none")
-            else:
-                for track in tracks:
-                    logger.info("    %s %s" % (track['id'], track['description']))
-            return
-        logger.info("Demuxing the following tracks:")
-        log_tracks("Chapters", chapters)
-        log_tracks("Video", videos)
-        log_tracks("Soundtracks", soundtracks)
-        log_tracks("Commentaries", commentaries)
-        log_tracks("Subtitles", subtitles)
-        logger.info('')
+#
+# Batch mode.
+#
+# A batch manifest is an ini file with one section per disc:
+#
+#   [Some Movie]
+#   path = D:
+#   playlist = 3
+#
+# Jobs run concurrently, but every I/O- or CPU-heavy step holds a slot
+# of a named resource while it runs: the disc's drive for scans and
+# extraction, a 'cpu' slot for extraction (which includes the FLAC
+# encoding) and a 'mux' slot for mkvmerge. So one disc can be muxing
+# while another is being read, without two jobs fighting over a drive.
+# Slot counts are set in the manifest's [resources] section.
+#
+class Resources(object):
+    """Named pools of slots, held by jobs while they use them.
 
-        #
-        # Map tracks to filenames for extraction.
-        #
-        def idnum(track):
-            return int(track['id'].rstrip(':'))
-        def add_option(track, option):
-            if 'eac3to args' in track:
-                track['eac3to args'] += [option]
-            else:
-                track['eac3to args'] = [option]
-
-        for track in chapters:
-            track['filename'] = '%02dchapters.txt' % idnum(track)
-        for track in videos:
-            track['filename'] = '%02dvideo.mkv' % idnum(track)
-        for track in soundtracks:
-            # XXX handle these more gracefully.
-            if re.search(r'strange setup', track['description']):
-                logger.error("Track %s is a 'strange setup', aborting." % track['id'])
-                return 1
+    Resources named in ``capacities`` get that many slots; any other
+    resource (e.g. 'drive:D:') gets ``default`` slots. The time each
+    owner spent waiting for slots is kept in ``waited``.
+    """
 
-            if re.match(r'\(FLAC\)', track['description']):
-                track['filename'] = '%02daudio.flac' % idnum(track)
-                track['format'] = 'FLAC'
-                if re.search(r'DTS Master Audio', track['description']) and re.search(r'6.1 channels', track['description']):
-                    logger.warning("Track %s is a DTS-MA 6.1 track, using Sonic decoder for it." % track['id'])
-                    add_option(track, '-sonic')
-            elif re.match(r'DTS Master Audio', track['description']):
-                track['filename'] = '%02daudio.dts' % idnum(track)
-                track['format'] = 'DTS-MA'
-            elif re.match(r'TrueHD', track['description']):
-                track['filename'] = '%02daudio.thd' % idnum(track)
-                track['format'] = 'TrueHD'
-            else:
-                # XXX handle these more gracefully
-                logger.error("Audio track %d has an unknown type: %s" % (track['id'], track['description']))
-                return 1
-            track['channels'] = re.search(r'(?P<channels>[1-7]\.[0-2] channels)', track['description']).group('channels')
-        for track in commentaries:
-            if re.match(r'AC3', track['description']):
-                track['filename'] = '%02dcommentary.ac3' % idnum(track)
-                track['format'] = 'AC3'
-            elif re.match(r'DTS', track['description']):
-                track['filename'] = '%02dcommentary.dts' % idnum(track)
-                track['format'] = 'DTS'
+    def __init__(self, capacities=None, default=1):
+        self.capacities = dict(capacities or {})
+        self.default = default
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.waited = {}
+        self.space_released = threading.Condition(self.lock)
+        self.reservations = {}
+
+    def _semaphore(self, name):
+        self.lock.acquire()
+        try:
+            if name not in self.semaphores:
+                self.semaphores[name] = \
+                    threading.Semaphore(self.capacities.get(name, self.default))
+            return self.semaphores[name]
+        finally:
+            self.lock.release()
+
+    @contextlib.contextmanager
+    def hold(self, names, owner=None):
+        # Always acquire in the same order, so that two jobs can't each
+        # hold a slot the other one is waiting for.
+        names = sorted(set(names))
+        started = time.time()
+        acquired = []
+        try:
+            for name in names:
+                semaphore = self._semaphore(name)
+                semaphore.acquire()
+                acquired.append(semaphore)
+            self.lock.acquire()
+            try:
+                self.waited[owner] = self.waited.get(owner, 0.0) + time.time() - started
+            finally:
+                self.lock.release()
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+    def reserve_space(self, needs, owner):
+        """Reserve disk space for ``owner``; see the Disk space comment.
+
+        ``needs`` is as returned by space_needed(). Returns False if
+        there isn't enough space, and no other job holds any of the
+        space that's missing.
+        """
+        started = time.time()
+        warned = False
+        self.space_released.acquire()
+        try:
+            while True:
+                short = []
+                for key, (path, nbytes) in needs.items():
+                    free = free_space(path)
+                    if free is None:
+                        continue
+                    # Other jobs' reservations are mostly still to be
+                    # written.
+                    reserved = sum([r.get(key, (None, 0))[1]
+                                    for (o, r) in self.reservations.items() if o != owner])
+                    if free - reserved < nbytes:
+                        short.append((key, path, nbytes, free - reserved))
+                if not short:
+                    self.reservations[owner] = needs
+                    self.waited[owner] = self.waited.get(owner, 0.0) + time.time() - started
+                    return True
+                blocked = [(key, path) for (key, path, _, _) in short
+                           if [o for (o, r) in self.reservations.items() if o != owner and key in r]]
+                if len(blocked) < len(short):
+                    for (key, path, nbytes, free) in short:
+                        logger.error("Not enough space on %s: %s needed, %s available; aborting." \
+                                         % (path, format_size(nbytes), format_size(max(free, 0))))
+                    return False
+                if not warned:
+                    logger.info("Waiting for other jobs to finish with %s" \
+                                    % ', '.join([path for (key, path) in blocked]))
+                    warned = True
+                # Space can be freed by jobs cleaning up, too.
+                self.space_released.wait(60)
+        finally:
+            self.space_released.release()
+
+    def release_space(self, owner):
+        self.space_released.acquire()
+        try:
+            self.reservations.pop(owner, None)
+            self.space_released.notify_all()
+        finally:
+            self.space_released.release()
+
+@contextlib.contextmanager
+def _no_resources():
+    yield
+
+def holding(settings, *names):
+    """Hold the named resources for a job (if it's running in a batch).
+
+    'drive' stands for the drive the job's disc is in.
+    """
+    resources = settings.get('resources')
+    if resources is None:
+        return _no_resources()
+    names = [name == 'drive' and settings['drive'] or name for name in names]
+    return resources.hold(names, settings['name'])
+
+def drive_resource(path):
+    """Name the resource for the drive (or volume) holding ``path``."""
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return 'drive:%s' % drive.upper()
+    try:
+        return 'drive:dev%d' % os.stat(path).st_dev
+    except OSError:
+        return 'drive:%s' % path
+
+def parse_playlist_indexes(values):
+    """Parse --playlist values: 'all' or a list of ints (may raise ValueError)."""
+    if 'all' in values:
+        return 'all'
+    return [int(x) for x in values]
+
+def check_output_dir(output_dir, mkvmerge):
+    """Return the output dir to use, or None if it should be ignored."""
+    # output_dir only makes sense if we're doing the mkvmerge step.
+    # (If more than one playlist is being demuxed, each mkv is named
+    # after its playlist.)
+    if output_dir == 'None':
+        # The config file default.
+        output_dir = None
+    if output_dir and mkvmerge is None:
+        logger.info("Ignoring output-dir option, because we're skipping the mkvmerge step.")
+        output_dir = None
+    elif output_dir:
+        logger.info("Writing MKV file to %s" % output_dir)
+    return output_dir
+
+def load_batch_state(filename):
+    try:
+        f = open(filename)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except IOError:
+        return {}
+
+def save_batch_state(filename, state):
+    write_atomic(filename, json.dumps(state, indent=1, sort_keys=True))
+
+# The demux() options a job in a batch manifest can set, by the name of
+# the manifest option, with how to read them.
+JOB_OPTIONS = {'soundtrack-languages': 'list',
+               'default-audio-track': 'string',
+               'output-dir': 'string',
+               'scratch-dir': 'string',
+               'job-dir': 'string',
+               'cleanup': 'boolean',
+               'verify': 'boolean',
+               'pipeline': 'boolean',
+               'prefetch': 'boolean',
+               'skip-duplicates': 'boolean',
+               'skip-invalid': 'boolean'}
+
+def read_batch_manifest(filename, defaults):
+    """Read a batch manifest into a list of (job name, demux options).
+
+    ``defaults`` are the demux() options every job starts from. Raises
+    ValueError for a manifest that doesn't make sense.
+    """
+    manifest = ConfigParser.SafeConfigParser()
+    if not manifest.read([filename]):
+        raise ValueError("Can't read batch manifest %s" % filename)
+    jobs = []
+    for section in manifest.sections():
+        if section == 'resources':
+            continue
+        def option(key, default=None):
+            if manifest.has_option(section, key):
+                return manifest.get(section, key)
+            return default
+        options = dict(defaults)
+        if not option('path'):
+            raise ValueError("Job %s has no path" % section)
+        options['path'] = option('path')
+        options['name'] = option('name', section)
+        if option('playlist'):
+            try:
+                options['playlist_indexes'] = parse_playlist_indexes(option('playlist').split())
+            except ValueError:
+                raise ValueError('Job %s: playlist indexes must be positive integers, or "all"' % section)
+        for key, kind in JOB_OPTIONS.items():
+            if not option(key):
+                continue
+            if kind == 'boolean':
+                options[key.replace('-', '_')] = manifest.getboolean(section, key)
+            elif kind == 'list':
+                options[key.replace('-', '_')] = option(key).split()
             else:
-                # XXX hack.
-                logger.error("Commentary track %s has unknown type: %s" % (track['id'], track['description']))
-                return 1
-            track['channels'] = re.search(r'(?P<channels>[1-7]\.[0-2] channels)', track['description']).group('channels')
-            # Keep dialog normalization for commentaries.
-            if re.search(r'dialnorm', track['description']):
-                add_option(track, '-keepDialnorm')
-        for track in subtitles:
-            track['filename'] = '%02dsubtitles.sup' % idnum(track)
-
-        if current_default_audio_track is None:
-            # assume default audio track is the first soundtrack
-            current_default_audio_track = soundtracks[0]['id']
-        else:
-            if current_default_audio_track not in [track['id'].rstrip(':') for track in soundtracks] and \
-                    current_default_audio_track not in [track['id'].rstrip(':') for track in commentaries]:
-                logger.error("You selected track ID %s as the default audio track, but it's not an audio track; aborting." % current_default_audio_track)
-                return 1
-            
-        eac3to_command = [eac3to, path, '%d)' % current_playlist]
-        for lst in [chapters, videos, soundtracks, commentaries, subtitles]:
-            for track in lst:
-                eac3to_command.append(track['id'])
-                eac3to_command.append(track['filename'])
-                if 'eac3to args' in track:
-                    # eac3to args are a list.
-                    eac3to_command += track['eac3to args']
+                options[key.replace('-', '_')] = option(key)
+        if not options['mkvmerge']:
+            # As on the command line, there's nothing to clean up or
+            # verify without the mux.
+            options['cleanup'] = options['verify'] = False
+        if option('profile'):
+            if option('profile') not in options['profiles']:
+                raise ValueError("Job %s: there's no profile %s" % (section, option('profile')))
+            options['profile'] = option('profile')
+        if option('sample'):
+            try:
+                options['sample'] = parse_sample(option('sample'))
+            except ValueError, e:
+                raise ValueError("Job %s: bad sample: %s" % (section, e))
+        options['output_dir'] = check_output_dir(options['output_dir'], options['mkvmerge'])
+        options['drive'] = option('drive')
+        jobs.append((section, options))
+    return jobs, manifest
 
-        logger.info('')
-        logger.info("Demuxing command line: %s", ' '.join(eac3to_command))
+def job_drive(options):
+    """Name the drive resource of a batch job."""
+    if options['drive'] is None:
+        return drive_resource(options['path'])
+    return 'drive:%s' % options['drive']
+
+def plan_batch(filename, defaults, slots=None, plan_json=None):
+    """Plan every job in a batch manifest without demuxing anything.
 
-        rc = subprocess.call(eac3to_command)
+    Logs each job's plan, how long the batch should take with ``slots``
+    jobs at a time (default: all of them, as run_batch() runs them) and
+    whether its output fits. The plan is written to ``plan_json`` as
+    JSON, if given. Returns 0 if every job could be planned.
+    """
+    try:
+        jobs, manifest = read_batch_manifest(filename, defaults)
+    except (ValueError, ConfigParser.Error), e:
+        logger.error(str(e))
+        return 1
+    estimates = []
+    status = 0
+    for job, options in jobs:
+        logger.info('')
+        logger.info('Planning %s' % job)
+        try:
+            rc = demux(dict(options, jobs=1, drive=job_drive(options), estimates=estimates))
+        except Exception:
+            logger.exception("Job %s failed" % job)
+            rc = 1
         if rc:
-            return rc
+            logger.error("Can't plan %s" % job)
+            status = status or rc
+    slots = slots or len(estimates)
+    seconds = schedule([(e['name'], e['drive'], e['drive_seconds'],
+                         max(e['seconds'] - e['drive_seconds'], 0)) for e in estimates],
+                       slots)
+    logger.info('')
+    logger.info('Batch plan, %d jobs at a time:' % slots)
+    for e in estimates:
+        logger.info('  %-30s %3d playlists %10s %10s' \
+                        % (e['name'], len(e['playlists']),
+                           format_size(sum([p['bytes'] for p in e['playlists']])),
+                           format_duration(e['seconds'])))
+    logger.info('Estimated time for the batch: %s' % format_duration(seconds))
+    space = {}
+    for e in estimates:
+        for key, (path, nbytes) in e['space'].items():
+            space[key] = (space.get(key, (path, 0))[0], space.get(key, (path, 0))[1] + nbytes)
+    fits = True
+    for key, (path, nbytes) in sorted(space.items()):
+        free = free_space(path)
+        logger.info('Space needed on %s: %s (%s free)' \
+                        % (path, format_size(nbytes),
+                           free is None and 'unknown' or format_size(free)))
+        if free is not None and free < nbytes:
+            logger.warning("The batch won't fit on %s: %s short." \
+                               % (path, format_size(nbytes - free)))
+            fits = False
+    if plan_json:
+        write_plan(plan_json, {'jobs': estimates, 'slots': slots, 'seconds': seconds,
+                               'space': space, 'fits': fits})
+    return status
 
-        mkvmerge_options = ['# Set default language']
-        mkvmerge_options += ['--default-language', 'eng']
-        # eac3to always saves the log file as 'foo - Log.txt' where 'foo'
-        # is the filename of the first extracted track, minus the '.txt'
-        # extension. In our case, that's the chapter file.
-        mkvmerge_options += ['', '# Attach eac3to extraction log']
-        mkvmerge_options += ['--attachment-description', 'eac3to extraction log',
-                             '--attachment-mime-type', 'text/plain',
-                             '--attach-file', '%s - Log.txt' % chapters[0]['filename'].rstrip('.txt')]
-        mkvmerge_options += ['', '# Chapter file']
-        for track in chapters:
-            mkvmerge_options += ['--chapters', track['filename']]
-        # XXX hack - assume first video track is the default
-        mkvmerge_options += ['', '# Default video track']
-        mkvmerge_options += ['--default-track', '-1:1',
-                             '--track-name', '-1:Theatrical release',
-                             videos[0]['filename']]
-        mkvmerge_options += ['', '# Additional video tracks (may be empty)']
-        for track in videos[1:]:
-            mkvmerge_options += ['--default-track', '-1:0', track['filename']]
-
-        mkvmerge_options += ['', '# Soundtracks']
-        for track in soundtracks:
-            if track['id'].rstrip(':') == current_default_audio_track:
-                dta = '-1:1'
-                # XXX hack: now reset default track so that if there's
-                # more than one track with the same id (e.g. a DTS-MA
-                # version of a FLAC track), we won't end up with two
-                # tracks marked as default.
-                current_default_audio_track = 0
-            else:
-                dta = '-1:0'
-            mkvmerge_options += ['--default-track', dta,
-                                 '--track-name', '-1:%s theatrical soundtrack (%s)' % (track['format'], track['channels']),
-                                 track['filename']]
-        mkvmerge_options += ['', '# Commentary tracks (may be empty)']
-        for track in commentaries:
-            if track['id'].rstrip(':') == current_default_audio_track:
-                dta = '-1:1'
-                # XXX hack: now reset default track so that if there's
-                # more than one track with the same id (e.g. a DTS-MA
-                # version of a FLAC track), we won't end up with two
-                # tracks marked as default.
-                current_default_audio_track = 0
-            else:
-                dta = '-1:0'
-            mkvmerge_options += ['--default-track', dta,
-                                 '--track-name', '-1:%s commentary (%s)' % (track['format'], track['channels']),
-                                 track['filename']]
-        mkvmerge_options += ['', '# Subtitles (may be empty)']
-        for track in subtitles:
-            mkvmerge_options += ['--default-track', '-1:0',
-                                 '--track-name', '-1:Subtitles',
-                                 track['filename']]
-        logger.info('Saving mkvmerge options to mkvmerge.options')
-        mkvopts_file = open('mkvmerge.options', 'w')
-        mkvopts_file.write('\n'.join(mkvmerge_options))
-        mkvopts_file.close()
-
-        if mkvmerge:
-            # Make the mkv.
-            logger.info('')
-            logger.info("Running mkvmerge")
-            if output_dir:
-                outpath = os.path.join(output_dir, name)
-                if not os.path.isdir(outpath):
-                    os.makedirs(outpath)
-                outfile = os.path.join(outpath, '%s.mkv' % name)
-            else:
-                outfile = name + '.mkv'
-            mkvmerge_command = [mkvmerge, "-o", outfile, "@mkvmerge.options"]
-            logger.info("mkvmerge command line: %s", ' '.join(mkvmerge_command))
-            rc = subprocess.call(mkvmerge_command)
-            if rc:
-                return rc
+def run_batch(filename, defaults, retry_failed=False):
+    """Run every job in a batch manifest; see the comment above.
 
-            if cleanup:
-                logger.info("Cleaning up demuxed tracks.")
-                for lst in [chapters, videos, soundtracks, commentaries, subtitles]:
-                    for track in lst:
-                        os.remove(track['filename'])
-                os.remove('%02dchapters - Log.txt' % idnum(chapters[0]))
-                os.remove('mkvmerge.options')
+    Job progress is kept in '<manifest>.state', so an interrupted batch
+    can be restarted: finished jobs are skipped, as are failed ones
+    unless ``retry_failed`` is set. Returns 0 if every job succeeded.
+    """
+    try:
+        jobs, manifest = read_batch_manifest(filename, defaults)
+    except (ValueError, ConfigParser.Error), e:
+        logger.error(str(e))
+        return 1
+    capacities = {'cpu': multiprocessing.cpu_count(), 'mux': 1}
+    readers = 1
+    if manifest.has_section('resources'):
+        for key in ['cpu', 'mux']:
+            if manifest.has_option('resources', key):
+                capacities[key] = manifest.getint('resources', key)
+        if manifest.has_option('resources', 'readers-per-drive'):
+            readers = manifest.getint('resources', 'readers-per-drive')
+    resources = Resources(capacities, readers)
+    logger.info('Batch of %d jobs; %d CPU slots, %d mux slots, %d reader(s) per drive' \
+                    % (len(jobs), capacities['cpu'], capacities['mux'], readers))
 
-        os.chdir("..")
-        if cleanup and not os.listdir(demux_dir):
-            logger.info("Removing empty demux directory %s" % demux_dir)
-            os.rmdir(demux_dir)
+    state_file = filename + '.state'
+    state = load_batch_state(state_file)
+    state_lock = threading.Lock()
+    def update_state(job, **fields):
+        state_lock.acquire()
+        try:
+            state.setdefault(job, {}).update(fields)
+            save_batch_state(state_file, state)
+        finally:
+            state_lock.release()
 
-    logger.info('Done')
-    return 0
+    def run_job(job, options):
+        update_state(job, status='running', started=time.time())
+        started = time.time()
+        try:
+            rc = demux(options)
+        except Exception:
+            logger.exception("Job %s failed" % job)
+            rc = 1
+        update_state(job, status=rc and 'failed' or 'done', returncode=rc,
+                     elapsed=time.time() - started,
+                     waited=resources.waited.get(options['name'], 0.0))
+
+    threads = []
+    for job, options in jobs:
+        status = state.get(job, {}).get('status')
+        if status == 'done' or (status == 'failed' and not retry_failed):
+            logger.info("Skipping %s job %s" % (status, job))
+            continue
+        options = dict(options, resources=resources, jobs=1, drive=job_drive(options))
+        thread = threading.Thread(target=run_job, name=job, args=(job, options))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+    logger.info('')
+    logger.info('Batch summary:')
+    status = 0
+    for job, options in jobs:
+        job_state = state.get(job, {})
+        logger.info('  %-30s %-8s %10s elapsed, %10s waiting for resources' \
+                        % (job, job_state.get('status', 'pending'),
+                           format_duration(job_state.get('elapsed', 0)),
+                           format_duration(job_state.get('waited', 0))))
+        if job_state.get('status') != 'done' and not status:
+            status = job_state.get('returncode') or 1
+    return status
 
 def main(argv=None):
     if argv is None:
@@ -424,26 +4406,83 @@ def main(argv=None):
     parser.add_argument('--mkvmerge', nargs=1, default=None,
                         help='Path to mkvmerge.')
     parser.add_argument('--output-dir', nargs=1, default=None,
-                        help='Write mkv file to this directory (default: same as playlist dir). Note that if the mkvmerge step is disabled, or if multiple playlists are to be demuxed, this flag is ignored.')
+                        help='Write mkv file to this directory (default: same as playlist dir). If multiple playlists are demuxed, each mkv is named after its playlist. Note that if the mkvmerge step is disabled, this flag is ignored.')
+    parser.add_argument('--scratch-dir', nargs=1, default=None,
+                        help='Demux tracks into playlist dirs under this directory (default: the current working dir).')
+    parser.add_argument('--no-preflight', action='store_true', default=None,
+                        help="Don't check there's enough disk space for the tracks and mkv files before demuxing.")
+    parser.add_argument('--skip-duplicates', action='store_true', default=None,
+                        help="Don't demux selected playlists that only play clips other selected playlists play too, e.g. a 'play all' playlist next to its episodes (default: False).")
+    parser.add_argument('--skip-invalid', action='store_true', default=None,
+                        help="If some of the selected playlists can't be demuxed (all of them are scanned and checked first), demux the others instead of aborting (default: False).")
+    parser.add_argument('--scan-jobs', nargs=1, type=int, default=None,
+                        help='Scan up to this many playlists at once before demuxing; only cached scans run side by side, the disc is read by one scan at a time (default: %d).' % PRESCAN_JOBS)
+    parser.add_argument('--prefetch', action='store_true', default=None,
+                        help="Copy the clips of the selected playlists from the disc to the scratch dir in one sequential pass, and extract from the copy (default: False). The copy is removed afterwards.")
     parser.add_argument('--cleanup', action='store_true', default=None,
                         help='Clean up demuxed tracks after mkvmerge (default: False). Ignored if mkvmerge step is disabled.')
+    parser.add_argument('--verify', action='store_true', default=None,
+                        help="Hash the demuxed tracks while mkvmerge reads them, then check the mkv's tracks, duration and size before cleaning up (default: False). Ignored if mkvmerge step is disabled.")
     parser.add_argument('--eac3to', nargs=1, default=None,
                         help='Path to eac3to.')
-    parser.add_argument('path', nargs=1)
-    parser.add_argument('name', nargs=1)
+    parser.add_argument('--jobs', nargs=1, type=int, default=None,
+                        help='Demux up to this many playlists in parallel, longest first (default: 1).')
+    parser.add_argument('--pipeline', action='store_true', default=None,
+                        help='Overlap the extract, mux, verify and cleanup steps of consecutive playlists, and report how long each step worked and waited (default: False). Ignored if --jobs is greater than 1.')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="Don't read or write the scan and tool probe caches.")
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                        help='Rescan the disc even if its scans are cached, and update the cache.')
+    parser.add_argument('--progress-json', nargs=1, default=None,
+                        help='Append eac3to and mkvmerge progress events to this file, as JSON lines.')
+    parser.add_argument('--trace', nargs=1, default=None,
+                        help="Record how long each step took, the CPU time of its child processes and the bytes it wrote in this file, as JSON lines or, if it ends in '.json', as Chrome trace events.")
+    parser.add_argument('--flac-jobs', nargs=1, type=int, default=None,
+                        help="Extract FLAC tracks as WAV and encode them with up to this many flac processes per playlist, instead of inside eac3to's own run; needs scratch space for the WAVs (default: 0, let eac3to encode them).")
+    parser.add_argument('--flac', nargs=1, default=None,
+                        help='Path to flac (used with --flac-jobs).')
+    parser.add_argument('--flac-compression', nargs=1, type=int, default=None,
+                        help='flac compression level, 0-8 (used with --flac-jobs; default: 8).')
+    parser.add_argument('--stream', action='store_true', default=None,
+                        help="Stream one track of each playlist, the first one eac3to can write sequentially (see 'stream-formats' in the config; usually the main soundtrack), straight into mkvmerge through a named pipe, instead of extracting it to disk. The streamed track is read from the disc by a second eac3to run while the first extracts the rest. Ignored if mkvmerge step is disabled, or if mkvmerge can't read from named pipes (checked when it's probed); if mkvmerge can't read a format that way, tracks of that format are extracted after all.")
+    parser.add_argument('--job-dir', nargs=1, default=None,
+                        help="Hand FLAC encoding and muxing to workers (see --worker) through this directory, instead of running flac and mkvmerge here. The job, scratch and output dirs must be on a filesystem the workers share, at the same paths.")
+    parser.add_argument('--worker', nargs=1, default=None,
+                        help='Run flac and mkvmerge jobs from this job directory, --jobs at a time, until interrupted, instead of ripping anything.')
+    parser.add_argument('--profile', nargs=1, default=None,
+                        help="Rip with this profile: 'archive' keeps lossless soundtracks both as FLAC and as they are, 'fast' only as they are, 'compact' only as FLAC; more can be defined in the config (default: %s)." % DEFAULT_PROFILE)
+    parser.add_argument('--sample', nargs=1, default=None,
+                        help="Only mux a sample of each playlist, into NAME.sample.mkv, to try out the track selection and options: a chapter or chapter range ('3', '3-5') or a time range ('0:10:00-0:12:00'). The tracks are extracted from the start of the playlist up to the end of the sample.")
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help="Don't extract or mux anything: scan and plan the selected playlists, and estimate each track's size and how long everything will take from earlier runs. With --batch, also estimate how long the batch takes with --jobs discs at a time (default: all at once) and whether it fits.")
+    parser.add_argument('--plan-json', nargs=1, default=None,
+                        help='With --plan, also write the plan to this file as JSON.')
+    parser.add_argument('--batch', nargs=1, default=None,
+                        help='Rip every disc listed in this batch manifest, instead of a single path and name. Finished jobs are recorded next to the manifest and skipped when the batch is restarted.')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='When restarting a batch, also rerun jobs that failed.')
+    parser.add_argument('path', nargs='?')
+    parser.add_argument('name', nargs='?')
     args = parser.parse_args(argv)
+    if not args.batch and not args.worker and (args.path is None or args.name is None):
+        parser.error('path and name are required (unless --batch or --worker is given)')
 
     if args.playlist is None:
         playlist_indexes = None
     else:
-        if 'all' in args.playlist:
-            playlist_indexes = 'all'
-        else:
-            try:
-                playlist_indexes = [int(x) for x in args.playlist]
-            except ValueError:
-                print >> sys.stderr, 'Playlist indexes must be an positive integer, or "all"'
-                return 1
+        try:
+            playlist_indexes = parse_playlist_indexes(args.playlist)
+        except ValueError:
+            print >> sys.stderr, 'Playlist indexes must be an positive integer, or "all"'
+            return 1
+    if args.sample is None:
+        sample = None
+    else:
+        try:
+            sample = parse_sample(args.sample[0])
+        except ValueError, e:
+            print >> sys.stderr, "Bad sample '%s': %s" % (args.sample[0], e)
+            return 1
     if args.default_audio_track is None:
         default_audio_track = None
     else:
@@ -456,13 +4495,35 @@ def main(argv=None):
     config_defaults = {'mkvmerge': 'mkvmerge',
                        'eac3to': 'eac3to',
                        'output-dir': 'None',
-                       'cleanup': 'False'
+                       'scratch-dir': 'None',
+                       'job-dir': 'None',
+                       'preflight': 'True',
+                       'skip-duplicates': 'False',
+                       'skip-invalid': 'False',
+                       'profile': DEFAULT_PROFILE,
+                       'scan-jobs': str(PRESCAN_JOBS),
+                       'prefetch': 'False',
+                       'cleanup': 'False',
+                       'verify': 'False',
+                       'jobs': '1',
+                       'pipeline': 'False',
+                       'cache-dir': os.path.join(os.path.expanduser('~'), '.eac3bot-cache'),
+                       'cache-max-size': '64',
+                       'cache-max-age': '90',
+                       'flac': 'flac',
+                       'flac-jobs': '0',
+                       'flac-compression': '8',
+                       'stream': 'False',
+                       'stream-formats': ' '.join(DEFAULT_STREAM_FORMATS)
                        }
     config = ConfigParser.SafeConfigParser(config_defaults)
     config.read(conffile)
     
     logger.setLevel(logging.INFO)
     console = logging.StreamHandler()
+    if args.batch:
+        # Tell the jobs' interleaved output apart.
+        console.setFormatter(logging.Formatter('[%(threadName)s] %(message)s'))
     logger.addHandler(console)
 
     # Merge config and command line. The latter takes precedence.
@@ -490,38 +4551,207 @@ def main(argv=None):
     else:
         logger.info('Skipping mkvmerge step')
 
-    # output_dir only makes sense if we're doing the mkvmerge step,
-    # and we're not demuxing more than one playlist. (If more than one
-    # playlist is being demuxed, it's probable either that this is a
-    # TV show with multiple episodes, or the user isn't sure which
-    # playlist she wants to keep, and needs to do some postmortem
-    # analysis.)
     if args.output_dir:
         output_dir = args.output_dir[0]
     else:
         output_dir = stripquotes(config.get('DEFAULT', 'output-dir'))
-    if output_dir and mkvmerge is None:
-        logger.info("Ignoring output-dir option, because we're skipping the mkvmerge step.")
-        output_dir = None
-    elif output_dir and playlist_indexes and len(playlist_indexes) != 1:
-        logger.info("Ignoring output-dir option, because we're extracting multiple playlists.")
-        output_dir = None
-    elif output_dir:
-        logger.info("Writing MKV file to %s" % output_dir)
+    if not args.batch:
+        output_dir = check_output_dir(output_dir, mkvmerge)
+    if args.scratch_dir:
+        scratch_dir = args.scratch_dir[0]
+    else:
+        scratch_dir = stripquotes(config.get('DEFAULT', 'scratch-dir'))
+    if scratch_dir == 'None':
+        scratch_dir = None
+    if args.no_preflight:
+        preflight = False
+    else:
+        preflight = config.getboolean('DEFAULT', 'preflight')
+
+    if args.job_dir:
+        job_dir = args.job_dir[0]
+    else:
+        job_dir = stripquotes(config.get('DEFAULT', 'job-dir'))
+    if job_dir == 'None':
+        job_dir = None
+
+    if args.prefetch is None:
+        prefetch = config.getboolean('DEFAULT', 'prefetch')
+    else:
+        prefetch = args.prefetch
+    if args.skip_duplicates is None:
+        skip_duplicates = config.getboolean('DEFAULT', 'skip-duplicates')
+    else:
+        skip_duplicates = args.skip_duplicates
+
+    try:
+        profiles = read_profiles(config)
+    except ValueError, e:
+        print >> sys.stderr, e
+        return 1
+    if args.profile:
+        profile = args.profile[0]
+    else:
+        profile = config.get('DEFAULT', 'profile')
+    if profile not in profiles:
+        print >> sys.stderr, "There's no profile %s (there are %s)" \
+            % (profile, ', '.join(sorted(profiles)))
+        return 1
+
+    if args.skip_invalid is None:
+        skip_invalid = config.getboolean('DEFAULT', 'skip-invalid')
+    else:
+        skip_invalid = args.skip_invalid
+
+    if args.jobs:
+        jobs = args.jobs[0]
+    else:
+        jobs = config.getint('DEFAULT', 'jobs')
+    if jobs < 1:
+        print >> sys.stderr, 'The number of jobs must be a positive integer'
+        return 1
+    if args.scan_jobs:
+        scan_jobs = args.scan_jobs[0]
+    else:
+        scan_jobs = config.getint('DEFAULT', 'scan-jobs')
+    if scan_jobs < 1:
+        print >> sys.stderr, 'The number of scan jobs must be a positive integer'
+        return 1
+
+    if args.pipeline is None:
+        pipeline = config.getboolean('DEFAULT', 'pipeline')
+    else:
+        pipeline = args.pipeline
+
+    # Extra track classification rules, as 'name = kind: pattern'.
+    extra_track_rules = []
+    if config.has_section('track-rules'):
+        for option in config.options('track-rules'):
+            if option in config.defaults():
+                continue
+            value = config.get('track-rules', option, raw=True)
+            kind, _, pattern = value.partition(':')
+            if kind.strip() not in TRACK_KINDS:
+                print >> sys.stderr, 'Track rule %s: kind must be one of %s' \
+                    % (option, ', '.join(TRACK_KINDS))
+                return 1
+            try:
+                re.compile(pattern.strip())
+            except re.error, e:
+                print >> sys.stderr, 'Track rule %s: bad pattern (%s)' % (option, e)
+                return 1
+            extra_track_rules.append((option, kind.strip(), pattern.strip()))
+
+    if args.flac:
+        flac = args.flac[0]
+    else:
+        flac = stripquotes(config.get('DEFAULT', 'flac'))
+    if args.worker:
+        return run_worker(os.path.abspath(args.worker[0]),
+                          {'mkvmerge': mkvmerge or 'mkvmerge', 'flac': flac}, jobs)
+    if args.flac_jobs is not None:
+        flac_jobs = args.flac_jobs[0]
+    else:
+        flac_jobs = config.getint('DEFAULT', 'flac-jobs')
+    if args.flac_compression is not None:
+        flac_compression = args.flac_compression[0]
+    else:
+        flac_compression = config.getint('DEFAULT', 'flac-compression')
+    if flac_jobs < 0 or not 0 <= flac_compression <= 8:
+        print >> sys.stderr, 'flac-jobs must be 0 or more, and flac-compression between 0 and 8'
+        return 1
+    if flac_jobs:
+        logger.info('Encoding FLAC tracks with %s (level %d, %d per playlist)' \
+                        % (flac, flac_compression, flac_jobs))
+
+    if args.stream is None:
+        stream = config.getboolean('DEFAULT', 'stream')
+    else:
+        stream = args.stream
+    stream_formats = config.get('DEFAULT', 'stream-formats').split()
+    if stream and mkvmerge is None:
+        logger.info("Ignoring stream option, because we're skipping the mkvmerge step.")
+        stream = False
+
+    # Scan cache size is given in MB, age in days.
+    cache_dir = stripquotes(config.get('DEFAULT', 'cache-dir'))
+    cache_max_size = config.getint('DEFAULT', 'cache-max-size') * 1024 * 1024
+    cache_max_age = config.getint('DEFAULT', 'cache-max-age') * 24 * 3600
 
     # Only clean up if mkvmerge is enabled.
     if mkvmerge:
         if args.cleanup is None:
-            cleanup = config.get('DEFAULT', 'cleanup')
+            cleanup = config.getboolean('DEFAULT', 'cleanup')
         else:
             cleanup = args.cleanup
     else:
         cleanup = False
-
+    if args.verify is None:
+        verify = config.getboolean('DEFAULT', 'verify')
+    else:
+        verify = args.verify
+    if verify and mkvmerge is None:
+        logger.info("Ignoring verify option, because we're skipping the mkvmerge step.")
+        verify = False
 
     logger.info('')
 
-    return demux(eac3to, mkvmerge, output_dir, cleanup, args.path[0], args.name[0], playlist_indexes, args.soundtrack_languages, default_audio_track)
+    if args.progress_json:
+        progress_json = os.path.abspath(args.progress_json[0])
+    else:
+        progress_json = None
+    if args.trace:
+        trace = os.path.abspath(args.trace[0])
+    else:
+        trace = None
+
+    options = {'eac3to': eac3to,
+               'mkvmerge': mkvmerge,
+               'output_dir': output_dir,
+               'cleanup': cleanup,
+               'verify': verify,
+               'playlist_indexes': playlist_indexes,
+               'soundtrack_languages': args.soundtrack_languages,
+               'default_audio_track': default_audio_track,
+               'jobs': jobs,
+               'pipeline': pipeline,
+               'use_cache': not args.no_cache,
+               'cache_dir': cache_dir,
+               'refresh_cache': args.refresh_cache,
+               'cache_max_size': cache_max_size,
+               'cache_max_age': cache_max_age,
+               'extra_track_rules': extra_track_rules,
+               'progress_json': progress_json,
+               'flac': flac,
+               'flac_jobs': flac_jobs,
+               'flac_compression': flac_compression,
+               'stream': stream,
+               'stream_formats': stream_formats,
+               'trace': trace,
+               'scratch_dir': scratch_dir,
+               'preflight': preflight,
+               'skip_duplicates': skip_duplicates,
+               'prefetch': prefetch,
+               'job_dir': job_dir,
+               'scan_jobs': scan_jobs,
+               'skip_invalid': skip_invalid,
+               'sample': sample,
+               'profile': profile,
+               'profiles': profiles}
+    if args.batch:
+        if args.plan:
+            return plan_batch(args.batch[0], options, args.jobs and args.jobs[0],
+                              args.plan_json and args.plan_json[0])
+        return run_batch(args.batch[0], options, args.retry_failed)
+
+    if args.plan:
+        estimates = []
+    else:
+        estimates = None
+    rc = demux(dict(options, path=args.path, name=args.name, estimates=estimates))
+    if not rc and args.plan_json and estimates:
+        write_plan(args.plan_json[0], estimates[0])
+    return rc
 
 if __name__ == '__main__':
     status = main()